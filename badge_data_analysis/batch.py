@@ -0,0 +1,209 @@
+import os
+import csv
+import glob
+import time
+import argparse
+import traceback
+import numpy as np
+from . import preprocessing, vad, metrics, profiling, kernels, parallel
+from .correlations import CorrelationTable, MAX_BYTES, session_key
+
+# Parameters of every stage of the analysis, with the defaults of each function
+DEFAULT_PARAMS = {'excluded_members': [], 'use_cache': False,
+                  'fix_time_jumps': True, 'max_jump_sec': 1, 'percentile': 1,
+                  'align': None,
+                  'window': 1.0, 'max_temp_shift': 0.15, 'corr_thr': 0.85,
+                  'silence_thr_mean': 1.0, 'silence_thr_std': 0.0,
+                  'bandwidth': None, 'kde_method': 'exact',
+                  'threshold_by_mean': True,
+                  'threshold_by_std': True, 'min_succesive_non_overlap': 2,
+                  'fill_gaps': False, 'max_gap': 1, 'prune_similarity': None,
+                  'corr_cache': None, 'corr_cache_bytes': MAX_BYTES,
+                  'backend': None}
+
+# Parameters that change the windowed signals, and so the correlations
+SIGNAL_PARAMS = ('excluded_members', 'fix_time_jumps', 'max_jump_sec',
+                 'percentile', 'align', 'window')
+
+# Names of the values returned by metrics.calculate_indicators
+INDICATORS = ('speaking_time', 'p_cv', 'dominance', 'total_p', 'total_cp',
+              'turn_taking_count', 'ttf', 'avg_s_segm', 'overlap_time',
+              'overlap_count', 'total_o', 'avg_o_segm')
+MEMBER_INDICATORS = ('speaking_time', 'turn_taking_count', 'overlap_time',
+                     'overlap_count')
+
+def _params(params):
+    unknown = set(params) - set(DEFAULT_PARAMS)
+    if unknown:
+        raise ValueError('Unknown parameters: ' + ', '.join(sorted(unknown)))
+    return dict(DEFAULT_PARAMS, **params)
+
+def correlation_table(filename, max_lags=(), **params):
+    # Table of window correlations of a log, cached on disk when the
+    # corr_cache parameter is a directory
+    p = _params(params)
+    if p['corr_cache'] == None:
+        return CorrelationTable(max_lags=max_lags)
+    key = session_key(filename, **{k: p[k] for k in SIGNAL_PARAMS})
+    return CorrelationTable(p['corr_cache'], key, max_lags, p['corr_cache_bytes'])
+
+def process(data, correlations=None, workers=1, **params):
+    # Run the analysis on preprocessed data: vad, thresholds and metrics.
+    # With workers other than 1 genuine_speak and real_speak correlate the
+    # windows in one pool of worker processes
+    p = _params(params)
+    with parallel.pool(workers) as executor:
+        workers = 1 if executor == None else executor
+        vad.genuine_speak(data, p['window'], p['max_temp_shift'], p['corr_thr'],
+                          p['silence_thr_mean'], p['silence_thr_std'], workers,
+                          correlations, p['prune_similarity'])
+        vad.calculate_thresholds(data, p['bandwidth'], p['kde_method'])
+        vad.all_speak(data, p['threshold_by_mean'], p['threshold_by_std'])
+        vad.real_speak(data, p['corr_thr'], p['max_temp_shift'], workers,
+                       correlations, p['prune_similarity'])
+    metrics.speaking_time(data)
+    metrics.overlap_time(data)
+    metrics.overlap_count(data, p['fill_gaps'], p['max_gap'])
+    metrics.turn_taking(data, p['min_succesive_non_overlap'], p['fill_gaps'],
+                        p['max_gap'])
+    return data
+
+def run_session(filename, workers=1, **params):
+    # Full flow for one log file, from read_file to calculate_indicators,
+    # with the kernels of the backend parameter (default: kernels.backend)
+    # and the correlations in workers processes (see process)
+    p = _params(params)
+    with kernels.using(p['backend']):
+        data = preprocessing.read_file(filename, p['excluded_members'],
+                                       p['use_cache'])
+        if p['fix_time_jumps']:
+            preprocessing.fix_time_jumps(data, p['max_jump_sec'])
+        preprocessing.truncate(data)
+        preprocessing.remove_offset(data, p['percentile'])
+        if p['align'] != None:
+            preprocessing.align(data, method=p['align'])
+        table = correlation_table(filename, **params) if p['corr_cache'] != None else None
+        process(data, table, workers, **params)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            indicators = metrics.calculate_indicators(data, print_results=False)
+    return data, dict(zip(INDICATORS, indicators))
+
+def _session_rows(filename, params, profile_dir=None):
+    # One row per member with the member and team indicators. Any error is
+    # reported in its own row so one bad session does not stop the batch.
+    # With profile_dir the profile of the session is saved there as JSON
+    session = os.path.splitext(os.path.basename(filename))[0]
+    t0 = time.perf_counter()
+    try:
+        if profile_dir != None:
+            with profiling.profile() as profiler:
+                data, indicators = run_session(filename, **params)
+            profiler.to_json(os.path.join(profile_dir, session + '.json'))
+        else:
+            data, indicators = run_session(filename, **params)
+    except Exception as e:
+        return [{'session': session, 'file': filename, 'member': None,
+                 'error': type(e).__name__ + ': ' + str(e),
+                 'traceback': traceback.format_exc()}]
+    elapsed = time.perf_counter() - t0
+    rows = []
+    for i, member in enumerate(data.members):
+        row = {'session': session, 'file': filename, 'member': member}
+        for key in INDICATORS:
+            value = indicators[key]
+            row[key] = value[i] if key in MEMBER_INDICATORS else value
+        row['duration'] = data.meeting_duration
+        row['elapsed'] = elapsed
+        row['error'] = None
+        rows.append(row)
+    return rows
+
+def find_logs(paths):
+    # Expand directories (all .txt files inside) and glob patterns
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(glob.glob(os.path.join(path, '*.txt'))))
+        else:
+            files.extend(sorted(glob.glob(path)) if glob.has_magic(path) else [path])
+    return files
+
+def run_batch(paths, workers=None, profile_dir=None, **params):
+    # Analyse many sessions in parallel processes and collect the indicators
+    # in a single table (a list of rows, see write_csv)
+    files = find_logs([paths] if isinstance(paths, str) else paths)
+    _params(params)
+    if profile_dir != None:
+        os.makedirs(profile_dir, exist_ok=True)
+    if workers == 1:
+        results = [_session_rows(filename, params, profile_dir) for filename in files]
+    else:
+        with parallel.executor(workers) as executor:
+            results = list(executor.map(_session_rows, files, [params]*len(files),
+                                        [profile_dir]*len(files)))
+    return [row for rows in results for row in rows]
+
+def write_csv(rows, filename):
+    columns = ['session', 'file', 'member'] + list(INDICATORS)
+    columns += ['duration', 'elapsed', 'error']
+    with open(filename, 'w', newline='') as fid:
+        writer = csv.DictWriter(fid, columns, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(rows)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Analyse a batch of badge '
+                                     'audio logs and save their indicators.')
+    parser.add_argument('paths', nargs='+', help='log files, directories or '
+                        'glob patterns')
+    parser.add_argument('-o', '--output', default='indicators.csv')
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help='number of worker processes (default: all cores)')
+    parser.add_argument('--exclude', type=int, nargs='*', default=[],
+                        help='member ids to exclude')
+    parser.add_argument('--use-cache', action='store_true')
+    parser.add_argument('--align', choices=['nearest', 'linear'], default=None,
+                        help='resample all members on a common time grid')
+    parser.add_argument('--corr-cache', default=None, help='directory where '
+                        'the window correlations are cached')
+    parser.add_argument('--corr-cache-size', type=float, default=1024,
+                        help='size cap of the correlation cache in MiB')
+    for name in ('window', 'max_temp_shift', 'corr_thr', 'silence_thr_mean',
+                 'silence_thr_std', 'bandwidth'):
+        parser.add_argument('--' + name.replace('_', '-'), type=float,
+                            default=DEFAULT_PARAMS[name])
+    parser.add_argument('--kde-method', choices=['exact', 'binned'],
+                        default=DEFAULT_PARAMS['kde_method'])
+    parser.add_argument('--fill-gaps', action='store_true')
+    parser.add_argument('--max-gap', type=int, default=DEFAULT_PARAMS['max_gap'])
+    parser.add_argument('--prune-similarity', type=float, default=None,
+                        help='skip the correlation of members whose loudness '
+                        'envelopes are less similar than this (large groups)')
+    parser.add_argument('--backend', choices=kernels.BACKENDS, default=None,
+                        help='kernels of the window loops (default: numba when '
+                        'it is installed)')
+    parser.add_argument('--profile', default=None, help='directory where the '
+                        'time spent in every stage is saved, one JSON per session')
+    args = parser.parse_args(argv)
+    
+    params = {name: getattr(args, name) for name in ('window',
+              'max_temp_shift', 'corr_thr', 'silence_thr_mean',
+              'silence_thr_std', 'bandwidth', 'kde_method', 'fill_gaps',
+              'max_gap')}
+    params['excluded_members'] = args.exclude
+    params['use_cache'] = args.use_cache
+    params['align'] = args.align
+    params['corr_cache'] = args.corr_cache
+    params['corr_cache_bytes'] = int(args.corr_cache_size*2**20)
+    params['prune_similarity'] = args.prune_similarity
+    params['backend'] = args.backend
+    rows = run_batch(args.paths, args.workers, args.profile, **params)
+    write_csv(rows, args.output)
+    for row in rows:
+        if row['error'] != None:
+            print('Failed:', row['file'], '-', row['error'])
+    print('Indicators of', len({row['file'] for row in rows}), 'sessions saved to',
+          args.output)
+
+if __name__ == '__main__':
+    main()
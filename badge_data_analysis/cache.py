@@ -0,0 +1,67 @@
+import os
+import json
+import shutil
+import numpy as np
+from .meeting_data import MeetingData
+
+CACHE_VERSION = 2
+CACHE_SUFFIX = '.cache'
+
+def cache_path(filename):
+    # The cache of a log is a directory next to it
+    return filename + CACHE_SUFFIX
+
+def _source_stat(filename):
+    stat = os.stat(filename)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+def _read_header(filename):
+    try:
+        with open(os.path.join(cache_path(filename), 'header.json'), 'r') as fid:
+            return json.load(fid)
+    except (OSError, ValueError):
+        return None
+
+def is_valid(filename):
+    # A cache is valid while the source log keeps its size and mtime
+    header = _read_header(filename)
+    return (header is not None and header['version'] == CACHE_VERSION
+            and header['source'] == _source_stat(filename))
+
+def save(data, filename):
+    # Write the members x samples matrices of time and signal as .npy files 
+    # plus a small json header. The directory is written aside and renamed so
+    # readers never see it half done
+    path = cache_path(filename)
+    tmp_path = path + '.tmp' + str(os.getpid())
+    os.makedirs(tmp_path)
+    rows, samples, lengths, starts = data._export_samples()
+    header = {'version': CACHE_VERSION, 'source': _source_stat(filename),
+              'members': [[member, row] for member, row in rows.items()],
+              'lengths': {key: lengths[key].tolist() for key in ('time', 'signal')},
+              'starts': {key: starts[key].tolist() for key in ('time', 'signal')}}
+    for key in ('time', 'signal'):
+        np.save(os.path.join(tmp_path, key + '.npy'), samples[key])
+    with open(os.path.join(tmp_path, 'header.json'), 'w') as fid:
+        json.dump(header, fid)
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.rename(tmp_path, path)
+
+def load(filename, excluded_members=[], mmap_mode='c'):
+    # Memory-map the cached matrices. The default copy-on-write mode keeps 
+    # pages on disk until they are modified by the in-place preprocessing
+    # stages. Excluded members are only left out of the row map
+    path = cache_path(filename)
+    header = _read_header(filename)
+    rows = {member: row for member, row in header['members'] 
+            if not member in excluded_members}
+    samples = {key: np.load(os.path.join(path, key + '.npy'), mmap_mode=mmap_mode)
+               for key in ('time', 'signal')}
+    return MeetingData._from_samples(rows, samples, header['lengths'],
+                                     header.get('starts'))
+
+def clear(filename):
+    path = cache_path(filename)
+    if os.path.isdir(path):
+        shutil.rmtree(path)
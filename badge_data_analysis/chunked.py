@@ -0,0 +1,443 @@
+import os
+import shutil
+import argparse
+import tempfile
+import numpy as np
+from . import preprocessing, vad, metrics, profiling, kernels
+from .meeting_data import MeetingData
+from .batch import DEFAULT_PARAMS, INDICATORS, _params
+from .pipeline import _metrics
+
+# Samples per block of the time extents index of the spools
+BLOCK = 4096
+# Samples read at once when a spool is scanned from start to end
+SCAN_BLOCK = 256*BLOCK
+# Parameters that only exist for whole sessions in memory
+IN_MEMORY_PARAMS = ('use_cache', 'align', 'corr_cache')
+
+class _Counts():
+    ''' Mergeable summary of a multiset of values: the distinct values, sorted,
+    and the number of times each one occurs. Percentiles and medians are the
+    same as NumPy gives on the values themselves, with memory bounded by the
+    number of distinct values (amplitudes, sample periods).
+    '''
+
+    def __init__(self, dtype=float):
+        self.values = np.zeros((0,), dtype=dtype)
+        self.counts = np.zeros((0,), dtype=np.int64)
+
+    @property
+    def total(self):
+        return int(np.sum(self.counts))
+
+    def add(self, values, counts=None):
+        if counts is None:
+            values, counts = np.unique(values, return_counts=True)
+        merged, inverse = np.unique(np.concatenate((self.values, values)),
+                                    return_inverse=True)
+        total = np.zeros((len(merged),), dtype=np.int64)
+        np.add.at(total, inverse, np.concatenate((self.counts, counts)))
+        self.values, self.counts = merged, total
+        return self
+
+    def merge(self, other):
+        return self.add(other.values, other.counts)
+
+    def replace(self, old, new):
+        # Replace one occurrence of old by new
+        self.counts[np.searchsorted(self.values, old)] -= 1
+        return self.add(np.array([new], dtype=self.values.dtype), np.array([1]))
+
+    def kth(self, idx):
+        # Values at positions idx of the sorted multiset
+        positions = np.searchsorted(np.cumsum(self.counts), idx, side='right')
+        return self.values[positions]
+
+    def percentile(self, percentile):
+        return preprocessing._percentile_of(self.kth, self.total, percentile)
+
+    def median(self):
+        # As preprocessing._median_sorted
+        n = self.total
+        if n % 2:
+            return self.kth([n//2])[0]
+        return np.mean(self.kth([n//2-1, n//2]))
+
+class _Spool():
+    ''' Samples of one member in arrival order, on disk. Times and signal are
+    appended to two files while the log is parsed, and read back one block at
+    a time once it is closed.
+    '''
+
+    DTYPES = {'time': np.float64, 'signal': np.int64}
+
+    def __init__(self, path):
+        self.path = path
+        self.size = 0
+        self.low, self.high = 0, 0
+        self._files = {key: open(path + '.' + key, 'wb') for key in self.DTYPES}
+
+    def append(self, time, signal):
+        signal = np.asarray(signal, dtype=np.int64)
+        if len(signal) > 0:
+            self.low = min(self.low, signal.min())
+            self.high = max(self.high, signal.max())
+        self._files['time'].write(np.asarray(time, dtype=np.float64).tobytes())
+        self._files['signal'].write(signal.tobytes())
+        self.size += len(signal)
+
+    def close(self):
+        for fid in self._files.values():
+            fid.close()
+
+    def read(self, key, start, end):
+        # Samples start to end (excluded) of time or signal
+        dtype = np.dtype(self.DTYPES[key])
+        start, end = max(start, 0), min(end, self.size)
+        return np.fromfile(self.path + '.' + key, dtype=dtype, count=max(end - start, 0),
+                           offset=start*dtype.itemsize)
+
+    def blocks(self, size=SCAN_BLOCK):
+        for start in range(0, self.size, size):
+            yield start, self.read('time', start, start + size)
+
+def _release(data):
+    # Free a chunk as soon as it is used. The rows of a MeetingData refer back
+    # to it, so otherwise it waits for the garbage collector
+    data._data.clear()
+
+class ChunkedSession():
+    ''' A log preprocessed as read_file, fix_time_jumps, truncate and
+    remove_offset do, without holding its samples in memory. The log is
+    parsed once into per-member spools on disk (without duplicated packets);
+    the quantities that depend on all the samples (sample periods for the
+    time jumps, meeting start and end, the offset percentile, global mean and
+    std) come from summaries merged along the spools, and the samples of one
+    chunk of chunk_sec seconds are preprocessed on demand.
+
+    window_statistics, label_genuine and real_speak then run the windowed
+    stages one chunk at a time, giving the same window statistics and labels
+    as the functions of vad on the whole session (global_std up to rounding).
+    Windows never span two chunks and every correlation stays inside one
+    window, so chunks need no overlap. Memory is bounded by the chunk size,
+    plus the packet index of the deduplication and the per-window arrays.
+    The spools are removed by close() (or at the end of a with block).
+    '''
+
+    def __init__(self, filename, chunk_sec=600, excluded_members=[],
+                 fix_time_jumps=True, max_jump_sec=1, percentile=1, tmp_dir=None):
+        self.chunk_sec = chunk_sec
+        self.members = {}
+        self._dir = tempfile.mkdtemp(prefix='badge_chunks_', dir=tmp_dir)
+        try:
+            self._spool(filename, excluded_members)
+            for member in self.members.values():
+                self._fix_time_jumps(member, fix_time_jumps, max_jump_sec)
+            self._truncate()
+            for member in self.members.values():
+                self._remove_offset(member, percentile)
+        except BaseException:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        shutil.rmtree(self._dir, ignore_errors=True)
+
+    # Preprocessing
+
+    def _spool(self, filename, excluded_members):
+        # Same packets as read_file, in the same order
+        packets, duplicates = 0, 0
+        with open(filename, 'r') as fid:
+            for packet in preprocessing.iter_packets(fid):
+                member = packet['member_id']
+                if member in excluded_members:
+                    continue
+                if not member in self.members:
+                    self.members[member] = {
+                        'index': preprocessing._PacketIndex(),
+                        'spool': _Spool(os.path.join(self._dir, str(member)))}
+                packets += 1
+                ts, sp = packet['timestamp'], packet['sample_period']/1000
+                samples = packet['samples']
+                ns = len(samples)
+                if not self.members[member]['index'].add(ts, sp, ns):
+                    duplicates += 1
+                    continue
+                self.members[member]['spool'].append(np.linspace(ts, ts+(ns-1)*sp, ns),
+                                                     samples)
+        self.members = {m: self.members[m] for m in sorted(self.members)}
+        for member in self.members.values():
+            member['spool'].close()
+            member['dtype'] = preprocessing._compact_dtype(
+                np.array([member['spool'].low, member['spool'].high]))
+            del member['index']
+        profiling.count('packets', packets)
+        profiling.count('duplicate_packets', duplicates)
+
+    def _fix_time_jumps(self, member, fix_time_jumps, max_jump_sec):
+        # Same jumps and offsets as preprocessing.fix_time_jumps, from the
+        # counts of the sample periods. The shift of every sample is the sum
+        # of the offsets of the jumps after it, accumulated from the last one
+        spool = member['spool']
+        member['jumps'] = np.zeros((0,), dtype=np.int64)
+        member['shifts'] = np.zeros((1,))
+        if not fix_time_jumps:
+            return
+        periods = _Counts()
+        jumps, jump_diffs = [], []
+        previous = None
+        for start, time in spool.blocks():
+            if previous != None:
+                diff = np.diff(np.concatenate(([previous], time)))
+                first = start - 1
+            else:
+                diff = np.diff(time)
+                first = start
+            periods.add(diff)
+            found = np.where(np.abs(diff) > max_jump_sec)[0]
+            jumps.extend(found + first)
+            jump_diffs.extend(diff[found])
+            previous = time[-1]
+        jumps, jump_diffs = np.array(jumps, dtype=np.int64), np.array(jump_diffs)
+        time_jumps = []
+        offsets = np.zeros((len(jumps),))
+        for k in np.argsort(-np.abs(jump_diffs), kind='stable'):
+            median = periods.median()
+            offsets[k] = jump_diffs[k] - median
+            periods.replace(jump_diffs[k], median)
+            time_jumps.append({'index': int(jumps[k]+1),
+                               'time': float(spool.read('time', jumps[k]+1, jumps[k]+2)[0]),
+                               'jump': float(jump_diffs[k]), 'offset': float(offsets[k])})
+        member['time_jumps'] = time_jumps
+        member['jumps'] = jumps
+        member['shifts'] = np.append(np.cumsum(offsets[::-1])[::-1], 0.0)
+
+    def _fixed_time(self, member, start, time):
+        # Times of the samples from position start, with the jumps fixed
+        positions = np.arange(start, start + len(time))
+        return time + member['shifts'][np.searchsorted(member['jumps'], positions)]
+
+    def _truncate(self):
+        # Meeting start and end as in MeetingData, samples kept by truncate,
+        # with their amplitude counts, and the silence padding of members
+        # that start late (which needs the sample period of the first member)
+        for member in self.members.values():
+            spool = member['spool']
+            member['first'] = self._fixed_time(member, 0, spool.read('time', 0, 1))[0]
+            member['last'] = spool.read('time', spool.size-1, spool.size)[0]
+        self.meeting_start = np.max([m['first'] for m in self.members.values()])
+        self.meeting_end = np.min([m['last'] for m in self.members.values()])
+        for member in self.members.values():
+            member['counts'] = _Counts(np.int64)
+            member['block_min'], member['block_max'] = [], []
+            member['first_times'] = []
+            for start, time in member['spool'].blocks():
+                time = self._fixed_time(member, start, time)
+                edges = np.arange(0, len(time), BLOCK)
+                member['block_min'].append(np.minimum.reduceat(time, edges))
+                member['block_max'].append(np.maximum.reduceat(time, edges))
+                kept = self._kept(time)
+                member['counts'].add(member['spool'].read('signal', start, start+len(time))[kept])
+                if len(member['first_times']) < 2:
+                    member['first_times'].extend(time[kept][:2-len(member['first_times'])])
+            member['block_min'] = np.concatenate(member['block_min'])
+            member['block_max'] = np.concatenate(member['block_max'])
+
+        first = self.members[list(self.members)[0]]['first_times']
+        sample_period = np.diff(first[:2])[0]
+        for member in self.members.values():
+            member['pad'], member['pad_step'] = 0, sample_period
+            if member['first_times'][0] - self.meeting_start > 1:
+                # Same times as np.arange(meeting_start, first time, sample_period)
+                member['pad'] = int(np.ceil((member['first_times'][0] - self.meeting_start)
+                                            /sample_period))
+                member['pad_step'] = (self.meeting_start + sample_period) - self.meeting_start
+                member['counts'].add(np.zeros((1,), dtype=np.int64), np.array([member['pad']]))
+                member['first_times'] = list(self._pad_times(member, 0, 2)) + member['first_times']
+
+    def _kept(self, time):
+        return np.logical_and(time >= self.meeting_start, time <= self.meeting_end)
+
+    def _pad_times(self, member, lo, hi):
+        # Times of the padding samples lo to hi
+        hi = min(hi, member['pad'])
+        return self.meeting_start + np.arange(lo, max(hi, lo))*member['pad_step']
+
+    def _remove_offset(self, member, percentile):
+        # Offset of remove_offset and global mean and std of window_statistics
+        counts = member.pop('counts')
+        member['offset'] = int(counts.percentile(percentile))
+        values = np.clip(counts.values, member['offset'], None) - member['offset']
+        total = counts.total
+        member['global_mean'] = int(np.sum(counts.counts*values))/total
+        member['global_std'] = np.sqrt(np.sum(counts.counts*(values - member['global_mean'])**2)
+                                       /total)
+
+    # Chunks
+
+    def _samples(self, member, lo, hi):
+        # Preprocessed samples with lo <= time < hi, in arrival order
+        times, signals = [], []
+        if member['pad'] > 0:
+            first = max(int(np.floor((lo - self.meeting_start)/member['pad_step'])) - 1, 0)
+            last = int(np.ceil((hi - self.meeting_start)/member['pad_step'])) + 1
+            time = self._pad_times(member, first, last)
+            time = time[np.logical_and(time >= lo, time < hi)]
+            times.append(time)
+            signals.append(np.zeros(time.shape, dtype=np.int64))
+        blocks = np.where(np.logical_and(member['block_max'] >= lo,
+                                         member['block_min'] < hi))[0]
+        spool = member['spool']
+        for run in np.split(blocks, np.where(np.diff(blocks) != 1)[0] + 1):
+            if len(run) == 0:
+                continue
+            start, end = run[0]*BLOCK, min((run[-1]+1)*BLOCK, spool.size)
+            time = self._fixed_time(member, start, spool.read('time', start, end))
+            keep = np.logical_and(self._kept(time),
+                                  np.logical_and(time >= lo, time < hi))
+            times.append(time[keep])
+            signals.append(spool.read('signal', start, end)[keep])
+        signal = np.concatenate(signals) if signals else np.zeros((0,), dtype=np.int64)
+        signal = np.clip(signal, member['offset'], None) - member['offset']
+        time = np.concatenate(times) if times else np.zeros((0,))
+        return time, signal.astype(member['dtype'])
+
+    def chunk(self, first_window, last_window, members=None):
+        # MeetingData with the preprocessed samples of the windows from
+        # first_window to last_window (excluded), plus an empty last window.
+        # Its meeting start is the one of the session, so the windowed stages
+        # need first_window to find the same edges (see vad.window_index)
+        # and the window w of the chunk is first_window + w of the session
+        members = list(self.members) if members == None else members
+        data = MeetingData()
+        win_time = self.win_time[first_window:last_window+1]
+        for member in members:
+            time, signal = self._samples(self.members[member], self.edges[first_window],
+                                         self.edges[last_window])
+            data[member] = {'time': time, 'signal': signal, 'win_time': win_time}
+        data.meeting_start = self.meeting_start
+        # Between two edges, so that window_index finds last_window+1 windows
+        data.meeting_end = (self.edges[last_window] + self.edges[last_window+1])/2
+        return data
+
+    def chunks(self):
+        # (first, last) window of every chunk. As in window_stats, the last
+        # (incomplete) window of the session is left out
+        return [(w, min(w + self.chunk_windows, self.num_windows - 1))
+                for w in range(0, self.num_windows - 1, self.chunk_windows)]
+
+    # Windowed stages
+
+    @profiling.profiled
+    def window_statistics(self, window=1.0):
+        # Same result as vad.window_statistics, without the samples. The
+        # statistics of each chunk are computed by vad.window_stats
+        self.window = window
+        self.num_windows = int(np.ceil((self.meeting_end - self.meeting_start)/window))
+        self.chunk_windows = max(int(np.round(self.chunk_sec/window)), 1)
+        self.win_time = np.linspace(self.meeting_start, self.meeting_start
+                                    + (self.num_windows-1)*window, self.num_windows)
+        # Same window edges as vad.window_index
+        self.edges = self.meeting_start + np.arange(self.num_windows+1)*window
+
+        data = MeetingData()
+        for member, values in self.members.items():
+            data[member] = {'win_time': self.win_time, 'global_mean': values['global_mean'],
+                            'global_std': values['global_std'], 'is_beacon': False}
+            if 'time_jumps' in values:
+                data[member]['time_jumps'] = values['time_jumps']
+        data.meeting_start = self.meeting_start
+        data.meeting_end = self.meeting_end
+        shape = (len(self.members), self.num_windows)
+        win_mean, win_std = np.zeros(shape), np.zeros(shape)
+        win_count = np.zeros(shape, dtype=np.int64)
+        for first, last in self.chunks():
+            chunk = vad.window_stats(self.chunk(first, last), window, first)
+            win_mean[:, first:last] = chunk.matrix('win_mean')[:, :last-first]
+            win_std[:, first:last] = chunk.matrix('win_std')[:, :last-first]
+            win_count[:, first:last] = chunk.matrix('win_count')[:, :last-first]
+            _release(chunk)
+        data.set_matrix('win_mean', win_mean)
+        data.set_matrix('win_std', win_std)
+        data.set_matrix('win_count', win_count)
+        return data
+
+    def correlate(self, data, max_temp_shift=0.15):
+        # Function giving the correlations of window pairs of data.members
+        # (see vad._correlate_pairs), chunk by chunk. The number of lags is
+        # the one vad.label_genuine and vad.real_speak find on the session
+        sample_period = np.diff(self.members[data.members[0]]['first_times'][:2])[0]
+        max_lag = int(np.round(max_temp_shift/sample_period))
+        members = data.members
+
+        def correlate(jobs):
+            corr = np.zeros((len(jobs),))
+            chunk_idx = jobs[:, 0]//self.chunk_windows
+            for c in np.unique(chunk_idx):
+                idx = np.where(chunk_idx == c)[0]
+                first, last = self.chunks()[c]
+                chunk = self.chunk(first, last, members)
+                vad.window_index(chunk, self.window, first)
+                corr[idx] = vad._correlate_pairs(chunk, jobs[idx] - [first, 0, 0],
+                                                 max_lag)
+                _release(chunk)
+            return corr
+        return correlate
+
+    @profiling.profiled
+    def label_genuine(self, data, max_temp_shift=0.15, corr_thr=0.85, silence_thr_mean=1.0,
+                      silence_thr_std=0.0, prune_similarity=None):
+        return vad._genuine_labels(data, self.correlate(data, max_temp_shift), corr_thr,
+                                   silence_thr_mean, silence_thr_std, prune_similarity)
+
+    @profiling.profiled
+    def real_speak(self, data, corr_thr=0.85, max_temp_shift=0.15, prune_similarity=None):
+        return vad._real_labels(data, self.correlate(data, max_temp_shift), corr_thr,
+                                prune_similarity)
+
+def run_session(filename, chunk_sec=600, tmp_dir=None, **params):
+    # Same flow and results as batch.run_session, holding the samples of one
+    # chunk at a time in memory. The spools go to tmp_dir (default: the
+    # system temporary directory)
+    p = _params(params)
+    unsupported = [key for key in IN_MEMORY_PARAMS if p[key] != DEFAULT_PARAMS[key]]
+    if unsupported:
+        raise ValueError('Not supported in chunked mode: ' + ', '.join(unsupported))
+    with kernels.using(p['backend']):
+        with ChunkedSession(filename, chunk_sec, p['excluded_members'],
+                            p['fix_time_jumps'], p['max_jump_sec'], p['percentile'],
+                            tmp_dir) as session:
+            data = session.window_statistics(p['window'])
+            session.label_genuine(data, p['max_temp_shift'], p['corr_thr'],
+                                  p['silence_thr_mean'], p['silence_thr_std'],
+                                  p['prune_similarity'])
+            vad.calculate_thresholds(data, p['bandwidth'], p['kde_method'])
+            vad.all_speak(data, p['threshold_by_mean'], p['threshold_by_std'])
+            session.real_speak(data, p['corr_thr'], p['max_temp_shift'],
+                               p['prune_similarity'])
+        _metrics(data, p['fill_gaps'], p['max_gap'], p['min_succesive_non_overlap'])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            indicators = metrics.calculate_indicators(data, print_results=False)
+    return data, dict(zip(INDICATORS, indicators))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Analyse a long log in chunks, '
+                                     'with memory bounded by the chunk size.')
+    parser.add_argument('filename')
+    parser.add_argument('--chunk-sec', type=float, default=600)
+    parser.add_argument('--tmp-dir', default=None, help='directory of the '
+                        'spooled samples (default: system temporary directory)')
+    args = parser.parse_args(argv)
+    data, indicators = run_session(args.filename, args.chunk_sec, args.tmp_dir)
+    for key in INDICATORS:
+        print('%-18s %s' % (key, np.round(indicators[key], 3)))
+
+if __name__ == '__main__':
+    main()
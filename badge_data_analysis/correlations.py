@@ -0,0 +1,152 @@
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+from . import vad, profiling
+
+CACHE_VERSION = 1
+# Size cap of a cache directory, in bytes
+MAX_BYTES = 2**30
+
+def file_hash(filename):
+    # Hash of the contents of a log, so renamed or copied logs share entries
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as fid:
+        for block in iter(lambda: fid.read(2**20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+def session_key(filename, **params):
+    # Key of the correlations of a log preprocessed and windowed with params
+    text = json.dumps([file_hash(filename), params], sort_keys=True, default=repr)
+    return hashlib.sha1(text.encode()).hexdigest()
+
+def _entry_size(path):
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+def _evict(cache_dir, size, max_bytes, keep=()):
+    # Remove the least recently used entries until size more bytes fit. The
+    # header of an entry is touched every time it is opened
+    entries = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        header = os.path.join(path, 'header.json')
+        if os.path.isfile(header) and not path in keep:
+            entries.append((os.path.getmtime(header), _entry_size(path), path))
+    total = sum(entry[1] for entry in entries)
+    for _, entry_size, path in sorted(entries):
+        if total + size <= max_bytes:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= entry_size
+
+def _read_header(path):
+    try:
+        with open(os.path.join(path, 'header.json'), 'r') as fid:
+            return json.load(fid)
+    except (OSError, ValueError):
+        return None
+
+def _open_entry(path, members, shape, max_bytes, keep=()):
+    # Memory-map the correlations and the mask of computed ones of an entry,
+    # creating it when it does not exist. New entries are written aside and
+    # renamed, so concurrent processes end up sharing the first one
+    header = _read_header(path)
+    if header == None or header['version'] != CACHE_VERSION or \
+       header['members'] != members or header['shape'] != list(shape):
+        shutil.rmtree(path, ignore_errors=True)
+        cache_dir = os.path.dirname(path)
+        os.makedirs(cache_dir, exist_ok=True)
+        _evict(cache_dir, 9*np.prod(shape), max_bytes, keep)
+        tmp_path = path + '.tmp' + str(os.getpid())
+        os.makedirs(tmp_path)
+        np.lib.format.open_memmap(os.path.join(tmp_path, 'corr.npy'), 'w+',
+                                  np.float64, shape)
+        np.lib.format.open_memmap(os.path.join(tmp_path, 'known.npy'), 'w+',
+                                  np.bool_, shape)
+        with open(os.path.join(tmp_path, 'header.json'), 'w') as fid:
+            json.dump({'version': CACHE_VERSION, 'members': members,
+                       'shape': list(shape)}, fid)
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+    os.utime(os.path.join(path, 'header.json'))
+    return (np.load(os.path.join(path, 'corr.npy'), mmap_mode='r+'),
+            np.load(os.path.join(path, 'known.npy'), mmap_mode='r+'))
+
+class CorrelationTable():
+    ''' Maximum normalized correlation of every ordered pair of members (the
+    normalization is not symmetric) in every window, as members x members x
+    windows arrays, one per maximum lag. Entries are computed the first time
+    they are looked up, for all the lags of the table at once since smaller
+    lags only take the maximum over fewer of the same values.
+
+    Without cache_dir the arrays are kept in memory. Otherwise they are memory
+    mapped from cache_dir/<key>-<lag>, where key identifies the log and the
+    preprocessing and window parameters (see session_key), so that later runs
+    with any corr_thr skip the correlations. The directory is kept under
+    max_bytes by removing the least recently used entries.
+    '''
+
+    def __init__(self, cache_dir=None, key=None, max_lags=(), max_bytes=MAX_BYTES):
+        if cache_dir != None and key == None:
+            raise ValueError('A key is needed to cache the correlations')
+        self.cache_dir = cache_dir
+        self.key = key
+        self.max_lags = sorted(set(max_lags))
+        self.max_bytes = max_bytes
+        self.members = None
+        self.entries = {}
+
+    def _path(self, max_lag):
+        return os.path.join(self.cache_dir, self.key + '-' + str(max_lag))
+
+    def _open(self, data, max_lag):
+        # Arrays sized for the members and windows of data on first use. The
+        # members flagged as beacons by calculate_thresholds keep their rows
+        if self.members == None:
+            beacons = [m for m in data.keys() if data[m].get('is_beacon', False)]
+            self.members = sorted(set(data.members) | set(beacons))
+        shape = (len(self.members), len(self.members),
+                 len(data[data.members[0]]['win_time']) - 1)
+        if self.cache_dir == None:
+            self.entries[max_lag] = (np.zeros(shape), np.zeros(shape, dtype=bool))
+        else:
+            keep = [self._path(lag) for lag in self.entries]
+            self.entries[max_lag] = _open_entry(self._path(max_lag), self.members,
+                                                shape, self.max_bytes, keep)
+        if not max_lag in self.max_lags:
+            self.max_lags = sorted(self.max_lags + [max_lag])
+
+    def lookup(self, data, jobs, max_lag, executor=None):
+        # Correlations of (window, member row, member row) jobs, rows of
+        # data.members, within max_lag. Members that became beacons after the
+        # table was opened are no longer in data.members. The missing ones are
+        # computed in the workers of executor, if any
+        for lag in sorted(set(self.max_lags + [max_lag]) - set(self.entries)):
+            self._open(data, lag)
+        rows = np.array([self.members.index(member) for member in data.members],
+                        dtype=np.int64)
+        w, a, b = jobs[:, 0], rows[jobs[:, 1]], rows[jobs[:, 2]]
+        missing = np.zeros((len(jobs),), dtype=bool)
+        for corr, known in self.entries.values():
+            missing |= ~known[a, b, w]
+        profiling.count('cached_pairs', len(jobs) - np.count_nonzero(missing))
+        if np.any(missing):
+            values = vad._correlate_pairs(data, jobs[missing], self.max_lags,
+                                          executor)
+            for i, lag in enumerate(self.max_lags):
+                corr, known = self.entries[lag]
+                corr[a[missing], b[missing], w[missing]] = values[:, i]
+                known[a[missing], b[missing], w[missing]] = True
+        return self.entries[max_lag][0][a, b, w]
+
+    def __getstate__(self):
+        # Worker processes map the cached entries again instead of receiving
+        # copies of them
+        state = self.__dict__.copy()
+        if self.cache_dir != None:
+            state['entries'] = {}
+        return state
@@ -0,0 +1,273 @@
+import json
+import time
+import asyncio
+import argparse
+import numpy as np
+from .preprocessing import _MemberBuffer, _meeting_data
+
+DEFAULT_SESSION = 'default'
+# Longest line accepted from a hub, in bytes
+MAX_LINE = 2**20
+
+class SessionBuffer():
+    ''' Samples received for one session, in the same per-member buffers that
+    read_file fills while parsing a log, so duplicated packets are dropped by
+    the same rule. meeting_data() gives a MeetingData of everything received
+    so far, as read_file would give for a log with the same packets.
+    '''
+
+    def __init__(self, excluded_members=[]):
+        self.excluded_members = excluded_members
+        self.buffers = {}
+        self.packets = 0
+        self.duplicates = 0
+
+    def add(self, packet):
+        # Store the samples of an 'audio received' packet (its data field).
+        # Returns False when it is a duplicate or comes from an excluded member
+        member = packet['member_id']
+        if member in self.excluded_members:
+            return False
+        if not member in self.buffers:
+            self.buffers[member] = _MemberBuffer()
+        self.packets += 1
+        if not self.buffers[member].append(packet['timestamp'],
+                                           packet['sample_period']/1000,
+                                           packet['samples']):
+            self.duplicates += 1
+            return False
+        return True
+
+    def meeting_data(self):
+        return _meeting_data(self.buffers)
+
+class _Connection():
+    # Writer of a connection and the number of its lines still in the queue,
+    # so it can be closed once they are acknowledged
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.pending = 0
+        self.idle = asyncio.Event()
+        self.idle.set()
+
+class IngestServer():
+    ''' Asyncio server receiving the packets of many hubs at once, as the
+    newline-delimited JSON of the logs, over TCP and/or a Unix socket.
+
+    Every line is acknowledged in order with 'ok', 'dup' (duplicate packet or
+    excluded member), 'skip' (not an audio packet) or 'err' (invalid line).
+    A line may name its session in a 'session' field; otherwise it goes to
+    DEFAULT_SESSION. Connections read lines into a queue of at most
+    max_queue lines that a single task stores in the session buffers: when
+    the queue is full the connections stop reading, and TCP flow control
+    slows the hubs down.
+    '''
+
+    def __init__(self, max_queue=1024, excluded_members=[]):
+        self.max_queue = max_queue
+        self.excluded_members = excluded_members
+        self.sessions = {}
+        self.stats = {'connections': 0, 'lines': 0, 'packets': 0,
+                      'duplicates': 0, 'skipped': 0, 'errors': 0}
+        self._servers = []
+        self._queue = None
+        self._consumer = None
+
+    async def start(self, host='127.0.0.1', port=0, path=None):
+        # Listen on host:port (port None: no TCP) and on the Unix socket path.
+        # Returns the TCP port, useful with port=0
+        self._queue = asyncio.Queue(self.max_queue)
+        self._consumer = asyncio.ensure_future(self._consume())
+        if path != None:
+            self._servers.append(await asyncio.start_unix_server(
+                self._handle, path, limit=MAX_LINE))
+        if port != None:
+            server = await asyncio.start_server(self._handle, host, port,
+                                                limit=MAX_LINE)
+            self._servers.append(server)
+            port = server.sockets[0].getsockname()[1]
+        return port
+
+    async def close(self):
+        for server in self._servers:
+            server.close()
+            await server.wait_closed()
+        # Store the lines already received
+        if self._queue != None:
+            await self._queue.join()
+        if self._consumer != None:
+            self._consumer.cancel()
+        self._servers = []
+
+    async def _handle(self, reader, writer):
+        self.stats['connections'] += 1
+        connection = _Connection(writer)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                connection.pending += 1
+                connection.idle.clear()
+                await self._queue.put((line, connection))
+        except (ConnectionError, asyncio.LimitOverrunError, ValueError):
+            pass
+        finally:
+            # Only the lines of this connection are waited for, the queue
+            # may never empty while other hubs keep sending
+            await connection.idle.wait()
+            writer.close()
+
+    async def _consume(self):
+        while True:
+            line, connection = await self._queue.get()
+            try:
+                reply = self.add_line(line)
+                if not connection.writer.is_closing():
+                    connection.writer.write(reply + b'\n')
+            finally:
+                connection.pending -= 1
+                if connection.pending == 0:
+                    connection.idle.set()
+                self._queue.task_done()
+
+    def add_line(self, line):
+        # Store one line of a log and return its acknowledgement
+        self.stats['lines'] += 1
+        if not line.strip():
+            return b'skip'
+        try:
+            message = json.loads(line)
+            if message.get('type', 'audio received') != 'audio received':
+                self.stats['skipped'] += 1
+                return b'skip'
+            session = message.get('session', DEFAULT_SESSION)
+            if not session in self.sessions:
+                self.sessions[session] = SessionBuffer(self.excluded_members)
+            stored = self.sessions[session].add(message['data'])
+        except (ValueError, KeyError, TypeError, AttributeError):
+            self.stats['errors'] += 1
+            return b'err'
+        self.stats['packets'] += 1
+        if not stored:
+            self.stats['duplicates'] += 1
+            return b'dup'
+        return b'ok'
+
+    def meeting_data(self, session=DEFAULT_SESSION):
+        # MeetingData of the packets received so far in a session
+        return self.sessions[session].meeting_data()
+
+async def replay_log(filename, host='127.0.0.1', port=None, path=None, session=None,
+                     speed=None):
+    # Load generator: send a log to an IngestServer like a hub would, paced
+    # by log_timestamp speed times faster than real time, or as fast as the
+    # server takes it when speed is None. With session, every line is sent
+    # to that session. Returns the latency from sending each line to its
+    # acknowledgement, and the acknowledgements
+    if path != None:
+        reader, writer = await asyncio.open_unix_connection(path, limit=MAX_LINE)
+    else:
+        reader, writer = await asyncio.open_connection(host, port, limit=MAX_LINE)
+    prefix = ('{"session": ' + json.dumps(session) + ', ').encode() if session != None else None
+    sent = []
+
+    async def send():
+        t_start, log_start = time.perf_counter(), None
+        with open(filename, 'rb') as fid:
+            for line in fid:
+                if not line.strip():
+                    continue
+                if speed != None:
+                    log_time = json.loads(line).get('log_timestamp')
+                    if log_time != None:
+                        log_start = log_time if log_start == None else log_start
+                        wait = (log_time - log_start)/speed - (time.perf_counter() - t_start)
+                        if wait > 0:
+                            await asyncio.sleep(wait)
+                if prefix != None:
+                    line = prefix + line.lstrip()[1:]
+                sent.append(time.perf_counter())
+                writer.write(line if line.endswith(b'\n') else line + b'\n')
+                await writer.drain()
+        if writer.can_write_eof():
+            writer.write_eof()
+
+    async def receive():
+        replies = []
+        latencies = []
+        while True:
+            reply = await reader.readline()
+            if not reply:
+                break
+            latencies.append(time.perf_counter() - sent[len(replies)])
+            replies.append(reply.strip().decode())
+        return latencies, replies
+
+    _, (latencies, replies) = await asyncio.gather(send(), receive())
+    writer.close()
+    return np.array(latencies), replies
+
+async def load_test(files, hubs=4, host='127.0.0.1', port=None, path=None,
+                    speed=None):
+    # Replay the logs from hubs concurrent clients, each log in its own
+    # session. Returns the throughput and the latency percentiles
+    t0 = time.perf_counter()
+    results = await asyncio.gather(*[
+        replay_log(files[i % len(files)], host, port, path, 'hub-' + str(i), speed)
+        for i in range(hubs)])
+    elapsed = time.perf_counter() - t0
+    latencies = np.concatenate([latencies for latencies, _ in results])
+    replies = [reply for _, hub_replies in results for reply in hub_replies]
+    summary = {'hubs': hubs, 'lines': len(replies), 'elapsed': elapsed,
+               'lines_per_sec': len(replies)/elapsed,
+               'duplicates': replies.count('dup'), 'errors': replies.count('err')}
+    for q in (50, 90, 99, 100):
+        summary['latency_p' + str(q)] = float(np.percentile(latencies, q)) if len(latencies) else np.nan
+    return summary
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Receive badge audio packets '
+                                     'from hubs, or replay logs to a server to '
+                                     'measure its throughput and latency.')
+    parser.add_argument('command', choices=['serve', 'load'])
+    parser.add_argument('logs', nargs='*', help='logs to replay (load)')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--unix', default=None, help='Unix socket path, '
+                        'instead of TCP')
+    parser.add_argument('--hubs', type=int, default=4, help='concurrent clients (load)')
+    parser.add_argument('--speed', type=float, default=None, help='replay speed '
+                        'relative to real time (load, default: as fast as possible)')
+    parser.add_argument('--max-queue', type=int, default=1024,
+                        help='lines waiting to be stored before reading stops (serve)')
+    args = parser.parse_args(argv)
+    port = None if args.unix != None else args.port
+
+    if args.command == 'load':
+        summary = asyncio.run(load_test(args.logs, args.hubs, args.host, port,
+                                        args.unix, args.speed))
+        for key, value in summary.items():
+            print('%-16s %s' % (key, value))
+        return
+
+    async def serve():
+        server = IngestServer(args.max_queue)
+        await server.start(args.host, port, args.unix)
+        print('Listening on', args.unix if args.unix != None else
+              args.host + ':' + str(port))
+        try:
+            while True:
+                await asyncio.sleep(10)
+                print({name: (session.packets, session.duplicates)
+                       for name, session in server.sessions.items()}, server.stats)
+        finally:
+            await server.close()
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+import numpy as np
+from contextlib import contextmanager
+try:
+    import numba
+except ImportError:
+    numba = None
+
+BACKENDS = ('numpy', 'numba')
+# Backend of the window loops: the numba kernels below when numba is
+# installed, the vectorized NumPy code of vad and metrics otherwise
+backend = 'numba' if numba != None else 'numpy'
+
+def set_backend(name):
+    global backend
+    if not name in BACKENDS:
+        raise ValueError('Unknown backend: ' + str(name))
+    if name == 'numba' and numba == None:
+        raise ImportError('The numba backend needs numba to be installed')
+    backend = name
+
+@contextmanager
+def using(name):
+    # Run a block with another backend, None keeps the current one
+    previous = backend
+    if name != None:
+        set_backend(name)
+    try:
+        yield
+    finally:
+        set_backend(previous)
+
+def use_numba():
+    return backend == 'numba'
+
+if numba != None:
+    _njit = numba.njit
+    _prange = numba.prange
+else:
+    _njit = lambda **kwargs: (lambda func: func)
+    _prange = range
+
+@_njit(parallel=True, cache=True)
+def _max_corr(signal, x_start, x_end, y_start, y_end, max_lags, eps):
+    # Same operations as vad.batch_xcorr followed by vad._lag_maxima, one
+    # window pair at a time, so integer signals give the same bits
+    max_lag = np.max(max_lags)
+    out_len = 2*max_lag + 1
+    result = np.empty((len(x_start), len(max_lags)))
+    for i in _prange(len(x_start)):
+        if x_end[i] - x_start[i] > y_end[i] - y_start[i]:
+            s_start, len_s = y_start[i], y_end[i] - y_start[i]
+            l_start, len_l = x_start[i], x_end[i] - x_start[i]
+        else:
+            s_start, len_s = x_start[i], x_end[i] - x_start[i]
+            l_start, len_l = y_start[i], y_end[i] - y_start[i]
+        # Cumulative energy of the longer signal padded with max_lag zeros
+        energy = np.zeros((out_len + len_s,), dtype=signal.dtype)
+        for k in range(1, out_len + len_s):
+            j = k - 1 - max_lag
+            value = signal[l_start + j] if 0 <= j < len_l else energy[0]
+            energy[k] = energy[k-1] + value*value
+        s_energy = energy[0]
+        for n in range(len_s):
+            s_energy += signal[s_start + n]*signal[s_start + n]
+        corr = np.empty((out_len,))
+        for k in range(out_len):
+            total = energy[0]
+            for n in range(max(max_lag - k, 0), min(len_s, len_l + max_lag - k)):
+                total += signal[s_start + n]*signal[l_start + k + n - max_lag]
+            l_energy = energy[k + len_s] - energy[k]
+            corr[k] = np.float64(total)/np.sqrt(np.float64(l_energy*s_energy) + eps)
+        for m in range(len(max_lags)):
+            result[i, m] = np.max(corr[max_lag - max_lags[m]:max_lag + max_lags[m] + 1])
+    return result
+
+def max_corr(signal, x_start, x_end, y_start, y_end, max_lags, eps=1e-10):
+    # Maximum normalized correlation of the pairs of segments
+    # signal[x_start:x_end] and signal[y_start:y_end], within each of
+    # max_lags (one column each). Integer signals are correlated exactly in
+    # int64, as in vad.batch_xcorr
+    signal = np.asarray(signal)
+    signal = signal.astype(np.int64 if signal.dtype.kind in 'iub' else np.float64)
+    bounds = [np.asarray(b, dtype=np.int64) for b in (x_start, x_end, y_start, y_end)]
+    return _max_corr(signal, *bounds, np.asarray(max_lags, dtype=np.int64), eps)
+
+@_njit(cache=True)
+def turn_counts(speakers, num_members, required):
+    # Turns taken by every member along the sequence of single speakers, as
+    # in metrics.turn_taking: a member other than the active speaker takes
+    # the turn when it speaks alone in required windows since the last turn
+    turns = np.zeros((num_members,), dtype=np.int64)
+    counts = np.zeros((num_members,), dtype=np.int64)
+    active = -1
+    for speaker in speakers:
+        counts[speaker] += 1
+        if speaker != active and counts[speaker] >= required:
+            turns[speaker] += 1
+            active = speaker
+            counts[:] = 0
+    return turns
+
+@_njit(parallel=True, cache=True)
+def overlapped_runs(labels, overlap):
+    # Runs of True in every row of labels with at least one overlap window
+    counts = np.zeros((labels.shape[0],), dtype=np.int64)
+    for row in _prange(labels.shape[0]):
+        in_run, overlapped = False, False
+        for w in range(labels.shape[1]):
+            if labels[row, w]:
+                in_run = True
+                overlapped = overlapped or overlap[row, w]
+            elif in_run:
+                counts[row] += 1 if overlapped else 0
+                in_run, overlapped = False, False
+        if in_run and overlapped:
+            counts[row] += 1
+    return counts
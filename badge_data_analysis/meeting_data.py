@@ -1,45 +1,346 @@
 import numpy as np
+from copy import deepcopy
+from collections.abc import MutableMapping
 
 INIT_VALUE = -1.0
 
+# Keys stored in the members x samples and members x windows matrices
+SAMPLE_KEYS = ('time', 'signal', 'valid')
+WINDOW_KEYS = ('win_time', 'win_mean', 'win_std', 'win_count', 'gen_speak',
+               'all_speak', 'real_speak')
+FILLED_PREFIX = 'real_speak_filled_'
+
+def _is_window_key(key):
+    return key in WINDOW_KEYS or (isinstance(key, str)
+                                  and key.startswith(FILLED_PREFIX))
+
+class MemberData(MutableMapping):
+    ''' Dictionary-like view of the data of one participant. Samples and
+    per-window arrays are rows of the matrices of the MeetingData they belong
+    to, so reading them returns views and writing them fills the matrices.
+    Any other key (thresholds, metrics, flags) is kept in a plain dictionary.
+    '''
+    
+    __slots__ = ('_meeting', '_member', '_fields')
+    
+    def __init__(self, meeting, member):
+        self._meeting = meeting
+        self._member = member
+        self._fields = {}
+    
+    def __getitem__(self, key):
+        if key in SAMPLE_KEYS:
+            return self._meeting._get_samples(self._member, key)
+        if _is_window_key(key):
+            return self._meeting._get_window_row(self._member, key)
+        return self._fields[key]
+    
+    def __setitem__(self, key, value):
+        if key in SAMPLE_KEYS:
+            self._meeting._set_samples(self._member, key, value)
+        elif _is_window_key(key):
+            self._meeting._set_window_row(self._member, key, value)
+        else:
+            self._fields[key] = value
+    
+    def __delitem__(self, key):
+        if key in SAMPLE_KEYS or _is_window_key(key):
+            self._meeting._delete(self._member, key)
+        else:
+            del self._fields[key]
+    
+    def __iter__(self):
+        yield from self._meeting._stored_keys(self._member)
+        yield from self._fields
+    
+    def __len__(self):
+        return len(self._meeting._stored_keys(self._member)) + len(self._fields)
+    
+    def __repr__(self):
+        return 'MemberData(' + repr(dict(self)) + ')'
+
 class MeetingData():
     ''' This class defines a data structure to store the audio meeting data. It
     is basically a dictionary where the keys are the participants numbers and
-    the values are the data of each participant. It also have some 
+    the values are the data of each participant. It also have some
     functionality to simplify code needed to process the data.
     
-    Each function of the vad, processing (finish this)
-    
-    
+    Samples are stored in members x samples matrices (each row holds a
+    contiguous segment of samples, see sample_mask) and per-window arrays in
+    members x windows matrices. data[member][key] returns views of those
+    rows, while matrix() and samples() give the whole matrices for vectorized
+    operations across members. Assigning a slice of a member's own samples
+    only moves the bounds of its segment, without copying.
     '''
     
+    __slots__ = ('_data', '_rows', '_samples', '_lengths', '_starts',
+                 '_matrices', '_present', '__sp', '__wl', '__ms', '__me', '__nw',
+                 '__gp', 'profile')
+    
     def __init__(self):
         self._data = {}
+        self._rows = {}
+        self._samples = {}
+        self._lengths = {}
+        self._starts = {}
+        self._matrices = {}
+        self._present = {}
         self.__sp = INIT_VALUE
         self.__wl = INIT_VALUE
         self.__ms = INIT_VALUE
         self.__me = INIT_VALUE
         self.__nw = INIT_VALUE
-        
+        self.__gp = None
+        # Profiler of the stages run on this meeting (see profiling)
+        self.profile = None
+    
     def __getitem__(self, key):
         return self._data[key]
     
     def __setitem__(self, key, item):
-        self._data[key] = item
-        
+        if not key in self._rows:
+            self._rows[key] = len(self._rows)
+            self._data[key] = MemberData(self, key)
+        for k, v in dict(item).items():
+            self._data[key][k] = v
+    
     def __len__(self):
         return len(self._data)
     
     def keys(self):
         return self._data.keys()
     
+    # Matrix storage
+    
+    def _num_rows(self):
+        return max(self._rows.values()) + 1 if self._rows else 0
+    
+    def _row_index(self, members):
+        # Slice when the rows are contiguous, so indexing returns a view
+        rows = [self._rows[member] for member in members]
+        if len(rows) > 0 and rows == list(range(rows[0], rows[0] + len(rows))):
+            return slice(rows[0], rows[0] + len(rows))
+        return rows
+    
+    def _fit_rows(self, matrix):
+        num_rows = self._num_rows()
+        if matrix.shape[0] < num_rows:
+            pad = ((0, num_rows - matrix.shape[0]),) + ((0, 0),)*(matrix.ndim-1)
+            matrix = np.pad(matrix, pad)
+        return matrix
+    
+    def _length(self, member, key):
+        # Number of samples stored for a member, -1 if there are none
+        row = self._rows[member]
+        if not key in self._lengths or row >= len(self._lengths[key]):
+            return -1
+        return self._lengths[key][row]
+    
+    def _get_samples(self, member, key):
+        length = self._length(member, key)
+        if length < 0:
+            raise KeyError(key)
+        start = self._starts[key][self._rows[member]]
+        return self._samples[key][self._rows[member], start:start+length]
+    
+    def _segment_of(self, member, key, value):
+        # Start of value inside the row of the member when value is a
+        # contiguous slice of it, None otherwise
+        if not key in self._samples or self._rows[member] >= len(self._samples[key]):
+            return None
+        row = self._samples[key][self._rows[member]]
+        if (value.ndim != 1 or value.dtype != row.dtype
+            or not np.may_share_memory(value, row)
+            or (len(value) > 1 and value.strides[0] != row.strides[0])):
+            return None
+        start, rest = divmod(value.ctypes.data - row.ctypes.data, row.itemsize)
+        if rest != 0 or start < 0 or start + len(value) > len(row):
+            return None
+        return start
+    
+    def _row_arrays(self, key):
+        # Sample matrix with a row per member, with the lengths and starts
+        matrix = self._fit_rows(self._samples[key])
+        lengths, starts = self._lengths[key], self._starts[key]
+        if len(lengths) < matrix.shape[0]:
+            lengths = np.pad(lengths, (0, matrix.shape[0]-len(lengths)),
+                             constant_values=-1)
+            starts = np.pad(starts, (0, matrix.shape[0]-len(starts)))
+        return matrix, lengths, starts
+    
+    def _set_samples(self, member, key, value):
+        value = np.asarray(value)
+        row = self._rows[member]
+        start = self._segment_of(member, key, value)
+        if start != None:
+            self._starts[key][row] = start
+            self._lengths[key][row] = len(value)
+            return
+        if not key in self._samples:
+            self._samples[key] = np.zeros((self._num_rows(), len(value)),
+                                          dtype=value.dtype)
+            self._lengths[key] = -np.ones((self._num_rows(),), dtype=np.int64)
+            self._starts[key] = np.zeros((self._num_rows(),), dtype=np.int64)
+        matrix, lengths, starts = self._row_arrays(key)
+        if not np.can_cast(value.dtype, matrix.dtype, 'safe'):
+            matrix = matrix.astype(np.result_type(matrix.dtype, value.dtype))
+        if matrix.shape[1] < len(value):
+            width = max(len(value), 2*matrix.shape[1])
+            matrix = np.pad(matrix, ((0, 0), (0, width-matrix.shape[1])))
+        matrix[row, :len(value)] = value
+        lengths[row] = len(value)
+        starts[row] = 0
+        self._samples[key] = matrix
+        self._lengths[key] = lengths
+        self._starts[key] = starts
+    
+    def prepend_samples(self, member, key, values):
+        # Insert samples before the current ones of a member. They are written
+        # in the free space that precedes its segment when there is enough
+        # (e.g. after truncating), otherwise the segment is moved
+        values = np.asarray(values)
+        length = self._length(member, key)
+        if length < 0:
+            raise KeyError(key)
+        matrix, lengths, starts = self._row_arrays(key)
+        row, count = self._rows[member], len(values)
+        if not np.can_cast(values.dtype, matrix.dtype, 'same_kind'):
+            matrix = matrix.astype(np.result_type(matrix.dtype, values.dtype))
+        if starts[row] < count:
+            if matrix.shape[1] < count + length:
+                width = max(count + length, 2*matrix.shape[1])
+                matrix = np.pad(matrix, ((0, 0), (0, width-matrix.shape[1])))
+            start = starts[row]
+            matrix[row, count:count+length] = matrix[row, start:start+length]
+            starts[row] = count
+        matrix[row, starts[row]-count:starts[row]] = values
+        starts[row] -= count
+        lengths[row] += count
+        self._samples[key] = matrix
+        self._lengths[key] = lengths
+        self._starts[key] = starts
+    
+    def _get_window_row(self, member, key):
+        if not key in self._matrices or not member in self._present[key]:
+            raise KeyError(key)
+        return self._matrices[key][self._rows[member]]
+    
+    def _set_window_row(self, member, key, value):
+        value = np.asarray(value)
+        matrix = self._matrices.get(key)
+        if matrix is None or matrix.shape[1:] != value.shape:
+            matrix = np.zeros((self._num_rows(),) + value.shape,
+                              dtype=value.dtype)
+            self._present[key] = set()
+        matrix = self._fit_rows(matrix)
+        if not np.can_cast(value.dtype, matrix.dtype, 'safe'):
+            matrix = matrix.astype(np.result_type(matrix.dtype, value.dtype))
+        matrix[self._rows[member]] = value
+        self._matrices[key] = matrix
+        self._present[key].add(member)
+    
+    def _delete(self, member, key):
+        if key in SAMPLE_KEYS:
+            if self._length(member, key) < 0:
+                raise KeyError(key)
+            self._lengths[key][self._rows[member]] = -1
+        else:
+            if not key in self._present or not member in self._present[key]:
+                raise KeyError(key)
+            self._present[key].discard(member)
+    
+    def _stored_keys(self, member):
+        keys = [key for key in self._samples if self._length(member, key) >= 0]
+        keys.extend([key for key in self._matrices if member in self._present[key]])
+        return keys
+    
+    def _export_samples(self):
+        return (dict(self._rows), dict(self._samples), dict(self._lengths),
+                dict(self._starts))
+    
+    @classmethod
+    def _from_samples(cls, rows, samples, lengths, starts=None):
+        # Build a MeetingData around existing sample matrices (e.g. memory
+        # mapped ones). rows maps each member to its row in the matrices
+        data = cls()
+        data._rows = dict(rows)
+        data._samples = dict(samples)
+        data._lengths = {key: np.array(lengths[key]) for key in lengths}
+        data._starts = {key: np.array(starts[key]) if starts != None and key in starts
+                        else np.zeros((len(lengths[key]),), dtype=np.int64)
+                        for key in lengths}
+        data._data = {member: MemberData(data, member) for member in rows}
+        return data
+    
+    def copy(self, samples=True):
+        # Copy of the meeting that can be modified without changing this one.
+        # With samples=False both share the sample matrices, for stages that
+        # only add per-window data
+        new = type(self)()
+        new._rows = dict(self._rows)
+        new._samples = {key: np.array(matrix) if samples else matrix
+                        for key, matrix in self._samples.items()}
+        new._lengths = {key: np.array(v) for key, v in self._lengths.items()}
+        new._starts = {key: np.array(v) for key, v in self._starts.items()}
+        new._matrices = {key: np.array(m) for key, m in self._matrices.items()}
+        new._present = {key: set(members) for key, members in self._present.items()}
+        for member in self._data:
+            new._data[member] = MemberData(new, member)
+            new._data[member]._fields = deepcopy(self._data[member]._fields)
+        new.__sp, new.__wl, new.__gp = self.__sp, self.__wl, self.__gp
+        new.__ms, new.__me, new.__nw = self.__ms, self.__me, self.__nw
+        new.profile = self.profile
+        return new
+    
+    def set_matrix(self, key, matrix, members=None):
+        # Store a members x windows matrix. Each member gets a view of its row
+        # under the same key, so both forms of access share the same memory
+        members = self.members if members == None else list(members)
+        if self._row_index(members) == slice(0, self._num_rows()):
+            self._matrices[key] = matrix
+        else:
+            full = np.zeros((self._num_rows(),) + matrix.shape[1:],
+                            dtype=matrix.dtype)
+            full[self._row_index(members)] = matrix
+            self._matrices[key] = full
+        self._present[key] = set(members)
+    
+    def matrix(self, key, members=None):
+        # Members x windows matrix of a per-window key
+        members = self.members if members == None else members
+        return self._matrices[key][self._row_index(members)]
+    
+    def samples(self, key='signal', members=None):
+        # Members x samples matrix. Each row holds the samples of a member in a
+        # contiguous segment; use sample_mask to know which entries are real
+        members = self.members if members == None else members
+        return self._samples[key][self._row_index(members)]
+    
+    def sample_mask(self, members=None):
+        # True where the sample matrix holds a real sample of the member. This
+        # excludes the unused entries around the segment of each row and the
+        # samples that truncate marks as missing
+        members = self.members if members == None else members
+        rows = self._row_index(members)
+        width = self._samples['signal'].shape[1]
+        starts = self._starts['signal'][rows][:, np.newaxis]
+        lengths = self._lengths['signal'][rows][:, np.newaxis]
+        positions = np.arange(width)
+        mask = np.logical_and(positions >= starts, positions < starts + lengths)
+        for i, member in enumerate(members):
+            if 'valid' in self._samples and self._length(member, 'valid') >= 0:
+                start = self._starts['signal'][self._rows[member]]
+                valid = self._get_samples(member, 'valid')
+                mask[i, start:start+len(valid)] &= valid
+        return mask
+    
     @property
     def members(self):
         if self._data != {}:
             if not 'is_beacon' in self._data[list(self._data.keys())[0]].keys():
                 return sorted(list(self._data.keys()))
             else:
-                return sorted([m for m in self._data.keys() if (type(m) == int 
+                return sorted([m for m in self._data.keys() if (type(m) == int
                                          and not self._data[m]['is_beacon'])])
         else:
             return []
@@ -54,6 +355,20 @@ class MeetingData():
             self.__sp = np.diff(self._data[self.members[0]]['time'][:2])[0]
         return self.__sp
     
+    @sample_period.setter
+    def sample_period(self, sample_period):
+        self.__sp = sample_period
+    
+    @property
+    def grid_period(self):
+        # Sample period of the common time grid set by preprocessing.align, 
+        # None when the members keep their own sample times
+        return self.__gp
+    
+    @grid_period.setter
+    def grid_period(self, grid_period):
+        self.__gp = grid_period
+    
     @property
     def window_length(self):
         if self.__wl == INIT_VALUE:
@@ -85,25 +400,7 @@ class MeetingData():
     @meeting_end.setter
     def meeting_end(self, meeting_end):
         self.__me = meeting_end
-        
+    
     @property
     def meeting_duration(self):
         return self.__me - self.__ms
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
@@ -1,5 +1,7 @@
 import numpy as np
+from . import profiling, kernels
 
+@profiling.profiled
 def speaking_time(data):
     window = data.window_length
     for member in data.members:
@@ -7,72 +9,133 @@ def speaking_time(data):
         data[member]['speaking_time'] /= data.meeting_duration
     return data
 
+def _runs(labels):
+    # Runs of consecutive speaking windows in each row of a label matrix. 
+    # Returns the row, first window and end (exclusive) window of every run
+    padded = np.zeros((labels.shape[0], labels.shape[1]+2), dtype=np.int8)
+    padded[:, 1:-1] = labels != 0
+    edges = np.diff(padded, axis=1)
+    rows, starts = np.where(edges == 1)
+    _, ends = np.where(edges == -1)
+    return rows, starts, ends
+
+@profiling.profiled
 def overlap_time(data):
-    for member in data.members:
-        data[member]['overlap_time'] = 0.0
-    for win in range(data.number_of_windows):
-        speaking = [m for m in data.members if bool(data[m]['real_speak'][win])]
-        if len(speaking) >= 2:
-            for member in speaking:
-                data[member]['overlap_time'] += data.window_length
-    for member in data.members:
-        data[member]['overlap_time'] /= data.meeting_duration
+    labels = data.matrix('real_speak') != 0
+    overlap = labels & (np.sum(labels, axis=0) >= 2)
+    counts = np.sum(overlap, axis=1)
+    # Running sums of the window length, so each value equals adding the 
+    # window length once per overlapping window
+    totals = np.zeros((np.max(counts, initial=0)+1,))
+    np.cumsum(np.full((len(totals)-1,), data.window_length), out=totals[1:])
+    for member, count in zip(data.members, counts):
+        data[member]['overlap_time'] = totals[count]/data.meeting_duration
     return data
 
 def _fill_speech_gaps(data, max_gap=1):
+    # Fill the silent gaps of at most max_gap windows that follow speech. A 
+    # gap at the end of the meeting is filled as well, unless it is a single
+    # window
     key = 'real_speak_filled_' + str(max_gap)
-    for member in data.members:
-        data[member][key] = data[member]['real_speak'].copy()
-    for m in data.members:    
-        for w in range(data.number_of_windows-2):
-            if data[m]['real_speak'][w] and not data[m]['real_speak'][w+1]:
-                gap = 1
-                limit = np.clip(max_gap+1, None, data.number_of_windows-1-w)
-                for d in range(2, limit+1):
-                    if data[m]['real_speak'][w+d]:
-                        break
-                    gap += 1
-                if gap <= max_gap:
-                    data[m][key][w+1:w+gap+1] = 1
+    labels = data.matrix('real_speak')
+    num_win = labels.shape[1]
+    rows, starts, ends = _runs(labels == 0)
+    length = ends - starts
+    fill = np.logical_and(starts > 0, length <= max_gap)
+    fill = np.logical_and(fill, np.logical_or(ends < num_win, length >= 2))
+    delta = np.zeros((labels.shape[0], num_win+1), dtype=np.int64)
+    np.add.at(delta, (rows[fill], starts[fill]), 1)
+    np.add.at(delta, (rows[fill], ends[fill]), -1)
+    filled = labels.copy()
+    filled[np.cumsum(delta[:, :-1], axis=1) > 0] = 1
+    data.set_matrix(key, filled)
     return data
 
+def _overlap_events(labels, overlap):
+    # Row and first window of the runs of speech with at least one overlap
+    # window
+    overlap_accum = np.zeros((labels.shape[0], labels.shape[1]+1), dtype=np.int64)
+    np.cumsum(overlap, axis=1, out=overlap_accum[:, 1:])
+    rows, starts, ends = _runs(labels)
+    overlapped = overlap_accum[rows, ends] > overlap_accum[rows, starts]
+    return rows[overlapped], starts[overlapped]
+
+@profiling.profiled
 def overlap_count(data, fill_gaps=False, max_gap=1):
-    for member in data.members:
-        data[member]['overlap_count'] = 0
-    prev_overlap = np.zeros((len(data.members),))
     key = 'real_speak_filled_' + str(max_gap) if fill_gaps else 'real_speak'
     if fill_gaps and not key in data[data.members[0]].keys():
         _fill_speech_gaps(data, max_gap)
-    for w in range(data.number_of_windows):
-        speaking = np.array([data[m][key][w] for m in data.members])
-        if np.sum(speaking) >= 2:
-            for idx, m in enumerate(data.members):
-                if speaking[idx] and not prev_overlap[idx]:
-                    data[m]['overlap_count'] += 1
-                    prev_overlap[idx] = 1
-        prev_overlap[np.where(speaking==0)[0]] = 0
+    # Count the speech segments of each member that overlap with someone else
+    # in at least one window
+    labels = data.matrix(key) != 0
+    overlap = labels & (np.sum(labels, axis=0) >= 2)
+    if kernels.use_numba():
+        counts = kernels.overlapped_runs(labels, overlap)
+    else:
+        rows, _ = _overlap_events(labels, overlap)
+        counts = np.bincount(rows, minlength=len(data.members))
+    for member, count in zip(data.members, counts):
+        data[member]['overlap_count'] = int(count)
     return data
 
+def _turn_events(labels, required):
+    # Row and window of every turn taken, as counted by turn_taking
+    num_members = labels.shape[0]
+    
+    # Sequence of speakers in the windows where only one member speaks 
+    solo = np.where(np.sum(labels, axis=0) == 1)[0]
+    speakers = np.argmax(labels[:, solo], axis=0)
+    num_solo = len(speakers)
+    is_speaker = speakers == np.arange(num_members)[:, np.newaxis]
+    count_before = np.zeros((num_members, num_solo+1), dtype=np.int64)
+    np.cumsum(is_speaker, axis=1, out=count_before[:, 1:])
+    
+    # A member takes the turn when it is the first one other than the active
+    # speaker to accumulate the required number of single-speaker windows 
+    # since the last turn. Jump from turn to turn using the position of the 
+    # n-th occurrence of each member in the sequence
+    occurrences = np.full((num_members, count_before[:, -1].max(initial=0) 
+                           + required), num_solo)
+    for row in range(num_members):
+        idx = np.where(is_speaker[row])[0]
+        occurrences[row, :len(idx)] = idx
+    turn_rows, turn_positions = [], []
+    active_speaker_idx = -1
+    position = 0
+    while position < num_solo:
+        turn_at = occurrences[np.arange(num_members), 
+                              count_before[:, position] + required - 1]
+        if active_speaker_idx >= 0:
+            turn_at[active_speaker_idx] = num_solo
+        speaker_idx = np.argmin(turn_at)
+        if turn_at[speaker_idx] >= num_solo:
+            break
+        turn_rows.append(speaker_idx)
+        turn_positions.append(turn_at[speaker_idx])
+        active_speaker_idx = speaker_idx
+        position = turn_at[speaker_idx] + 1
+    return (np.array(turn_rows, dtype=np.int64), 
+            solo[np.array(turn_positions, dtype=np.int64)])
+
+@profiling.profiled
 def turn_taking(data, min_succesive_non_overlap=2, fill_gaps=False, max_gap=1):
-    for member in data.members:
-        data[member]['turn_taking_count'] = 0
     key = 'real_speak_filled_' + str(max_gap) if fill_gaps else 'real_speak'
     if fill_gaps and not key in data[data.members[0]].keys():
         _fill_speech_gaps(data, max_gap)
-    non_overlap_accum = np.zeros((len(data.members),))
-    active_speaker_idx = -1
-    for w in range(data.number_of_windows):
-        speaking = np.array([data[m][key][w] for m in data.members])
-        if np.sum(speaking) == 1:
-            speaker_idx = np.where(speaking)[0][0]
-            if speaker_idx != active_speaker_idx:
-                non_overlap_accum[speaker_idx] += 1
-                if non_overlap_accum[speaker_idx] >= min_succesive_non_overlap:
-                    active_speaker_idx = speaker_idx
-                    data[data.members[speaker_idx]]['turn_taking_count'] += 1
-                    non_overlap_accum = np.zeros((len(data.members),))
+    labels = data.matrix(key) != 0
+    required = max(int(np.ceil(min_succesive_non_overlap)), 1)
+    if kernels.use_numba():
+        solo = np.where(np.sum(labels, axis=0) == 1)[0]
+        speakers = np.argmax(labels[:, solo], axis=0)
+        turns = kernels.turn_counts(speakers, labels.shape[0], required)
+    else:
+        rows, _ = _turn_events(labels, required)
+        turns = np.bincount(rows, minlength=labels.shape[0])
+    for member, count in zip(data.members, turns):
+        data[member]['turn_taking_count'] = int(count)
     return data
 
+@profiling.profiled
 def calculate_indicators(data, print_results=True, round_decimals=2):
     p_values = np.array([data[m]['speaking_time'] for m in data.members])
     o_values = np.array([data[m]['overlap_time'] for m in data.members])
@@ -111,38 +174,63 @@ def calculate_indicators(data, print_results=True, round_decimals=2):
         
     return (p_values, p_cv, dominance, total_p, total_cp, tt_values, ttf,
             avg_s_segm, o_values, oc_values, total_o, avg_o_segm)
-    
-    
-    
-    
-    
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
 
+def _slice_sums(counts, starts, ends):
+    # Sums of counts over the windows [start, end) of every slice, from one
+    # cumulative sum along the windows
+    accum = np.zeros((counts.shape[0], counts.shape[1]+1), dtype=np.int64)
+    np.cumsum(counts, axis=1, out=accum[:, 1:])
+    return accum[:, ends] - accum[:, starts]
+
+@profiling.profiled
+def rolling_indicators(data, horizons=(60, 300, 600), stride=60, fill_gaps=False,
+                       max_gap=1, min_succesive_non_overlap=2):
+    # Indicators over sliding slices of the meeting, horizon seconds long and
+    # every stride seconds, for each horizon. Speech and overlap windows,
+    # turns (at the window where they are taken) and overlapped segments (at
+    # their first window) are accumulated once along the meeting, so every
+    # slice of every horizon is a difference of two cumulative sums.
+    # Returns a dict per horizon with the start and end time of the slices,
+    # members x slices arrays of speaking_time, overlap_time (fractions of
+    # the slice), overlap_count and turn_taking_count, and the team
+    # indicators of calculate_indicators per slice
+    key = 'real_speak_filled_' + str(max_gap) if fill_gaps else 'real_speak'
+    if fill_gaps and not key in data[data.members[0]].keys():
+        _fill_speech_gaps(data, max_gap)
+    labels = data.matrix(key) != 0
+    num_members, num_win = labels.shape
+    window = data.window_length
+    win_time = data[data.members[0]]['win_time']
+    overlap = labels & (np.sum(labels, axis=0) >= 2)
+    events = {}
+    required = max(int(np.ceil(min_succesive_non_overlap)), 1)
+    for name, (rows, wins) in [('turn_taking_count', _turn_events(labels, required)),
+                               ('overlap_count', _overlap_events(labels, overlap))]:
+        events[name] = np.zeros((num_members, num_win), dtype=np.int64)
+        np.add.at(events[name], (rows, wins), 1)
+    
+    step = max(int(round(stride/window)), 1)
+    results = {}
+    for horizon in horizons:
+        size = max(int(round(horizon/window)), 1)
+        ends = np.arange(size, num_win+1, step)
+        starts = ends - size
+        duration = size*window
+        r = {'start': win_time[starts], 'end': win_time[ends-1] + window}
+        r['speaking_time'] = window*_slice_sums(labels, starts, ends)/duration
+        r['overlap_time'] = window*_slice_sums(overlap, starts, ends)/duration
+        for name in events:
+            r[name] = _slice_sums(events[name], starts, ends)
+        
+        p_values = r['speaking_time']
+        p_max = np.max(p_values, axis=0, initial=0)
+        others = p_values != p_max
+        with np.errstate(divide='ignore', invalid='ignore'):
+            r['coefficient_of_variation'] = np.std(p_values, axis=0)/np.mean(p_values, axis=0)
+            r['dominance'] = p_max/(np.sum(p_values*others, axis=0)/np.sum(others, axis=0))
+        r['total_participation'] = np.sum(p_values, axis=0)
+        r['total_overlap'] = np.sum(r['overlap_time'], axis=0)
+        r['clean_participation'] = r['total_participation'] - r['total_overlap']
+        r['turn_taking_frequency'] = np.sum(r['turn_taking_count'], axis=0)/(duration/60)
+        results[horizon] = r
+    return results
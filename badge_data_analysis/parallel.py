@@ -0,0 +1,91 @@
+import contextlib
+import multiprocessing
+import numpy as np
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
+from . import kernels
+
+def _share(arrays):
+    # Copy the arrays into new shared memory blocks
+    blocks, specs = [], {}
+    for name, array in arrays.items():
+        shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, array.dtype, buffer=shm.buf)[...] = array
+        blocks.append(shm)
+        specs[name] = (shm.name, array.shape, array.dtype.str)
+    return blocks, specs
+
+def _init_worker(backend, initializer, initargs):
+    # Workers do not inherit the module state of the parent, so the backend
+    # of the kernels is set again before the initializer of the caller
+    kernels.set_backend(backend)
+    if initializer != None:
+        initializer(*initargs)
+
+def executor(workers=None, initializer=None, initargs=()):
+    # Process pool whose workers are started by a forkserver (spawn where
+    # there is none) instead of forked from this process. A fork would copy
+    # the thread pool that the parallel numba kernels start in the parent,
+    # and the children hang at exit
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('forkserver')
+        # The server imports the package once and the workers are forked
+        # from it, instead of each one importing numpy, scipy and numba
+        context.set_forkserver_preload(['__main__', __package__ + '.sweep'])
+    else:
+        context = multiprocessing.get_context('spawn')
+    return ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                               initializer=_init_worker,
+                               initargs=(kernels.backend, initializer, initargs))
+
+@contextlib.contextmanager
+def pool(workers=None):
+    # Executor for the correlations of a run from the workers argument of the
+    # vad functions: none (serial) with 1, a new pool of that many processes
+    # (None: all cores) that is shut down at the end, or the given executor,
+    # so that several runs share one pool and start its workers once
+    if workers == 1:
+        yield None
+    elif isinstance(workers, ProcessPoolExecutor):
+        yield workers
+    else:
+        with executor(workers) as new:
+            yield new
+
+def size(executor):
+    # Number of worker processes of an executor
+    return executor._max_workers
+
+def _run_chunk(func, specs, chunk, args):
+    # Worker side: attach the shared arrays without copying them
+    blocks, arrays = [], {}
+    for name, (shm_name, shape, dtype) in specs.items():
+        shm = shared_memory.SharedMemory(name=shm_name)
+        blocks.append(shm)
+        arrays[name] = np.ndarray(shape, dtype, buffer=shm.buf)
+    try:
+        return func(arrays, chunk, *args)
+    finally:
+        del arrays
+        for shm in blocks:
+            shm.close()
+
+def split(jobs, workers, chunks_per_worker=4):
+    # Contiguous chunks of a job array, a few per worker to balance the load
+    num_chunks = max(min(len(jobs), workers*chunks_per_worker), 1)
+    return np.array_split(jobs, num_chunks)
+
+def map_chunks(func, arrays, chunks, executor, args=()):
+    # Call func(arrays, chunk, *args) for every chunk in the worker processes
+    # of executor. The arrays are placed in shared memory once instead of
+    # being pickled along with every chunk, and the results are returned in
+    # the order of chunks
+    blocks, specs = _share(arrays)
+    try:
+        futures = [executor.submit(_run_chunk, func, specs, chunk, args)
+                   for chunk in chunks]
+        return [future.result() for future in futures]
+    finally:
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
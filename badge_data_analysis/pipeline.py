@@ -0,0 +1,187 @@
+import json
+import hashlib
+from collections import OrderedDict, namedtuple
+import numpy as np
+from . import preprocessing, vad, metrics, cache, parallel
+from .meeting_data import SAMPLE_KEYS
+from .batch import INDICATORS, _params, correlation_table
+
+# A stage modifies the result of its input stage in place with
+# func(data, **params). outputs are the keys it writes, so the pipeline knows
+# whether the sample matrices have to be copied before running it
+Stage = namedtuple('Stage', ['name', 'func', 'params', 'input', 'outputs'])
+
+def _read(data, filename, excluded_members=[], use_cache=False):
+    return preprocessing.read_file(filename, excluded_members, use_cache)
+
+def _fix_time_jumps(data, fix_time_jumps=True, max_jump_sec=1):
+    if fix_time_jumps:
+        preprocessing.fix_time_jumps(data, max_jump_sec)
+    return data
+
+def _align(data, align=None):
+    if align != None:
+        preprocessing.align(data, method=align)
+    return data
+
+def _metrics(data, fill_gaps=False, max_gap=1, min_succesive_non_overlap=2):
+    metrics.speaking_time(data)
+    metrics.overlap_time(data)
+    metrics.overlap_count(data, fill_gaps, max_gap)
+    metrics.turn_taking(data, min_succesive_non_overlap, fill_gaps, max_gap)
+    return data
+
+# Same flow as batch.run_session, one stage per function
+STAGES = [
+    Stage('read', _read, ('filename', 'excluded_members', 'use_cache'), None,
+          ('time', 'signal')),
+    Stage('fix_time_jumps', _fix_time_jumps, ('fix_time_jumps', 'max_jump_sec'),
+          'read', ('time',)),
+    Stage('truncate', preprocessing.truncate, (), 'fix_time_jumps',
+          ('time', 'signal', 'valid')),
+    Stage('remove_offset', preprocessing.remove_offset, ('percentile',),
+          'truncate', ('signal',)),
+    Stage('align', _align, ('align',), 'remove_offset',
+          ('time', 'signal', 'valid')),
+    Stage('window_statistics', vad.window_statistics, ('window',), 'align',
+          ('win_time', 'win_mean', 'win_std', 'win_count', 'win_idx',
+           'global_mean', 'global_std')),
+    Stage('genuine_speak', vad.label_genuine, ('max_temp_shift', 'corr_thr',
+          'silence_thr_mean', 'silence_thr_std', 'prune_similarity'),
+          'window_statistics',
+          ('gen_speak',)),
+    Stage('thresholds', vad.calculate_thresholds, ('bandwidth', 'kde_method'),
+          'genuine_speak', ('thr_mean', 'thr_std', 'is_beacon')),
+    Stage('all_speak', vad.all_speak, ('threshold_by_mean', 'threshold_by_std'),
+          'thresholds', ('all_speak',)),
+    Stage('real_speak', vad.real_speak, ('corr_thr', 'max_temp_shift',
+          'prune_similarity'),
+          'all_speak', ('real_speak',)),
+    Stage('metrics', _metrics, ('fill_gaps', 'max_gap',
+          'min_succesive_non_overlap'), 'real_speak',
+          ('speaking_time', 'overlap_time', 'overlap_count', 'turn_taking_count')),
+]
+
+# Parameters named differently in the stage functions
+STAGE_ARGS = {'thresholds': {'kde_method': 'method'}}
+# Stages that correlate windows, which can run in worker processes
+PARALLEL_STAGES = ('genuine_speak', 'real_speak')
+
+class Pipeline():
+    ''' Lazy version of the analysis of one log file. Every stage result is
+    memoized under a hash of the parameters of the stage and of the key of its
+    input stage, so after changing some parameters only the stages that
+    depend on them are run again, starting from a copy of the latest result
+    that is still valid. A sweep over corr_thr, for example, reads and
+    preprocesses the log and computes the window statistics and correlations
+    only once (see correlations.CorrelationTable):
+
+        pipe = Pipeline('data/audio_data_session_0.txt')
+        for corr_thr in [0.75, 0.8, 0.85, 0.9]:
+            indicators = pipe.indicators(corr_thr=corr_thr)
+
+    The results returned are the memoized ones, modify copies of them
+    (data.copy()). max_results bounds the number of stage results kept,
+    dropping the least recently used ones. With workers other than 1 the
+    correlating stages of a run share one pool of worker processes; an
+    executor from parallel.executor is used by all the runs instead.
+    '''
+
+    def __init__(self, filename, stages=STAGES, workers=1, max_results=None,
+                 **params):
+        self.stages = OrderedDict((stage.name, stage) for stage in stages)
+        self.workers = workers
+        self.max_results = max_results
+        self.params = dict(_params(params), filename=filename)
+        self.results = OrderedDict()
+        self.tables = {}
+        self.runs = {name: 0 for name in self.stages}
+
+    def set(self, **params):
+        # Change parameters, without running anything
+        _params({key: v for key, v in params.items() if key != 'filename'})
+        self.params.update(params)
+        return self
+
+    def key(self, name):
+        # Hash of the parameters of a stage and the key of its input. The
+        # log is identified by its path, size and modification time
+        stage = self.stages[name]
+        state = {param: self.params[param] for param in stage.params}
+        if 'filename' in state:
+            state['source'] = cache._source_stat(state['filename'])
+        if stage.input != None:
+            state['input'] = self.key(stage.input)
+        text = json.dumps([name, state], sort_keys=True, default=repr)
+        return hashlib.sha1(text.encode()).hexdigest()
+
+    def _lineage(self, name):
+        # Stages from the source to name
+        lineage = [name]
+        while self.stages[lineage[-1]].input != None:
+            lineage.append(self.stages[lineage[-1]].input)
+        return lineage[::-1]
+
+    def correlations(self):
+        # Window correlations of the current preprocessing and window
+        # parameters, shared by genuine_speak and real_speak of every corr_thr
+        key = self.key('window_statistics')
+        if not key in self.tables:
+            params = {k: v for k, v in self.params.items() if k != 'filename'}
+            self.tables[key] = correlation_table(self.params['filename'], **params)
+        return self.tables[key]
+
+    def _store(self, key, data):
+        self.results[key] = data
+        if self.max_results != None:
+            while len(self.results) > self.max_results:
+                self.results.popitem(last=False)
+
+    def run(self, until='metrics', **params):
+        # Result of a stage with the current parameters (updated with params)
+        self.set(**params)
+        lineage = self._lineage(until)
+        keys = [self.key(name) for name in lineage]
+        done = len(lineage)
+        while done > 0 and not keys[done-1] in self.results:
+            done -= 1
+        if done == len(lineage):
+            self.results.move_to_end(keys[-1])
+            return self.results[keys[-1]]
+        data = self.results[keys[done-1]] if done > 0 else None
+        todo = lineage[done:]
+        workers = self.workers if set(todo) & set(PARALLEL_STAGES) else 1
+        with parallel.pool(workers) as executor:
+            for name, key in zip(todo, keys[done:]):
+                stage = self.stages[name]
+                args = {STAGE_ARGS.get(name, {}).get(param, param): self.params[param]
+                        for param in stage.params}
+                if name in PARALLEL_STAGES:
+                    args['workers'] = 1 if executor == None else executor
+                    args['correlations'] = self.correlations()
+                if data is not None:
+                    data = data.copy(samples=any(output in SAMPLE_KEYS
+                                                 for output in stage.outputs))
+                data = stage.func(data, **args)
+                self.runs[name] += 1
+                self._store(key, data)
+        return data
+
+    def indicators(self, **params):
+        # Team and member indicators, as in batch.run_session
+        data = self.run('metrics', **params)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            indicators = metrics.calculate_indicators(data, print_results=False)
+        return dict(zip(INDICATORS, indicators))
+
+    def invalidate(self, name=None):
+        # Forget the results of a stage with the current parameters and of
+        # the stages that depend on it, to free memory. All of them by default
+        if name == None:
+            self.results.clear()
+            self.tables.clear()
+            return self
+        for stage in self.stages:
+            if name in self._lineage(stage):
+                self.results.pop(self.key(stage), None)
+        return self
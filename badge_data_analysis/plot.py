@@ -1,20 +1,110 @@
 import matplotlib.pyplot as plt
-from datetime import datetime
+import matplotlib.dates as mdates
+from datetime import datetime, timezone
 import numpy as np
-from .vad import _positive_kde
-
-def signals(data, title=None, fig=None, axes=None):
+from .vad import densities
+from .metrics import _runs, rolling_indicators
+
+def _utc_offset(t):
+    # Seconds from UTC to local time at the unix time t
+    utc = datetime.fromtimestamp(t, timezone.utc).replace(tzinfo=None)
+    return (datetime.fromtimestamp(t) - utc).total_seconds()
+
+def _offset_changes(start, end, step=3600):
+    # Times where the UTC offset changes (e.g. daylight saving time) in
+    # [start, end], and the offsets before and after each of them. The range
+    # is scanned hourly and every change is located to the second
+    times = np.append(np.arange(start, end, step), end)
+    offsets = np.array([_utc_offset(t) for t in times])
+    changed = np.where(np.diff(offsets) != 0)[0]
+    changes = []
+    for i in changed:
+        lo, hi = int(np.floor(times[i])), int(np.ceil(times[i+1]))
+        while hi - lo > 1:
+            mid = (lo + hi)//2
+            lo, hi = (mid, hi) if _utc_offset(mid) == offsets[i] else (lo, mid)
+        changes.append(hi)
+    return np.array(changes), np.append(offsets[0], offsets[changed+1])
+
+def _dates(time):
+    # Matplotlib date numbers of unix times, in local time as
+    # datetime.fromtimestamp, converted all at once with the UTC offset of
+    # every sample
+    time = np.asarray(time, dtype=float)
+    if len(time) == 0:
+        return time
+    changes, offsets = _offset_changes(np.min(time), np.max(time))
+    offset = offsets[np.searchsorted(changes, time, side='right')]
+    return mdates.date2num(((time + offset)*1e6).astype('datetime64[us]'))
+
+def _min_max(x, y, num_bins):
+    # Envelope of a signal for num_bins pixels: the minimum and maximum of
+    # every bin of samples, in the order they occur, so the drawn line covers
+    # the same pixels as the full signal
+    if len(x) <= 4*num_bins:
+        return x, y
+    per_bin = int(np.ceil(len(x)/num_bins))
+    pad = per_bin*num_bins - len(y)
+    bins = np.pad(y, (0, pad), mode='edge').reshape((num_bins, per_bin))
+    offsets = np.arange(num_bins)*per_bin
+    lo = offsets + np.argmin(bins, axis=1)
+    hi = offsets + np.argmax(bins, axis=1)
+    idx = np.minimum(np.sort(np.column_stack((lo, hi)), axis=1).ravel(), len(x)-1)
+    return x[idx], y[idx]
+
+class _DecimatedLine():
+    ''' Line drawn from the min/max envelope of a full resolution signal. The
+    envelope is recomputed from the full signal for the visible range every
+    time the x limits of the axes change, so zooming in shows the details.
+    '''
+    
+    def __init__(self, ax, x, y, **kwargs):
+        order = None if np.all(x[1:] >= x[:-1]) else np.argsort(x, kind='stable')
+        self.x = x if order is None else x[order]
+        self.y = np.asarray(y) if order is None else np.asarray(y)[order]
+        self.ax = ax
+        self.line, = ax.plot(*self._envelope(None), **kwargs)
+        # The axes only keep weak references to bound methods
+        ax.callbacks.connect('xlim_changed', lambda ax: self.update(ax))
+    
+    def _envelope(self, xlim):
+        lo, hi = 0, len(self.x)
+        if xlim != None:
+            lo = max(np.searchsorted(self.x, xlim[0], side='left') - 1, 0)
+            hi = min(np.searchsorted(self.x, xlim[1], side='right') + 1, len(self.x))
+        return _min_max(self.x[lo:hi], self.y[lo:hi], max(int(self.ax.bbox.width), 1))
+    
+    def update(self, ax):
+        self.line.set_data(*self._envelope(ax.get_xlim()))
+
+def _plot_signal(ax, time, signal, decimate=True, **kwargs):
+    x = _dates(time)
+    if decimate:
+        return _DecimatedLine(ax, x, signal, **kwargs).line
+    return ax.plot(x, signal, **kwargs)[0]
+
+def _spans(win_time, labels, window):
+    # (start, width) in date numbers of every run of windows with labels > 0
+    _, starts, ends = _runs(np.atleast_2d(labels > 0))
+    start = _dates(win_time[starts])
+    return np.column_stack((start, _dates(win_time[ends-1] + window) - start))
+
+def signals(data, title=None, fig=None, axes=None, decimate=True):
+    # With decimate, each signal is drawn as its min/max envelope at the
+    # resolution of the axes (see _DecimatedLine)
     if fig == None:
         fig, axes = plt.subplots(nrows=len(data), ncols=1, sharex=True, sharey=True)
     for i, member in enumerate(data.members):
-        axes[i].plot([datetime.fromtimestamp(t) for t in data[member]['time']], 
-                     data[member]['signal'], c=plt.get_cmap('tab10').colors[i])
+        _plot_signal(axes[i], data[member]['time'], data[member]['signal'], decimate,
+                     c=plt.get_cmap('tab10').colors[i])
+        axes[i].xaxis_date()
         axes[i].set_title('Participant ' + str(member))
         axes[i].grid(alpha=0.3)
     fig.suptitle('Voice signals from each participant' if title==None else title)
     return fig, axes
 
-def histograms(data, num_bins=30, plot_thresholds=True, plot_kde=True, bandwidth=None):
+def histograms(data, num_bins=30, plot_thresholds=True, plot_kde=True, bandwidth=None,
+               method='exact'):
     non_beacons = [key for key in data.members if not data[key]['is_beacon']]
     fig, axes = plt.subplots(nrows=len(non_beacons), ncols=2, sharex=True)
     plt.xlim([0,80])
@@ -35,44 +125,40 @@ def histograms(data, num_bins=30, plot_thresholds=True, plot_kde=True, bandwidth
             axes[i,0].plot(np.repeat(data[member]['thr_mean'], 2), [0, np.max(np.hstack((c1, c2)))], c='k')
             axes[i,1].plot(np.repeat(data[member]['thr_std'], 2), [0, np.max(np.hstack((c3, c4)))], c='k')
         if plot_kde:
-            xi, f_speak, f_silen = _positive_kde(data[member], 'win_mean', bandwidth)
+            xi, f_speak, f_silen = densities(data[member], 'win_mean', bandwidth, method)
             axes[i,0].plot(xi, f_speak, color='tab:blue')
             axes[i,0].plot(xi, f_silen, color='tab:orange')
-            xi, f_speak, f_silen = _positive_kde(data[member], 'win_std', bandwidth)
+            xi, f_speak, f_silen = densities(data[member], 'win_std', bandwidth, method)
             axes[i,1].plot(xi, f_speak, color='tab:blue')
             axes[i,1].plot(xi, f_silen, color='tab:orange')
     return fig, axes
 
-def vad(data, gen_speak=True, all_speak=True, real_speak=True):
+def vad(data, gen_speak=True, all_speak=True, real_speak=True, decimate=True):
+    # Speaking windows are drawn as one bar per run of windows: genuine,
+    # thresholded and real speech at increasing heights over each signal
+    # (light to dark), and real speech of everyone in the last axes
     if real_speak:
         fig, axes = plt.subplots(nrows=len(data)+1, ncols=1, sharex=True)
-        axes[0].get_shared_y_axes().join(*axes[:-1])
-        fig, axes = signals(data, 'Voice activity detection', fig, axes)
+        for ax in axes[1:-1]:
+            ax.sharey(axes[0])
+        fig, axes = signals(data, 'Voice activity detection', fig, axes, decimate)
     else:
-        fig, axes = signals(data, 'Voice activity detection')
+        fig, axes = signals(data, 'Voice activity detection', decimate=decimate)
     window = np.diff(data[list(data.members)[0]]['win_time'][:2])[0]
     for i, member in enumerate(data.members):
-        time_vec = np.repeat(data[member]['win_time'], 2)
-        time_vec[1::2] += window
-        time_vec = np.array([datetime.fromtimestamp(t) for t in time_vec])
+        win_time = data[member]['win_time']
         amp = data[member]['global_mean'] + 2*data[member]['global_std']
-        if gen_speak:
-            gen_s = 0.8*amp*np.repeat(np.clip(data[member]['gen_speak'], 0, 1), 2)
-            linestyle = ':' if all_speak and real_speak else '--' if all_speak or real_speak else '-'
-            axes[i].plot(time_vec, gen_s, linestyle=linestyle, c='black')
-        if all_speak:
-            all_s = 1.0*amp*np.repeat(data[member]['all_speak'], 2)
-            linestyle = '--' if real_speak else '-'
-            axes[i].plot(time_vec, all_s, linestyle=linestyle, c='black')
+        levels = [('gen_speak', 0.8, 0.3, gen_speak), ('all_speak', 1.0, 0.6, all_speak),
+                  ('real_speak', 1.2, 1.0, real_speak)]
+        for key, level, alpha, show in levels:
+            if show:
+                axes[i].broken_barh(_spans(win_time, data[member][key], window),
+                                    ((level - 0.03)*amp, 0.06*amp), facecolors='black',
+                                    alpha=alpha)
         if real_speak:
-            real_s = 1.2*amp*np.repeat(data[member]['real_speak'], 2)
-            axes[i].plot(time_vec, real_s, c='black')
-        
-            time_vec = data[member]['win_time'][data[member]['real_speak'] > 0]
-            time_vec = np.vstack((np.array([datetime.fromtimestamp(t) for t in time_vec]), 
-                                  np.array([datetime.fromtimestamp(t) for t in time_vec+window])))
-            y = (len(data.members)-1-i)*np.ones(time_vec.shape)
-            axes[-1].plot(time_vec, y, c=plt.get_cmap('tab10').colors[i], linewidth=3)
+            axes[-1].broken_barh(_spans(win_time, data[member]['real_speak'], window),
+                                 (len(data.members)-1-i - 0.1, 0.2),
+                                 facecolors=plt.get_cmap('tab10').colors[i])
     if real_speak:
         axes[-1].set_yticks(range(-1, len(data.members)+1))
         yticks = [' ']
@@ -93,35 +179,39 @@ def metrics(data):
         # axes[r,c].set_title(' '.join([x.capitalize() for x in metrics[i].split('_')]))
         axes[r,c].set_title(titles[r*2+c])
         axes[r,c].grid(alpha=0.3)
-    axes[0,0].get_shared_y_axes().join(axes[0,0], axes[0,1])
+    axes[0,1].sharey(axes[0,0])
     axes[0,1].set_ylim(axes[0,0].get_ylim())
     return fig, axes
 
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+def rolling(data, indicators=None, **kwargs):
+    # Indicators of metrics.rolling_indicators (computed with kwargs when not
+    # given) against the end time of each slice: one column per horizon, with
+    # the speaking time of every member, dominance, turn taking frequency and
+    # overlap
+    if indicators == None:
+        indicators = rolling_indicators(data, **kwargs)
+    horizons = sorted(indicators)
+    fig, axes = plt.subplots(nrows=4, ncols=len(horizons), sharex=True, sharey='row',
+                             squeeze=False)
+    colors = plt.get_cmap('tab10').colors
+    for c, horizon in enumerate(horizons):
+        r = indicators[horizon]
+        x = _dates(r['end'])
+        for i, member in enumerate(data.members):
+            axes[0,c].plot(x, 100*r['speaking_time'][i], c=colors[i % len(colors)],
+                           label=str(member))
+        axes[1,c].plot(x, r['dominance'], c='k')
+        axes[2,c].plot(x, r['turn_taking_frequency'], c='k')
+        axes[3,c].plot(x, 100*r['total_overlap'], c='k')
+        axes[0,c].set_title(str(np.round(horizon/60, 2)) + ' min')
+        for ax in axes[:,c]:
+            ax.xaxis_date()
+            ax.grid(alpha=0.3)
+        axes[-1,c].xaxis.set_major_formatter(mdates.DateFormatter('%H:%M'))
+    for ax, label in zip(axes[:,0], ['Speaking time [%]', 'Dominance',
+                                     'Turns/min', 'Overlap [%]']):
+        ax.set_ylabel(label)
+    axes[0,-1].legend(loc='upper right', fontsize='small')
+    fig.autofmt_xdate()
+    fig.suptitle('Rolling indicators')
+    return fig, axes
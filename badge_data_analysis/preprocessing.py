@@ -1,76 +1,299 @@
 import json
+from bisect import bisect_left, bisect_right
 import numpy as np
 from .meeting_data import MeetingData
+from . import cache as _cache
+from . import profiling
 
-def read_file(filename, excluded_members=[]):
-    # Read text lines and save signal and timestamps to data structure
-    data = MeetingData()
+def _compact_dtype(signal):
+    # Smallest integer type that holds the amplitudes (uint8 for the badges)
+    low, high = signal.min(initial=0), signal.max(initial=0)
+    for dtype in (np.uint8, np.int16, np.int32):
+        if np.iinfo(dtype).min <= low and high <= np.iinfo(dtype).max:
+            return dtype
+    return signal.dtype
+
+class _PacketIndex():
+    ''' Sorted index of the packets of one member, to deduplicate them while a
+    log is being parsed: a packet is dropped when its timestamp matches any
+    sample time of a stored packet, which only requires checking the few 
+    packets whose span contains that timestamp.
+    '''
+    
+    def __init__(self):
+        self.samples = 0
+        self._starts = []
+        self._packets = []
+        self._max_span = 0.0
+    
+    def is_duplicate(self, ts):
+        lo = bisect_left(self._starts, ts - self._max_span)
+        hi = bisect_right(self._starts, ts)
+        for start, sp, ns in self._packets[lo:hi]:
+            if start == ts or ts in np.linspace(start, start+(ns-1)*sp, ns):
+                return True
+        return False
+    
+    def add(self, ts, sp, ns):
+        # Store a packet, False when it is a duplicate
+        if self.samples > 0 and self.is_duplicate(ts):
+            return False
+        idx = bisect_right(self._starts, ts)
+        self._starts.insert(idx, ts)
+        self._packets.insert(idx, (ts, sp, ns))
+        self._max_span = max(self._max_span, (ns-1)*sp)
+        self.samples += ns
+        return True
+    
+    def remove(self, ts):
+        # Forget the stored packet that starts at ts
+        idx = bisect_left(self._starts, ts)
+        del self._starts[idx]
+        _, _, ns = self._packets.pop(idx)
+        self.samples -= ns
+
+class _MemberBuffer():
+    ''' Growable NumPy buffers holding the samples of one member while a log is
+    being parsed, without the duplicated packets (see _PacketIndex).
+    '''
+    
+    def __init__(self, capacity=4096):
+        self.time = np.empty((capacity,))
+        self.signal = np.empty((capacity,), dtype=np.int64)
+        self.size = 0
+        self.index = _PacketIndex()
+    
+    def _grow(self, min_capacity):
+        capacity = max(2*len(self.time), min_capacity)
+        self.time = np.resize(self.time, (capacity,))
+        self.signal = np.resize(self.signal, (capacity,))
+    
+    def append(self, ts, sp, samples):
+        ns = len(samples)
+        if not self.index.add(ts, sp, ns):
+            return False
+        if self.size + ns > len(self.time):
+            self._grow(self.size + ns)
+        self.time[self.size:self.size+ns] = np.linspace(ts, ts+(ns-1)*sp, ns)
+        self.signal[self.size:self.size+ns] = samples
+        self.size += ns
+        return True
+    
+    def arrays(self):
+        signal = self.signal[:self.size]
+        return self.time[:self.size].copy(), signal.astype(_compact_dtype(signal))
+
+def iter_packets(fid):
+    # Parse the log one line at a time, yielding the data field of each packet
+    for line in fid:
+        if line.strip():
+            yield json.loads(line)['data']
+
+@profiling.profiled
+def read_file(filename, excluded_members=[], use_cache=False):
+    # Load the binary cache of the log when it is up to date
+    if use_cache:
+        if _cache.is_valid(filename):
+            return _cache.load(filename, excluded_members)
+        data = read_file(filename)
+        _cache.save(data, filename)
+        return _cache.load(filename, excluded_members)
+    
+    # Stream the packets of the log into per-member buffers
+    buffers = {}
+    packets, duplicates = 0, 0
     with open(filename, 'r') as fid:
-        for line in fid.readlines():
-            packet = json.loads(line)
-            member = packet['data']['member_id']
+        for packet in iter_packets(fid):
+            member = packet['member_id']
             if member in excluded_members:
                 continue
-            ts = packet['data']['timestamp']
-            sp = packet['data']['sample_period']/1000
-            ns = packet['data']['num_samples']
-            if not member in data.members:
-                data[member] = {'signal': packet['data']['samples'],
-                                   'time': list(np.linspace(ts,ts+(ns-1)*sp,ns))}
-            elif not ts in data[member]['time']:
-                data[member]['signal'].extend(packet['data']['samples'])
-                data[member]['time'].extend(np.linspace(ts,ts+(ns-1)*sp,ns))
-                
-    # Convert lists to numpy arrays
-    for member in data.members:
-        data[member]['time'] = np.array(data[member]['time'])
-        data[member]['signal'] = np.array(data[member]['signal'], 
-                                             dtype=np.int64)
+            if not member in buffers:
+                buffers[member] = _MemberBuffer()
+            packets += 1
+            duplicates += not buffers[member].append(packet['timestamp'], 
+                                                     packet['sample_period']/1000,
+                                                     packet['samples'])
+    profiling.count('packets', packets)
+    profiling.count('duplicate_packets', duplicates)
+    return _meeting_data(buffers)
+
+def _meeting_data(buffers):
+    # Save signal and timestamps of per-member buffers to data structure
+    data = MeetingData()
+    for member in sorted(buffers):
+        time, signal = buffers[member].arrays()
+        data[member] = {'signal': signal, 'time': time}
     return data
 
+def _sorted_replace(values, old, new):
+    # Replace one value of a sorted array in place, keeping it sorted
+    i = np.searchsorted(values, old)
+    j = np.searchsorted(values, new)
+    if j > i:
+        values[i:j-1] = values[i+1:j]
+        values[j-1] = new
+    else:
+        values[j+1:i+1] = values[j:i]
+        values[j] = new
+
+def _median_sorted(values):
+    # Same result as np.median on the unsorted values
+    n = len(values)
+    if n % 2:
+        return values[n//2]
+    return np.mean(values[n//2-1:n//2+1])
+
+@profiling.profiled
 def fix_time_jumps(data, max_jump_sec=1):
-    # Find and fix time jumps due to clock synchronization with hub
-    # time_jumps_ids = []
+    # Find and fix time jumps due to clock synchronization with hub. The 
+    # samples before each jump are moved so that the jump is replaced by the
+    # median sample period. Jumps are fixed from the largest to the smallest
+    # and each one uses the median of the periods with the previous ones 
+    # already fixed. The jumps found are kept in data[member]['time_jumps']
+    # with the index and raw time of the first sample after them.
+    # The periods are computed once and the offsets are added with a single
+    # reverse cumulative sum, as in chunked.ChunkedMeeting. Shifting the times
+    # at every jump and computing the periods again, as the original loop
+    # did, rounds them differently. With one jump the times are the same.
+    # With k jumps, and an even number of periods whose median is a mean of
+    # two, they can differ by up to 3*k units in the last place of the times,
+    # which is 7e-7 s per jump for Unix timestamps. None of the hub-like
+    # series of benchmarks/bench_time_jumps.py differ
     for member in data.members:
-        while True:
-            diff = np.diff(data[member]['time'])
-            diff_abs = np.abs(diff)
-            idx = np.argmax(diff_abs)
-            if diff_abs[idx] > max_jump_sec:
-                # time_jumps_ids.append(member)
-                offset = diff[idx] - np.median(diff)
-                length, = data[member]['time'].shape
-                data[member]['time'] += np.pad(offset*np.ones((idx+1,)), 
-                                               (0,length-idx-1))
-            else:
-                break
-
-    # # Print info about time jump found
-    # if any(time_jumps_ids):
-    #     print('Time jumps found in ' + str(time_jumps_ids))
-    
+        time = data[member]['time']
+        diff = np.diff(time)
+        diff_abs = np.abs(diff)
+        jumps = np.where(diff_abs > max_jump_sec)[0]
+        time_jumps = []
+        if len(jumps) == 0:
+            data[member]['time_jumps'] = time_jumps
+            continue
+        jumps = jumps[np.argsort(-diff_abs[jumps], kind='stable')]
+        periods = np.sort(diff)
+        shift = np.zeros((len(time),))
+        for idx in jumps:
+            median = _median_sorted(periods)
+            offset = diff[idx] - median
+            shift[idx] += offset
+            _sorted_replace(periods, diff[idx], median)
+            time_jumps.append({'index': int(idx+1), 'time': float(time[idx+1]),
+                               'jump': float(diff[idx]), 'offset': float(offset)})
+        time += np.cumsum(shift[::-1])[::-1]
+        data[member]['time_jumps'] = time_jumps
     return data
 
+def _kept_samples(time, start, end):
+    # Slice of the samples with start <= time <= end, or a boolean mask when
+    # they are not contiguous (overlapping packets leave the time unsorted)
+    if np.all(time[1:] >= time[:-1]):
+        return slice(np.searchsorted(time, start, side='left'),
+                     np.searchsorted(time, end, side='right'))
+    indices = np.greater_equal(time, start)
+    indices &= time <= end
+    first = np.argmax(indices)
+    last = len(indices) - np.argmax(indices[::-1])
+    if np.count_nonzero(indices) == last - first:
+        return slice(first, last)
+    return indices
+
+@profiling.profiled
 def truncate(data):
-    # Truncate data to the segment where all devices are turned on
+    # Truncate data to the segment where all devices are turned on. Rows are
+    # sliced in place and members that start late are padded with silence, 
+    # marked as missing in 'valid'
     for member in data.members:
-        indices = np.logical_and(data[member]['time'] >= data.meeting_start,
-                                 data[member]['time'] <= data.meeting_end)
+        indices = _kept_samples(data[member]['time'], data.meeting_start,
+                                data.meeting_end)
         data[member]['signal'] = data[member]['signal'][indices]
         data[member]['time'] = data[member]['time'][indices]
         if data[member]['time'][0] - data.meeting_start > 1:
             time_missing = np.arange(data.meeting_start, data[member]['time'][0], data.sample_period)
-            data[member]['time'] = np.hstack((time_missing, data[member]['time']))
-            signal_missing = np.zeros(time_missing.shape)
-            data[member]['signal'] = np.hstack((signal_missing, data[member]['signal']))
+            data.prepend_samples(member, 'time', time_missing)
+            signal = data[member]['signal']
+            data.prepend_samples(member, 'signal', np.zeros(time_missing.shape, 
+                                                            dtype=signal.dtype))
+            valid = np.ones(len(data[member]['signal']), dtype=bool)
+            valid[:len(time_missing)] = False
+            data[member]['valid'] = valid
     return data
     
     # To do: Print info about truncation
+
+def _percentile_of(kth, n, percentile):
+    # np.percentile (linear method) of n values, where kth(indices) gives the
+    # values at those positions of the sorted values
+    q = percentile/100
+    virtual_index = (n - 1)*q
+    previous = int(np.clip(np.floor(virtual_index), 0, n-1))
+    following = int(np.clip(previous + 1, 0, n-1))
+    gamma = virtual_index - np.floor(virtual_index)
+    a, b = [float(value) for value in kth([previous, following])]
+    if gamma >= 0.5:
+        return b - (b - a)*(1 - gamma)
+    return a + (b - a)*gamma
+
+def _percentile(signal, percentile):
+    # np.percentile (linear method) from a partial sort
+    return _percentile_of(lambda idx: np.partition(signal, idx)[idx], len(signal),
+                          percentile)
     
+@profiling.profiled
 def remove_offset(data, percentile=1):
-    # Remove the badge-specific offset due to noise floor
+    # Remove the badge-specific offset due to noise floor. Samples below the
+    # offset are raised to it before subtracting, so unsigned signals work
+    for member in data.members:
+        signal = data[member]['signal']
+        offset = int(_percentile(signal, percentile))
+        np.clip(signal, offset, None, out=signal)
+        signal -= offset
+    return data
+
+@profiling.profiled
+def align(data, sample_period=None, method='nearest', max_gap=None):
+    # Resample every member onto one uniform grid that starts at the meeting 
+    # start, taking the nearest sample or interpolating linearly between the 
+    # two around each grid point. Grid points farther than max_gap (default:
+    # one sample period) from any real sample are missing: their signal is 
+    # zero and they are False in data[member]['valid']. Windows of aligned 
+    # data are fixed-size blocks of the grid
+    if not method in ('nearest', 'linear'):
+        raise ValueError('Unknown alignment method: ' + str(method))
+    if sample_period == None:
+        sample_period = np.median([np.median(np.diff(np.sort(data[m]['time'])))
+                                   for m in data.members])
+    max_gap = sample_period if max_gap == None else max_gap
+    start, end = data.meeting_start, data.meeting_end
+    num_samples = int(np.floor((end - start)/sample_period)) + 1
+    grid = start + sample_period*np.arange(num_samples)
+    
     for member in data.members:
-        offset = int(np.percentile(data[member]['signal'], percentile))
-        data[member]['signal'] -= offset
-        data[member]['signal'] = np.clip(data[member]['signal'], 0, None)
+        time, signal = data[member]['time'], data[member]['signal']
+        # Real samples in time order, leaving out the padding of truncate
+        order = None
+        if not np.all(time[1:] >= time[:-1]):
+            order = np.argsort(time, kind='stable')
+        if 'valid' in data[member].keys():
+            valid = data[member]['valid']
+            order = np.where(valid)[0] if order is None else order[valid[order]]
+        if order is not None:
+            time, signal = time[order], signal[order]
+        
+        # Samples before and after each grid point
+        after = np.clip(np.searchsorted(time, grid), 1, len(time)-1)
+        before = after - 1
+        to_before = np.abs(grid - time[before])
+        to_after = np.abs(time[after] - grid)
+        nearest = np.where(to_before <= to_after, before, after)
+        missing = np.minimum(to_before, to_after) > max_gap
+        if method == 'nearest':
+            values = signal[nearest]
+        else:
+            values = np.interp(grid, time, signal)
+            values = np.rint(values).astype(signal.dtype)
+        values[missing] = 0
+        data[member]['time'] = grid
+        data[member]['signal'] = values
+        data[member]['valid'] = ~missing
+    data.sample_period = sample_period
+    data.grid_period = sample_period
     return data
@@ -0,0 +1,150 @@
+import json
+import time
+import functools
+import tracemalloc
+from contextlib import contextmanager
+from .meeting_data import MeetingData
+
+# Profiler recording the instrumented functions, None when profiling is off
+_ACTIVE = None
+
+class Profiler():
+    ''' Wall time, CPU time, peak memory and counters of every instrumented
+    function (see profiled), accumulated over all its calls. Times are
+    inclusive of the instrumented functions called inside, 'self_wall'
+    excludes them. Counters go to the innermost running function and to the
+    totals of the profiler.
+
+    Peak memory is only measured with memory=True, through tracemalloc, which
+    slows the code down noticeably, so times are best taken without it.
+    '''
+
+    def __init__(self, memory=False):
+        self.memory = memory
+        self.functions = {}
+        self.counters = {}
+        self._stack = []
+        self._started = memory and not tracemalloc.is_tracing()
+        if self._started:
+            tracemalloc.start()
+
+    def stop(self):
+        # Stop tracing memory, if this profiler started it
+        if self._started:
+            tracemalloc.stop()
+            self._started = False
+
+    def _enter(self, name):
+        current = 0
+        if self.memory:
+            current, peak = tracemalloc.get_traced_memory()
+            if self._stack:
+                self._stack[-1]['peak'] = max(self._stack[-1]['peak'], peak)
+            tracemalloc.reset_peak()
+        self._stack.append({'name': name, 'start': current, 'peak': current,
+                            'children': 0.0, 'counters': {},
+                            'cpu': time.process_time(),
+                            'wall': time.perf_counter()})
+
+    def _exit(self):
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        frame = self._stack.pop()
+        wall -= frame['wall']
+        stats = self.functions.setdefault(frame['name'], {
+            'calls': 0, 'wall': 0.0, 'self_wall': 0.0, 'cpu': 0.0,
+            'peak_memory': 0, 'counters': {}})
+        stats['calls'] += 1
+        stats['wall'] += wall
+        stats['self_wall'] += wall - frame['children']
+        stats['cpu'] += cpu - frame['cpu']
+        for counter, value in frame['counters'].items():
+            stats['counters'][counter] = stats['counters'].get(counter, 0) + value
+        if self.memory:
+            peak = max(frame['peak'], tracemalloc.get_traced_memory()[1])
+            stats['peak_memory'] = max(stats['peak_memory'], peak - frame['start'])
+        if self._stack:
+            self._stack[-1]['children'] += wall
+            if self.memory:
+                self._stack[-1]['peak'] = max(self._stack[-1]['peak'], peak)
+
+    def count(self, counter, value=1):
+        self.counters[counter] = self.counters.get(counter, 0) + value
+        if self._stack:
+            counters = self._stack[-1]['counters']
+            counters[counter] = counters.get(counter, 0) + value
+
+    def report(self):
+        # Structured report, with the functions sorted by their total time
+        functions = sorted(self.functions.items(), key=lambda item: -item[1]['wall'])
+        return {'memory': self.memory,
+                'functions': [dict(name=name, **stats) for name, stats in functions],
+                'counters': dict(self.counters)}
+
+    def to_json(self, filename=None):
+        # JSON of the report, also written to filename when given
+        text = json.dumps(self.report(), indent=1, default=int)
+        if filename != None:
+            with open(filename, 'w') as fid:
+                fid.write(text)
+        return text
+
+    def print_report(self):
+        report = self.report()
+        print('%-32s %6s %9s %9s %9s %11s' % ('function', 'calls', 'wall [s]',
+                                              'self [s]', 'cpu [s]', 'peak [MiB]'))
+        for stats in report['functions']:
+            print('%-32s %6d %9.4f %9.4f %9.4f %11s' % (
+                stats['name'], stats['calls'], stats['wall'], stats['self_wall'],
+                stats['cpu'], '%.1f' % (stats['peak_memory']/2**20)
+                if report['memory'] else '-'))
+        for counter, value in sorted(report['counters'].items()):
+            print('%-32s %d' % (counter, value))
+
+def profiled(func):
+    # Instrument a stage. It is recorded by the active profiler (see profile)
+    # or, when there is none, by the profiler of the MeetingData it receives
+    # (data.profile), which then stays active for the functions it calls.
+    # MeetingData returned while profiling get the profiler as their profile.
+    # Without a profiler the only cost is checking for one
+    name = func.__module__.rsplit('.', 1)[-1] + '.' + func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        global _ACTIVE
+        profiler = _ACTIVE
+        if profiler == None:
+            profiler = getattr(args[0], 'profile', None) if args else None
+            if profiler == None:
+                return func(*args, **kwargs)
+        previous, _ACTIVE = _ACTIVE, profiler
+        profiler._enter(name)
+        try:
+            result = func(*args, **kwargs)
+        finally:
+            profiler._exit()
+            _ACTIVE = previous
+        if isinstance(result, MeetingData) and result.profile == None:
+            result.profile = profiler
+        return result
+    return wrapper
+
+def count(counter, value=1):
+    # Add value to a counter of the running instrumented function
+    if _ACTIVE != None:
+        _ACTIVE.count(counter, value)
+
+@contextmanager
+def profile(memory=False):
+    # Profile every instrumented function called inside the block:
+    #     with profile() as profiler:
+    #         data, indicators = batch.run_session(filename)
+    #     profiler.to_json('profile.json')
+    global _ACTIVE
+    previous, _ACTIVE = _ACTIVE, Profiler(memory)
+    profiler = _ACTIVE
+    try:
+        yield profiler
+    finally:
+        _ACTIVE = previous
+        profiler.stop()
@@ -0,0 +1,212 @@
+import os
+import csv
+import time
+import hashlib
+import argparse
+import tempfile
+import itertools
+import numpy as np
+from . import vad, metrics, parallel
+from .batch import (DEFAULT_PARAMS, INDICATORS, MEMBER_INDICATORS, _params,
+                    find_logs, correlation_table)
+from .pipeline import Pipeline, STAGES, _metrics
+
+# Parameters of the stages that follow the window statistics. Grid points
+# that only differ in these share the preprocessing and the correlations
+POINT_PARAMS = tuple(param for stage in STAGES[[s.name for s in STAGES]
+                     .index('window_statistics')+1:] for param in stage.params)
+
+def grid_points(grid):
+    # Every combination of the values of a {parameter: values} grid. A list
+    # of parameter dictionaries is returned as it is
+    if isinstance(grid, dict):
+        names = list(grid)
+        return [dict(zip(names, values)) for values
+                in itertools.product(*[grid[name] for name in names])]
+    return [dict(point) for point in grid]
+
+def _max_lag(data, max_temp_shift):
+    # Same number of lags as genuine_speak and real_speak
+    sample_period = np.diff(data[data.members[0]]['time'][:2])[0]
+    return int(np.round(max_temp_shift/sample_period))
+
+# State of the worker processes, set once by _init_worker
+_STATE = {}
+
+def _init_worker(data, table):
+    _STATE.update(data=data, table=table, thresholds={})
+
+def _thresholds(data, bandwidth, method):
+    # Thresholds only depend on the genuine speech labels, which many grid
+    # points share
+    key = (hashlib.sha1(data.matrix('gen_speak').tobytes()).hexdigest(),
+           bandwidth, method)
+    if not key in _STATE['thresholds']:
+        # Members found to be beacons leave data.members
+        members = data.members
+        vad.calculate_thresholds(data, bandwidth, method)
+        _STATE['thresholds'][key] = {member: {k: data[member][k] for k in
+                                     ('thr_mean', 'thr_std', 'is_beacon')
+                                     if k in data[member].keys()}
+                                     for member in members}
+    for member, values in _STATE['thresholds'][key].items():
+        data[member].update(values)
+    return data
+
+def _fill_genuine(table, data, points, executor):
+    # Correlate here, with the jobs split among the workers, the genuine
+    # speech jobs (loudest member against the rest) of every window that is
+    # active for some point: most of the correlations of a sweep. Otherwise
+    # the workers start their first points at once and all compute them
+    num_win = len(data[data.members[0]]['win_time']) - 1
+    num_members = len(data.members)
+    points = [dict(DEFAULT_PARAMS, **point) for point in points]
+    max_lag = max(_max_lag(data, p['max_temp_shift']) for p in points)
+    means = data.matrix('win_mean')[:, :num_win]
+    loudest = np.argmax(means, axis=0)
+    max_vol = means[loudest, np.arange(num_win)]
+    global_mean = np.array([data[m]['global_mean'] for m in data.members])
+    global_std = np.array([data[m]['global_std'] for m in data.members])
+    silence_thr = np.min([(p['silence_thr_mean']*global_mean + p['silence_thr_std']
+                           *global_std)[loudest] for p in points], axis=0)
+    windows = np.where(max_vol >= silence_thr)[0]
+    others = np.tile(np.arange(num_members), (len(windows), 1))
+    others = others[others != loudest[windows][:, np.newaxis]]
+    jobs = np.column_stack((np.repeat(windows, num_members-1),
+                            np.repeat(loudest[windows], num_members-1), others))
+    table.lookup(data, jobs, max_lag, executor)
+
+def _evaluate(point):
+    # Errors are returned, so one failing point does not stop the sweep
+    try:
+        return _indicators(point)
+    except Exception as e:
+        return None, type(e).__name__ + ': ' + str(e)
+
+def _indicators(point):
+    # Indicators of one grid point from the shared window statistics and
+    # correlations, following the stages of the pipeline
+    p = dict(DEFAULT_PARAMS, **point)
+    data = _STATE['data'].copy(samples=False)
+    max_lag = _max_lag(data, p['max_temp_shift'])
+    correlate = lambda jobs: _STATE['table'].lookup(data, jobs, max_lag)
+    vad._genuine_labels(data, correlate, p['corr_thr'], p['silence_thr_mean'],
+                        p['silence_thr_std'], p['prune_similarity'])
+    _thresholds(data, p['bandwidth'], p['kde_method'])
+    vad.all_speak(data, p['threshold_by_mean'], p['threshold_by_std'])
+    vad._real_labels(data, correlate, p['corr_thr'], p['prune_similarity'])
+    _metrics(data, p['fill_gaps'], p['max_gap'], p['min_succesive_non_overlap'])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        indicators = metrics.calculate_indicators(data, print_results=False)
+    return data.members, dict(zip(INDICATORS, indicators))
+
+def sweep(filename, grid, workers=None, **params):
+    # Indicators of a log for every point of a parameter grid (see
+    # grid_points), with params as the fixed parameters. Returns one row per
+    # grid point and member. Points are grouped by their preprocessing and
+    # window parameters; each group computes the window statistics once and
+    # evaluates its points in worker processes, which share the correlations
+    # between points (and between processes and runs with corr_cache)
+    points = grid_points(grid)
+    for point in points:
+        _params(dict(params, **point))
+    session = os.path.splitext(os.path.basename(filename))[0]
+    pipe = Pipeline(filename, **params)
+    groups = {}
+    for point in points:
+        upstream = {k: v for k, v in point.items() if not k in POINT_PARAMS}
+        key = pipe.set(**dict(params, **upstream)).key('window_statistics')
+        groups.setdefault(key, (upstream, []))[1].append(point)
+    rows = []
+    for upstream, group in groups.values():
+        t0 = time.perf_counter()
+        data = pipe.run('window_statistics', **dict(params, **upstream))
+        shifts = {dict(params, **point).get('max_temp_shift',
+                  DEFAULT_PARAMS['max_temp_shift']) for point in group}
+        # All the lags of the group are correlated at once
+        max_lags = [_max_lag(data, shift) for shift in shifts]
+        group_params = dict(params, **upstream)
+        fixed = {k: v for k, v in params.items() if k in POINT_PARAMS}
+        args = [dict(fixed, **point) for point in group]
+        if workers == 1:
+            table = correlation_table(filename, max_lags, **group_params)
+            _init_worker(data, table)
+            results = [_evaluate(point) for point in args]
+        else:
+            # Workers share the table through memory-mapped files, in a
+            # temporary directory without corr_cache, so the correlations one
+            # of them computes are found by the others
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                if _params(group_params)['corr_cache'] == None:
+                    group_params['corr_cache'] = tmp_dir
+                table = correlation_table(filename, max_lags, **group_params)
+                # One pool for both, whose workers get data and table once
+                with parallel.executor(workers, _init_worker, (data, table)) as executor:
+                    _fill_genuine(table, data, args, executor)
+                    results = list(executor.map(_evaluate, args))
+        elapsed = (time.perf_counter() - t0)/len(group)
+        for point, (members, indicators) in zip(group, results):
+            if members == None:
+                rows.append(dict(point, session=session, file=filename,
+                                 member=None, elapsed=elapsed, error=indicators))
+                continue
+            for i, member in enumerate(members):
+                row = {'session': session, 'file': filename, 'member': member}
+                row.update(point)
+                for key in INDICATORS:
+                    value = indicators[key]
+                    row[key] = value[i] if key in MEMBER_INDICATORS else value
+                row['elapsed'] = elapsed
+                row['error'] = None
+                rows.append(row)
+    return rows
+
+def sweep_batch(paths, grid, workers=None, **params):
+    # Same sweep over many logs, one after the other
+    files = find_logs([paths] if isinstance(paths, str) else paths)
+    return [row for filename in files
+            for row in sweep(filename, grid, workers, **params)]
+
+def write_csv(rows, filename):
+    # Tidy table: one row per log, grid point and member
+    columns = ['session', 'file']
+    for row in rows:
+        columns.extend([key for key in row if not key in columns
+                        and not key in INDICATORS and key != 'elapsed'
+                        and key != 'error'])
+    columns += list(INDICATORS) + ['elapsed', 'error']
+    with open(filename, 'w', newline='') as fid:
+        writer = csv.DictWriter(fid, columns)
+        writer.writeheader()
+        writer.writerows(rows)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compute the indicators of '
+                                     'badge audio logs for a grid of VAD '
+                                     'parameters.')
+    parser.add_argument('paths', nargs='+', help='log files, directories or '
+                        'glob patterns')
+    parser.add_argument('-o', '--output', default='sweep.csv')
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help='number of worker processes (default: all cores)')
+    for name in ('window', 'max_temp_shift', 'corr_thr', 'silence_thr_mean',
+                 'silence_thr_std'):
+        parser.add_argument('--' + name.replace('_', '-'), type=float, nargs='+',
+                            default=[DEFAULT_PARAMS[name]])
+    parser.add_argument('--kde-method', choices=['exact', 'binned'],
+                        default=DEFAULT_PARAMS['kde_method'])
+    parser.add_argument('--align', choices=['nearest', 'linear'], default=None)
+    parser.add_argument('--corr-cache', default=None, help='directory where '
+                        'the window correlations are cached')
+    args = parser.parse_args(argv)
+
+    grid = {name: getattr(args, name) for name in ('window', 'max_temp_shift',
+            'corr_thr', 'silence_thr_mean', 'silence_thr_std')}
+    rows = sweep_batch(args.paths, grid, args.workers, kde_method=args.kde_method,
+                       align=args.align, corr_cache=args.corr_cache)
+    write_csv(rows, args.output)
+    print(len(grid_points(grid)), 'grid points of', len({row['file'] for row in rows}),
+          'sessions saved to', args.output)
+
+if __name__ == '__main__':
+    main()
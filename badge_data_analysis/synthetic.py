@@ -0,0 +1,128 @@
+import json
+import argparse
+import numpy as np
+
+# Packets of the badges: 114 samples every 50 ms
+SAMPLES_PER_PACKET = 114
+SAMPLE_PERIOD = 0.05
+
+def _mac(rng):
+    return ':'.join('%02X' % byte for byte in rng.integers(0, 256, 6))
+
+def _turns(num_members, num_samples, rng, mean_turn=4.0, mean_pause=1.5,
+           overlap=0.1):
+    # Speaking labels of a conversation at sample resolution: speakers take
+    # turns of exponential length separated by pauses, and sometimes someone
+    # else starts talking before the turn ends
+    speaking = np.zeros((num_members, num_samples), dtype=bool)
+    weights = rng.dirichlet(np.ones(num_members)*2)
+    position = 0
+    while position < num_samples:
+        speaker = rng.choice(num_members, p=weights)
+        length = int(rng.exponential(mean_turn)/SAMPLE_PERIOD) + 1
+        speaking[speaker, position:position+length] = True
+        if num_members > 1 and rng.random() < overlap:
+            other = rng.choice(np.delete(np.arange(num_members), speaker))
+            start = position + int(rng.uniform(0.5, 1)*length)
+            speaking[other, start:start+int(rng.exponential(1)/SAMPLE_PERIOD)+1] = True
+        position += length + int(rng.exponential(mean_pause)/SAMPLE_PERIOD)
+    return speaking
+
+def _signals(speaking, group, num_beacons, rng):
+    # Amplitudes recorded by every badge: its noise floor plus the voice of
+    # each speaker attenuated with the distance to it, much more for the
+    # speakers of other groups. Beacons are badges left in the room, far
+    # from everyone
+    num_members, num_samples = speaking.shape
+    num_badges = num_members + num_beacons
+    voices = speaking*rng.lognormal(3, 0.6, speaking.shape)
+    gains = rng.uniform(0.1, 0.35, (num_badges, num_members))
+    gains[:num_members][group[:, np.newaxis] != group] *= 0.1
+    gains[np.arange(num_members), np.arange(num_members)] = 1
+    gains[num_members:] *= 0.3
+    signals = gains @ voices
+    signals += rng.uniform(3, 8, (num_badges, 1))
+    signals += rng.gamma(2, 0.7, signals.shape)
+    return np.clip(np.round(signals), 0, 255).astype(np.int64)
+
+def generate(filename, num_members=4, hours=1.0, num_beacons=0, packet_loss=0.0,
+             duplicates=0.0, clock_jumps=0, seed=0, start_time=1.5e9, groups=1):
+    # Write a log in the format of the badge hub with num_members people
+    # talking for the given number of hours, split in groups that hold
+    # separate conversations in the same room (as in a classroom), plus
+    # num_beacons badges that only hear the room. A fraction packet_loss of
+    # the packets is dropped, a fraction duplicates is received twice, and
+    # clock_jumps badges start with their clock off by a large offset, until
+    # it is synchronized at a random point of the meeting.
+    # Returns the ids of the members and beacons and the speaking labels of
+    # the members at sample resolution
+    rng = np.random.default_rng(seed)
+    num_badges = num_members + num_beacons
+    num_packets = int(np.ceil(hours*3600/(SAMPLES_PER_PACKET*SAMPLE_PERIOD)))
+    num_samples = num_packets*SAMPLES_PER_PACKET
+    group = np.arange(num_members) % groups
+    speaking = np.zeros((num_members, num_samples), dtype=bool)
+    for g in range(groups):
+        speaking[group == g] = _turns(np.sum(group == g), num_samples, rng)
+    signals = _signals(speaking, group, num_beacons, rng)
+    ids = [int(i) for i in rng.permutation(np.arange(1, 3*num_badges+1))[:num_badges]]
+
+    # Every badge starts at a different time and its clock is a few ms off
+    packet_time = SAMPLES_PER_PACKET*SAMPLE_PERIOD
+    starts = start_time + rng.uniform(0, 30, num_badges)
+    skew = rng.normal(0, 0.01, num_badges)
+    jumps = np.zeros((num_badges, num_packets))
+    for badge in rng.choice(num_badges, min(clock_jumps, num_badges), replace=False):
+        jumps[badge, :rng.integers(1, num_packets)] = rng.choice([-1, 1])*rng.uniform(60, 5e4)
+
+    records = []
+    for badge, member in enumerate(ids):
+        address = _mac(rng)
+        first = int(np.ceil((starts[badge] - start_time)/packet_time))
+        for k in range(first, num_packets):
+            if rng.random() < packet_loss:
+                continue
+            timestamp = round(start_time + k*packet_time + skew[badge] + jumps[badge, k], 3)
+            samples = signals[badge, k*SAMPLES_PER_PACKET:(k+1)*SAMPLES_PER_PACKET]
+            arrival = start_time + (k+1)*packet_time + rng.exponential(2)
+            packet = {'member': address, 'badge_address': address, 'voltage': 0.0,
+                      'samples': samples.tolist(), 'num_samples': SAMPLES_PER_PACKET,
+                      'timestamp': timestamp, 'member_id': member,
+                      'sample_period': int(SAMPLE_PERIOD*1000)}
+            records.append((arrival, packet))
+            if rng.random() < duplicates:
+                records.append((arrival + rng.exponential(10), packet))
+
+    # The hub logs the packets as they arrive
+    records.sort(key=lambda record: record[0])
+    with open(filename, 'w') as fid:
+        for arrival, packet in records:
+            fid.write(json.dumps({'data': packet, 'log_timestamp': round(arrival, 3),
+                                  'type': 'audio received', 'log_index': -1}) + '\n')
+    return ids[:num_members], ids[num_members:], speaking
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Write a synthetic badge '
+                                     'audio log.')
+    parser.add_argument('output')
+    parser.add_argument('-m', '--members', type=int, default=4)
+    parser.add_argument('--hours', type=float, default=1.0)
+    parser.add_argument('-b', '--beacons', type=int, default=0)
+    parser.add_argument('-g', '--groups', type=int, default=1,
+                        help='number of separate conversations')
+    parser.add_argument('--loss', type=float, default=0.0,
+                        help='fraction of packets lost')
+    parser.add_argument('--duplicates', type=float, default=0.0,
+                        help='fraction of packets received twice')
+    parser.add_argument('--jumps', type=int, default=0,
+                        help='number of badges with a clock jump')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    members, beacons, _ = generate(args.output, args.members, args.hours, args.beacons,
+                                   args.loss, args.duplicates, args.jumps, args.seed,
+                                   groups=args.groups)
+    print('Members', members, 'and beacons', beacons, 'saved to', args.output)
+
+if __name__ == '__main__':
+    main()
@@ -1,202 +1,525 @@
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy.signal import fftconvolve
 from scipy.stats import gaussian_kde
+from . import parallel, profiling, kernels
 
-def xcorr(x, y, max_lag=None, normalize=True, eps=1e-10):
-    if len(x) > len(y):
+def _lag_padding(len_s, len_l, max_lag):
+    if max_lag == None:
+        return len_s - 1, len_s - 1, len_s + len_l - 1
+    return max_lag, max(max_lag - (len_l - len_s), 0), 2*max_lag + 1
+
+@profiling.profiled
+def batch_xcorr(x, y, max_lag=None, normalize=True, eps=1e-10):
+    # Cross-correlate each row of x with the same row of y. All the rows and 
+    # lags are computed at once from strided views of the padded signals, and
+    # the energy of every lagged segment comes from a cumulative sum
+    x, y = np.atleast_2d(x), np.atleast_2d(y)
+    profiling.count('xcorr_pairs', x.shape[0])
+    profiling.count('xcorr_samples', x.size + y.size)
+    # Compact integer signals would overflow in the products
+    if x.dtype.kind in 'ub' or x.dtype.itemsize < 8:
+        x = x.astype(np.result_type(x.dtype, np.int64))
+    if y.dtype.kind in 'ub' or y.dtype.itemsize < 8:
+        y = y.astype(np.result_type(y.dtype, np.int64))
+    if x.shape[1] > y.shape[1]:
         s, l = y, x
     else:
         s, l = x, y
-    if max_lag == None:
-        init_pad = len(s) - 1
-        end_pad = len(s) - 1
-        out_len = len(s) + len(l) - 1
-    else:
-        init_pad = max_lag
-        end_pad = np.clip(max_lag - (len(l) - len(s)), 0, None)
-        out_len = 2*max_lag + 1
-    l = np.pad(l, (init_pad, end_pad))
-    corr = np.zeros((out_len,))
-    s_energy = np.sum(s**2)
-    for lag in range(out_len):
-        corr[lag] = np.sum(l[lag:lag+len(s)]*s)
-        if normalize:
-            corr[lag] /= np.sqrt(np.sum(l[lag:lag+len(s)]**2)*s_energy + eps)
+    len_s = s.shape[1]
+    init_pad, end_pad, out_len = _lag_padding(len_s, l.shape[1], max_lag)
+    l = np.pad(l, ((0, 0), (init_pad, end_pad)))
+    segments = sliding_window_view(l, len_s, axis=1)[:, :out_len]
+    corr = np.einsum('ijk,ik->ij', segments, s).astype(float)
+    if normalize:
+        l_energy = np.zeros((l.shape[0], l.shape[1]+1), dtype=l.dtype)
+        np.cumsum(l**2, axis=1, out=l_energy[:, 1:])
+        l_energy = l_energy[:, len_s:len_s+out_len] - l_energy[:, :out_len]
+        s_energy = np.sum(s**2, axis=1)
+        corr /= np.sqrt(l_energy*s_energy[:, np.newaxis] + eps)
     return corr
 
-def genuine_speak(data, window=1.0, max_temp_shift=0.15, corr_thr=0.85, 
-                  silence_thr_mean=1.0, silence_thr_std=0.0): #min_num_samples=0.8
-    
-    # From now on the sample period it is assumed constant
-    sample_period = np.diff(data[data.members[0]]['time'][:2])[0]
-    max_corr_lag = int(np.round(max_temp_shift/sample_period))
-    
-    # Get meeting start and number of windows
+def xcorr(x, y, max_lag=None, normalize=True, eps=1e-10):
+    return batch_xcorr(x, y, max_lag, normalize, eps)[0]
+
+def _concat_pairs(x_list, y_list):
+    # Concatenated segments of pairs of signals, with the start and end of
+    # every signal, for the kernels
+    lengths = [len(x) for x in x_list] + [len(y) for y in y_list]
+    ends = np.cumsum(lengths, dtype=np.int64)
+    starts = ends - lengths
+    signal = np.concatenate(list(x_list) + list(y_list)) if lengths else np.zeros((0,))
+    n = len(x_list)
+    return signal, starts[:n], ends[:n], starts[n:], ends[n:]
+
+@profiling.profiled
+def max_xcorr(x_list, y_list, max_lag=None, normalize=True, eps=1e-10):
+    # Maximum cross-correlation of many pairs of signals. Pairs are grouped by
+    # their lengths and each group is correlated in a single batched call
+    if kernels.use_numba() and max_lag != None and normalize and len(x_list) > 0:
+        return kernels.max_corr(*_concat_pairs(x_list, y_list), [max_lag], eps)[:, 0]
+    groups = {}
+    for i, (x, y) in enumerate(zip(x_list, y_list)):
+        groups.setdefault((len(x), len(y)), []).append(i)
+    max_corr = np.zeros((len(x_list),))
+    for idx in groups.values():
+        corr = batch_xcorr(np.array([x_list[i] for i in idx]),
+                           np.array([y_list[i] for i in idx]),
+                           max_lag, normalize, eps)
+        max_corr[idx] = np.max(corr, axis=1)
+    return max_corr
+
+def _grid_window(data, window):
+    # Samples per window when the data is aligned on a grid whose period 
+    # divides the window, None otherwise
+    if data.grid_period == None:
+        return None
+    count = window/data.grid_period
+    if abs(count - np.round(count)) > 1e-6:
+        return None
+    return int(np.round(count))
+
+@profiling.profiled
+def window_index(data, window=1.0, first_window=0):
+    # Locate the samples of every window once, so that windowed stages slice
+    # the signals instead of masking them. When packets overlap in time the
+    # samples are not sorted, and 'win_order' groups them by window keeping
+    # their original order inside each window. On aligned data every window
+    # is a block of the same number of samples. With first_window, the
+    # windows before it are left out (data holds a later part of a meeting)
+    # and the rest keep the same edges
+    start_time = data.meeting_start
+    num_win = int(np.ceil((data.meeting_end - start_time)/window))
+    edges = start_time + np.arange(first_window, num_win+1)*window
+    num_win -= first_window
+    per_window = _grid_window(data, window)
+    for member in data.members:
+        time = data[member]['time']
+        if per_window != None:
+            data[member]['win_order'] = None
+            data[member]['win_idx'] = np.minimum(np.arange(num_win+1)*per_window,
+                                                 len(time))
+        elif np.all(time[1:] >= time[:-1]):
+            data[member]['win_order'] = None
+            data[member]['win_idx'] = np.searchsorted(time, edges, side='left')
+        else:
+            win = np.searchsorted(edges, time, side='right')
+            order = np.argsort(win, kind='stable')
+            data[member]['win_order'] = order
+            data[member]['win_idx'] = np.searchsorted(win[order], 
+                                                      np.arange(1, num_win+2))
+    return data
+
+def _windowed_signal(member_data):
+    # Signal arranged so that every window is a contiguous slice of it
+    if member_data['win_order'] is None:
+        return member_data['signal']
+    return member_data['signal'][member_data['win_order']]
+
+@profiling.profiled
+def window_stats(data, window=1.0, first_window=0):
+    # Mean, std and sample count of every window for all members. Windows with
+    # the same number of samples are gathered into a 2-D array and reduced 
+    # along its rows, so there is no python loop over windows. As in the VAD 
+    # loop, the last (incomplete) window is left at zero. With first_window
+    # the results start at that window (see window_index)
+    window_index(data, window, first_window)
+    num_win = len(data[data.members[0]]['win_idx']) - 1
+    win_mean = np.zeros((len(data.members), num_win))
+    win_std = np.zeros((len(data.members), num_win))
+    win_count = np.zeros((len(data.members), num_win), dtype=np.int64)
+    profiling.count('windows', len(data.members)*num_win)
+    per_window = _grid_window(data, window)
+    if per_window != None:
+        # Aligned data: reshape the sample matrices into members x windows x
+        # samples and reduce over the samples that are not missing
+        shape = (len(data.members), num_win-1, per_window)
+        length = (num_win-1)*per_window
+        blocks = data.samples('signal')[:, :length].reshape(shape)
+        valid = data.samples('valid')[:, :length].reshape(shape)
+        counts = np.sum(valid, axis=2)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if np.all(valid):
+                win_mean[:, :-1] = np.mean(blocks, axis=2)
+                win_std[:, :-1] = np.std(blocks, axis=2)
+            else:
+                win_mean[:, :-1] = np.sum(blocks, axis=2, where=valid)/counts
+                deviation = (blocks - win_mean[:, :-1, np.newaxis])**2
+                win_std[:, :-1] = np.sqrt(np.sum(deviation, axis=2, where=valid)/counts)
+        win_count[:, :-1] = counts
+        data.set_matrix('win_mean', win_mean)
+        data.set_matrix('win_std', win_std)
+        data.set_matrix('win_count', win_count)
+        return data
+    for row, member in enumerate(data.members):
+        signal = _windowed_signal(data[member])
+        bounds = data[member]['win_idx'][:num_win]
+        counts = np.diff(bounds)
+        win_count[row, :num_win-1] = counts
+        for count in np.unique(counts):
+            wins = np.where(counts == count)[0]
+            if count == 0:
+                win_mean[row, wins] = np.nan
+                win_std[row, wins] = np.nan
+                continue
+            samples = signal[bounds[wins][:, np.newaxis] + np.arange(count)]
+            win_mean[row, wins] = np.mean(samples, axis=1)
+            win_std[row, wins] = np.std(samples, axis=1)
+    data.set_matrix('win_mean', win_mean)
+    data.set_matrix('win_std', win_std)
+    data.set_matrix('win_count', win_count)
+    return data
+
+def _lag_maxima(corr, max_lags):
+    # Maximum of each row of corr, whose columns are the lags -L..L with L
+    # the largest of max_lags, within each of max_lags
+    center = (corr.shape[1] - 1)//2
+    return np.column_stack([np.max(corr[:, center-lag:center+lag+1], axis=1)
+                            for lag in max_lags])
+
+def _lag_xcorr(x_list, y_list, max_lags):
+    # Same as max_xcorr for several maximum lags at once, one column each
+    if kernels.use_numba() and len(x_list) > 0:
+        return kernels.max_corr(*_concat_pairs(x_list, y_list), max_lags)
+    groups = {}
+    for i, (x, y) in enumerate(zip(x_list, y_list)):
+        groups.setdefault((len(x), len(y)), []).append(i)
+    max_corr = np.zeros((len(x_list), len(max_lags)))
+    for idx in groups.values():
+        corr = batch_xcorr(np.array([x_list[i] for i in idx]),
+                           np.array([y_list[i] for i in idx]), max(max_lags))
+        max_corr[idx] = _lag_maxima(corr, max_lags)
+    return max_corr
+
+def _pair_max_corr(arrays, jobs, max_lag):
+    # Maximum correlation of the window pairs in jobs, whose rows are (window,
+    # member row a, member row b) into the concatenated windowed signals.
+    # With a list of maximum lags there is a column per lag
+    signal, bounds = arrays['signal'], arrays['bounds']
+    w, a, b = jobs.T
+    if kernels.use_numba():
+        max_lags = [max_lag] if np.isscalar(max_lag) else max_lag
+        corr = kernels.max_corr(signal, bounds[a, w], bounds[a, w+1], bounds[b, w],
+                                bounds[b, w+1], max_lags)
+        return corr[:, 0] if np.isscalar(max_lag) else corr
+    x = [signal[i:j] for i, j in zip(bounds[a, w], bounds[a, w+1])]
+    y = [signal[i:j] for i, j in zip(bounds[b, w], bounds[b, w+1])]
+    if np.isscalar(max_lag):
+        return max_xcorr(x, y, max_lag)
+    return _lag_xcorr(x, y, max_lag)
+
+def _block_max_corr(arrays, jobs, max_lag):
+    # Same as _pair_max_corr on aligned data, where the windows of every
+    # member are the rows of a members x windows x samples array
+    blocks = arrays['blocks']
+    w, a, b = jobs.T
+    if len(jobs) == 0:
+        return np.zeros((0,) if np.isscalar(max_lag) else (0, len(max_lag)))
+    if kernels.use_numba():
+        num_win, per_window = blocks.shape[1:]
+        x_start = (a*num_win + w)*per_window
+        y_start = (b*num_win + w)*per_window
+        max_lags = [max_lag] if np.isscalar(max_lag) else max_lag
+        corr = kernels.max_corr(blocks.reshape(-1), x_start, x_start + per_window,
+                                y_start, y_start + per_window, max_lags)
+        return corr[:, 0] if np.isscalar(max_lag) else corr
+    if np.isscalar(max_lag):
+        return np.max(batch_xcorr(blocks[a, w], blocks[b, w], max_lag), axis=1)
+    return _lag_maxima(batch_xcorr(blocks[a, w], blocks[b, w], max(max_lag)),
+                       max_lag)
+
+def _correlate_pairs(data, jobs, max_lag, executor=None):
+    # Correlate window pairs of data.members, optionally splitting the jobs
+    # in chunks of windows processed by the workers of executor (see
+    # parallel.pool) over shared memory
+    per_window = _grid_window(data, data.window_length)
+    if per_window != None:
+        num_win = data.number_of_windows - 1
+        func = _block_max_corr
+        arrays = {'blocks': data.samples('signal')[:, :num_win*per_window]
+                  .reshape((len(data.members), num_win, per_window))}
+    else:
+        signals = [_windowed_signal(data[member]) for member in data.members]
+        offsets = np.cumsum([0] + [len(signal) for signal in signals[:-1]])
+        func = _pair_max_corr
+        arrays = {'signal': np.concatenate(signals),
+                  'bounds': np.array([data[member]['win_idx'] for member 
+                                      in data.members]) + offsets[:, np.newaxis]}
+    if executor == None or len(jobs) == 0:
+        return func(arrays, jobs, max_lag)
+    corr = parallel.map_chunks(func, arrays,
+                               parallel.split(jobs, parallel.size(executor)),
+                               executor, (max_lag,))
+    return np.concatenate(corr)
+
+@profiling.profiled
+def window_statistics(data, window=1.0):
+    # Window times, global statistics and per-window statistics of every 
+    # member, the input of the VAD stages
     start_time = data.meeting_start
     end_time = data.meeting_end
     num_win = int(np.ceil((end_time - start_time)/window))
     
     # Memory alloc
     for member in data.members:
-        data[member]['gen_speak'] = np.zeros((num_win,), dtype=np.int16)
-        data[member]['win_mean'] = np.zeros((num_win,))
-        data[member]['win_std'] = np.zeros((num_win,))
         data[member]['win_time'] = np.linspace(start_time, start_time
                                                + (num_win-1)*window, num_win)
         data[member]['global_mean'] = np.mean(data[member]['signal'])
         data[member]['global_std'] = np.std(data[member]['signal'])
         data[member]['is_beacon'] = False
+    window_stats(data, window)
+    return data
+
+@profiling.profiled
+def genuine_speak(data, window=1.0, max_temp_shift=0.15, corr_thr=0.85, 
+                  silence_thr_mean=1.0, silence_thr_std=0.0, workers=1,
+                  correlations=None, prune_similarity=None): #min_num_samples=0.8
+    window_statistics(data, window)
+    return label_genuine(data, max_temp_shift, corr_thr, silence_thr_mean,
+                         silence_thr_std, workers, correlations, prune_similarity)
+
+def _correlate(data, max_temp_shift, executor=None, correlations=None):
+    # Function giving the correlations of window pairs, computed or looked up
+    # in a correlations.CorrelationTable
+    
+    # From now on the sample period it is assumed constant
+    sample_period = np.diff(data[data.members[0]]['time'][:2])[0]
+    max_corr_lag = int(np.round(max_temp_shift/sample_period))
+    if correlations == None:
+        return lambda jobs: _correlate_pairs(data, jobs, max_corr_lag, executor)
+    return lambda jobs: correlations.lookup(data, jobs, max_corr_lag, executor)
+
+@profiling.profiled
+def label_genuine(data, max_temp_shift=0.15, corr_thr=0.85, silence_thr_mean=1.0,
+                  silence_thr_std=0.0, workers=1, correlations=None,
+                  prune_similarity=None):
+    # Genuine speech labels from the statistics of window_statistics. workers
+    # is a number of processes or an executor shared with other runs (see
+    # parallel.pool)
+    with parallel.pool(workers) as executor:
+        correlate = _correlate(data, max_temp_shift, executor, correlations)
+        return _genuine_labels(data, correlate, corr_thr, silence_thr_mean,
+                               silence_thr_std, prune_similarity)
+
+def pair_similarity(data):
+    # Similarity of the loudness envelopes of every pair of members: the
+    # correlation of their window means over the whole meeting. Badges close
+    # to each other hear the same voices and their envelopes follow each
+    # other, while those of badges in different groups do not
+    means = data.matrix('win_mean')[:, :-1]
+    valid = np.isfinite(means)
+    centered = np.where(valid, means - np.nanmean(np.where(valid, means, np.nan),
+                                                  axis=1, keepdims=True), 0)
+    norm = np.sqrt(np.sum(centered**2, axis=1))
+    return (centered @ centered.T)/(np.outer(norm, norm) + 1e-10)
+
+def _early_exit_corr(jobs, per_window, correlate, similarity, corr_thr):
+    # Correlations of the jobs of _genuine_labels, per_window consecutive
+    # rows for the other members of every window, as far as needed to tell
+    # whether all of them reach corr_thr. The least similar pair of each
+    # window, the most likely to fail, is correlated first and the rest only
+    # in the windows it did not rule out. Correlations left out are -inf
+    corr = np.full((len(jobs),), -np.inf)
+    sim = similarity[jobs[:, 1], jobs[:, 2]].reshape((-1, per_window))
+    first = np.argmin(sim, axis=1)
+    idx = np.arange(len(sim))*per_window + first
+    corr[idx] = correlate(jobs[idx])
+    undecided = ~(corr[idx] < corr_thr)
+    rest = np.zeros(sim.shape, dtype=bool)
+    rest[undecided] = True
+    rest[np.arange(len(sim)), first] = False
+    rest = np.where(rest.ravel())[0]
+    corr[rest] = correlate(jobs[rest])
+    profiling.count('correlated_pairs', len(idx) + len(rest))
+    return corr
+
+def _genuine_labels(data, correlate, corr_thr=0.85, silence_thr_mean=1.0,
+                    silence_thr_std=0.0, prune_similarity=None):
+    # correlate(jobs) gives the maximum correlation of every (window, member
+    # row, member row) job, see _correlate_pairs. With prune_similarity the
+    # pairs are correlated in two rounds (see _early_exit_corr), which gives
+    # the same labels. Pairs are not pruned here: the correlation of badges
+    # that hear different voices is still high in quiet windows
+    num_win = len(data[data.members[0]]['win_time'])
+    
+    # Loudest member of each window. Windows where it is below its silence
+    # level are skipped to avoid false detections when there is silence
+    means = data.matrix('win_mean')[:, :num_win-1]
+    loudest_idx = np.argmax(means, axis=0)
+    global_mean = np.array([data[m]['global_mean'] for m in data.members])
+    global_std = np.array([data[m]['global_std'] for m in data.members])
+    silence_thr = silence_thr_mean*global_mean + silence_thr_std*global_std
+    max_vol = means[loudest_idx, np.arange(num_win-1)]
+    active = np.where(max_vol >= silence_thr[loudest_idx])[0]
+    profiling.count('silent_windows', num_win - 1 - len(active))
+    
+    # Correlate the loudest member against the rest in every active window
+    num_members = len(data.members)
+    others = np.tile(np.arange(num_members), (len(active), 1))
+    others = others[others != loudest_idx[active][:, np.newaxis]]
+    jobs = np.column_stack((np.repeat(active, num_members-1),
+                            np.repeat(loudest_idx[active], num_members-1),
+                            others))
+    if prune_similarity != None and len(jobs) > 0:
+        corr = _early_exit_corr(jobs, num_members-1, correlate, pair_similarity(data),
+                                corr_thr)
+    else:
+        profiling.count('correlated_pairs', len(jobs))
+        corr = correlate(jobs)
     
     # Genuine Speak
-    for w_i in range(num_win-1):
-        genuine = True
-        win_start, win_end = (start_time+w_i*window, start_time+(w_i+1)*window)
-        for member in data.members:
-            idx = np.logical_and(data[member]['time'] >= win_start,
-                                   data[member]['time'] < win_end)
-            data[member]['win_mean'][w_i] = np.mean(data[member]['signal'][idx])
-            data[member]['win_std'][w_i] = np.std(data[member]['signal'][idx])
-        
-        means = np.array([data[mem]['win_mean'][w_i] for mem in data.members])
-        max_vol = np.max(means)
-        max_vol_mem = data.members[np.where(means == max_vol)[0][0]]
-        
-        # This is to avoid false detections when there is silence
-        if max_vol < (silence_thr_mean*data[max_vol_mem]['global_mean'] 
-                      + silence_thr_std*data[max_vol_mem]['global_std']):
-            continue
-        
-        w_idx_max = np.logical_and(data[max_vol_mem]['time'] >= win_start,
-                                   data[max_vol_mem]['time'] < win_end)
-        for member in data.members:
-            if member == max_vol_mem:
-                continue
-            idx = np.logical_and(data[member]['time'] >= win_start,
-                                   data[member]['time'] < win_end)
-            corr = np.max(xcorr(data[max_vol_mem]['signal'][w_idx_max], 
-                                data[member]['signal'][idx], max_corr_lag))
-            if corr < corr_thr:
-                genuine = False
-                break
-        if genuine:
-            for member in data.members:
-                if member == max_vol_mem:
-                    data[member]['gen_speak'][w_i] = 1
-                else:
-                    data[member]['gen_speak'][w_i] = -1
+    genuine = np.setdiff1d(active, jobs[corr < corr_thr, 0])
+    gen_speak = np.zeros((num_members, num_win), dtype=np.int16)
+    gen_speak[:, genuine] = -1
+    gen_speak[loudest_idx[genuine], genuine] = 1
+    data.set_matrix('gen_speak', gen_speak)
+    # The densities estimated from the previous labels are no longer valid
+    for member in data.members:
+        data[member].pop('kde', None)
     return data
 
-def _positive_kde(member_data, key, bandwidth=None, xi_max=60, step=0.1):
+def _binned_kde(values, xi, bandwidth=None, weights=None):
+    # Gaussian KDE with the bandwidth of gaussian_kde, evaluated at xi and -xi
+    # (xi must be a regular grid starting at 0). The values are linearly
+    # binned on the grid and convolved with the kernel, so the cost does not
+    # depend on the number of windows
+    sigma = np.sqrt(gaussian_kde(values, bw_method=bandwidth,
+                                 weights=weights).covariance[0, 0])
+    weights = np.ones(len(values)) if weights is None else np.asarray(weights)
+    step = xi[1] - xi[0]
+    half = int(np.ceil(6*sigma/step))
+    # Grid from -xi[-1] to xi[-1] with half kernel widths on both sides
+    lo = -(len(xi) - 1) - half
+    size = 2*(len(xi) - 1 + half) + 1
+    pos = np.asarray(values)/step - lo
+    keep = np.logical_and(pos >= 0, pos < size - 1)
+    idx = np.floor(pos[keep]).astype(np.int64)
+    frac = pos[keep] - idx
+    counts = np.bincount(idx, weights[keep]*(1 - frac), minlength=size)
+    counts += np.bincount(idx + 1, weights[keep]*frac, minlength=size)
+    kernel = np.exp(-0.5*(np.arange(-half, half+1)*step/sigma)**2)
+    kernel /= np.sqrt(2*np.pi)*sigma*np.sum(weights)
+    density = np.clip(fftconvolve(counts, kernel, mode='valid'), 0, None)
+    # density goes from -xi[-1] to xi[-1]
+    return density[len(xi)-1:] + density[len(xi)-1::-1]
+
+def _positive_kde(member_data, key, bandwidth=None, xi_max=60, step=0.1,
+                  method='exact'):
     xi = np.arange(0, xi_max, step)
+    speak = member_data[key][member_data['gen_speak'] > 0]
+    silen = member_data[key][member_data['gen_speak'] < 0]
+    profiling.count('kde_fits', 2)
+    profiling.count('kde_samples', len(speak) + len(silen))
+    if method == 'binned':
+        return xi, _binned_kde(speak, xi, bandwidth), _binned_kde(silen, xi, bandwidth)
+    if method != 'exact':
+        raise ValueError('Unknown KDE method: ' + str(method))
     if bandwidth == None:
-        kde_speak = gaussian_kde(member_data[key][member_data['gen_speak'] > 0])
-        kde_silen = gaussian_kde(member_data[key][member_data['gen_speak'] < 0])
+        kde_speak = gaussian_kde(speak)
+        kde_silen = gaussian_kde(silen)
     else:
-        kde_speak = gaussian_kde(member_data[key][member_data['gen_speak'] > 0],
-                                 bw_method=bandwidth)
-        kde_silen = gaussian_kde(member_data[key][member_data['gen_speak'] < 0],
-                                 bw_method=bandwidth)
+        kde_speak = gaussian_kde(speak, bw_method=bandwidth)
+        kde_silen = gaussian_kde(silen, bw_method=bandwidth)
     f_speak = kde_speak(xi) + kde_speak(-xi)
     f_silen = kde_silen(xi) + kde_silen(-xi)
     return xi, f_speak, f_silen
 
-def _detect_thr(member_data, key, bandwidth=None):
-    xi, f_speak, f_silen = _positive_kde(member_data, key, bandwidth)
-    
+@profiling.profiled
+def densities(member_data, key, bandwidth=None, method='exact'):
+    # Speaking and silence densities of a window statistic. They are kept in
+    # member_data['kde'] so plotting reuses the ones used for the thresholds
+    cache = member_data['kde'] if 'kde' in member_data.keys() else {}
+    if not (key, bandwidth, method) in cache:
+        cache[(key, bandwidth, method)] = _positive_kde(member_data, key,
+                                                        bandwidth, method=method)
+        member_data['kde'] = cache
+    return cache[(key, bandwidth, method)]
+
+def _crossing(xi, f_speak, f_silen, interpolate=False):
+    # First point where f_speak goes above f_silen, after f_silen has been 
+    # above f_speak (sometimes f_speak starts being the largest). With 
+    # interpolate, the crossing is found between the grid points
     intersection = 0
-    intersection_found = None
-    for idx in range(len(xi)):
-        if intersection_found == None: # Esto es porque a veces empieza siendo más grande f_speak
-            if f_silen[idx] > f_speak[idx]:
-                intersection_found = False
-            continue
-        if f_speak[idx] > f_silen[idx]:
-            intersection = xi[idx]
-            intersection_found = True
-            break
-        
-    if not intersection_found:
+    above = np.where(f_silen > f_speak)[0]
+    crossings = np.where(f_speak > f_silen)[0]
+    if len(above) > 0:
+        crossings = crossings[crossings > above[0]]
+    if len(above) == 0 or len(crossings) == 0:
         print('Intersection between silent and speaking histograms not found')
-        
+        return intersection
+    idx = crossings[0]
+    intersection = xi[idx]
+    if interpolate:
+        d = f_speak[idx-1:idx+1] - f_silen[idx-1:idx+1]
+        intersection = xi[idx-1] + (xi[idx] - xi[idx-1])*d[0]/(d[0] - d[1])
     return intersection
 
-def calculate_thresholds(data, bandwidth=None):
+def _detect_thr(member_data, key, bandwidth=None, method='exact'):
+    xi, f_speak, f_silen = densities(member_data, key, bandwidth, method)
+    return _crossing(xi, f_speak, f_silen, interpolate=method == 'binned')
+
+@profiling.profiled
+def calculate_thresholds(data, bandwidth=None, method='exact'):
+    # method='binned' estimates the densities on a grid (much faster on long 
+    # sessions) and interpolates the crossing between grid points
     for member in data.members:
         if np.any(data[member]['gen_speak'] > 0):
-            data[member]['thr_mean'] = _detect_thr(data[member], 'win_mean', bandwidth)
-            data[member]['thr_std'] = _detect_thr(data[member], 'win_std', bandwidth)
+            data[member]['thr_mean'] = _detect_thr(data[member], 'win_mean', bandwidth, method)
+            data[member]['thr_std'] = _detect_thr(data[member], 'win_std', bandwidth, method)
             # print('Member', member, 'mean thr:', np.round(data[member]['thr_mean'],2))
             # print('Member', member, 'std  thr:', np.round(data[member]['thr_std'],2))
         else:
             data[member]['is_beacon'] = True
     return data
 
+@profiling.profiled
 def all_speak(data, threshold_by_mean=True, threshold_by_std=True):
-    for member in data.members:
-        data[member]['all_speak'] = np.zeros((data.number_of_windows,), dtype=np.int16)
-        if threshold_by_mean:
-            idx = data[member]['win_mean'] > data[member]['thr_mean']
-            data[member]['all_speak'][idx] = 1
-        if threshold_by_std:
-            idx = data[member]['win_std'] > data[member]['thr_std']
-            data[member]['all_speak'][idx] = 1
+    speak = np.zeros((len(data.members), data.number_of_windows), dtype=np.int16)
+    if threshold_by_mean:
+        thr = np.array([[data[member]['thr_mean']] for member in data.members])
+        speak[data.matrix('win_mean', data.members) > thr] = 1
+    if threshold_by_std:
+        thr = np.array([[data[member]['thr_std']] for member in data.members])
+        speak[data.matrix('win_std', data.members) > thr] = 1
+    data.set_matrix('all_speak', speak)
     return data
 
-def real_speak(data, corr_thr=0.85, max_temp_shift=0.15):
-    for member in data.members:
-        data[member]['real_speak'] = np.logical_and(data[member]['all_speak'],
-                                                    data[member]['gen_speak'] >= 0)
-            
-    sample_period = np.diff(data[data.members[0]]['time'][:2])[0]
-    max_corr_lag = int(np.round(max_temp_shift/sample_period))
-    num_win = len(data[data.members[0]]['real_speak'])
-    for w in range(num_win-1):
-        speaking = [bool(data[m]['real_speak'][w]) for m in data.members]
-        num_speaking = np.sum(speaking)
-        if num_speaking >= 2:
-            speaking_members = np.array(data.members)[speaking]
-            win_start = data[speaking_members[0]]['win_time'][w]
-            win_end = data[speaking_members[0]]['win_time'][w+1]
-            for i in range(num_speaking-1):
-                for j in range(i+1, num_speaking):
-                    data_i = data[speaking_members[i]]
-                    data_j = data[speaking_members[j]]
-                    idx_i = np.logical_and(data_i['time'] >= win_start,
-                                           data_i['time'] < win_end)
-                    idx_j = np.logical_and(data_j['time'] >= win_start,
-                                           data_j['time'] < win_end)
-                    corr = np.max(xcorr(data_i['signal'][idx_i], 
-                                        data_j['signal'][idx_j], max_corr_lag))
-                    if corr > corr_thr:
-                        if data_i['win_mean'][w] > data_j['win_mean'][w]:
-                            data_j['real_speak'][w] = 0
-                        else:
-                            data_i['real_speak'][w] = 0
+@profiling.profiled
+def real_speak(data, corr_thr=0.85, max_temp_shift=0.15, workers=1,
+               correlations=None, prune_similarity=None):
+    if not 'win_idx' in data[data.members[0]].keys():
+        window_index(data, data.window_length)
+    with parallel.pool(workers) as executor:
+        correlate = _correlate(data, max_temp_shift, executor, correlations)
+        return _real_labels(data, correlate, corr_thr, prune_similarity)
+
+def _real_labels(data, correlate, corr_thr=0.85, prune_similarity=None):
+    # correlate(jobs) as in _genuine_labels. With prune_similarity, pairs of
+    # members less similar than it (see pair_similarity) are not correlated
+    data.set_matrix('real_speak', np.logical_and(data.matrix('all_speak'),
+                                                 data.matrix('gen_speak') >= 0))
+    
+    # Every pair of members speaking in the same window, by (i, j, window)
+    labels = data.matrix('real_speak')
+    num_win = labels.shape[1]
+    speaking = labels[:, :num_win-1].astype(bool)
+    if prune_similarity != None:
+        similar = pair_similarity(data) >= prune_similarity
+    jobs = []
+    for i in range(len(data.members)-1):
+        both = np.logical_and(speaking[i], speaking[i+1:])
+        if prune_similarity != None:
+            both[~similar[i, i+1:]] = False
+        j, w = np.nonzero(both)
+        jobs.append(np.column_stack((w, np.full(len(w), i), j + i + 1)))
+    jobs = np.vstack(jobs) if jobs else np.zeros((0, 3), dtype=np.int64)
+    profiling.count('correlated_pairs', len(jobs))
+    corr = correlate(jobs)
+    
+    # When two speakers are correlated, only the loudest one is speaking
+    w, i, j = jobs[corr > corr_thr].T
+    means = data.matrix('win_mean')
+    quiet = np.where(means[i, w] > means[j, w], j, i)
+    labels[quiet, w] = 0
+    data.set_matrix('real_speak', labels)
     return data
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
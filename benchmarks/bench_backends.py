@@ -0,0 +1,44 @@
+''' Run the sessions with the NumPy and the numba backends (see
+badge_data_analysis.kernels), check that both give the same labels and
+indicators, and time the stages that use the kernels.
+
+Usage: python -m benchmarks.bench_backends [log files or directories]
+'''
+import sys
+import numpy as np
+from badge_data_analysis import batch, kernels, profiling
+
+STAGES = ('vad.label_genuine', 'vad.real_speak', 'metrics.overlap_count',
+          'metrics.turn_taking')
+KEYS = ('gen_speak', 'all_speak', 'real_speak')
+
+def run(filename, backend, **params):
+    with kernels.using(backend), profiling.profile() as profiler:
+        data, indicators = batch.run_session(filename, **params)
+    times = {f['name']: f['wall'] for f in profiler.report()['functions']}
+    return data, indicators, times
+
+if __name__ == '__main__':
+    files = batch.find_logs(sys.argv[1:] or ['data'])
+    # The first call of every kernel compiles it
+    run(files[-1], 'numba')
+    mismatches = 0
+    print('%-32s %-8s %10s %10s  same' % ('session', 'align', 'numpy [s]', 'numba [s]'))
+    for filename in files:
+        for align in [None, 'nearest', 'linear']:
+            try:
+                results = [run(filename, backend, align=align)
+                           for backend in kernels.BACKENDS]
+            except ValueError as e:
+                print('%-32s %-8s failed: %s' % (filename[-32:], align, e))
+                continue
+            (data, ind, times), (data_nb, ind_nb, times_nb) = results
+            same = all(np.array_equal(data.matrix(key), data_nb.matrix(key))
+                       for key in KEYS)
+            same = same and all(np.array_equal(ind[key], ind_nb[key], equal_nan=True)
+                                for key in ind)
+            mismatches += not same
+            print('%-32s %-8s %10.3f %10.3f  %s' % (
+                filename[-32:], align, sum(times.get(s, 0) for s in STAGES),
+                sum(times_nb.get(s, 0) for s in STAGES), same))
+    print('Sessions with different results:', mismatches)
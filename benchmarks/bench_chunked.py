@@ -0,0 +1,58 @@
+''' Analyse a long synthetic log in memory and in chunks, each in a fresh
+process, and report the time and the peak resident memory of both. Checks
+that the chunked labels and indicators are the same as in memory.
+
+Usage: python -m benchmarks.bench_chunked [hours] [members] [chunk seconds]
+'''
+import os
+import sys
+import time
+import resource
+import tempfile
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from badge_data_analysis import batch, chunked, synthetic
+
+def run(mode, filename, chunk_sec):
+    # Time, peak RSS [MiB] and results of one mode in this process
+    t0 = time.perf_counter()
+    if mode == 'imports':
+        data, indicators = None, None
+    elif mode == 'chunked':
+        data, indicators = chunked.run_session(filename, chunk_sec)
+    else:
+        data, indicators = batch.run_session(filename)
+    elapsed = time.perf_counter() - t0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024
+    labels = None if data == None else data.matrix('real_speak')
+    return elapsed, peak, labels, indicators
+
+def in_process(func, *args):
+    # Run in a fresh process. The peak RSS of a process starts from the one of
+    # its parent, so the parent does not generate the log either
+    with ProcessPoolExecutor(1, mp_context=get_context('spawn')) as executor:
+        return executor.submit(func, *args).result()
+
+def same(a, b):
+    return all(np.allclose(a[key], b[key], equal_nan=True) for key in batch.INDICATORS)
+
+if __name__ == '__main__':
+    hours = float(sys.argv[1]) if len(sys.argv) > 1 else 4
+    members = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    chunk_sec = float(sys.argv[3]) if len(sys.argv) > 3 else 600
+    filename = os.path.join(tempfile.mkdtemp(), 'meeting.txt')
+    in_process(synthetic.generate, filename, members, hours, 0, 0.0, 0.01, 2)
+    print('%d members, %g h, log of %.0f MiB' % (members, hours,
+                                                   os.path.getsize(filename)/2**20))
+    _, base, _, _ = in_process(run, 'imports', filename, chunk_sec)
+    results = {}
+    print('mode       time [s]  peak RSS [MiB]  above imports [MiB]')
+    for mode in ['in_memory', 'chunked']:
+        results[mode] = in_process(run, mode, filename, chunk_sec)
+        elapsed, peak, _, _ = results[mode]
+        print('%-9s  %8.1f  %14.0f  %19.0f' % (mode, elapsed, peak, peak - base))
+    (_, _, labels, indicators), (_, _, c_labels, c_indicators) = results.values()
+    print('same labels:', np.array_equal(labels, c_labels),
+          ' same indicators:', same(indicators, c_indicators))
+    os.remove(filename)
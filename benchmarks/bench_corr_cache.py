@@ -0,0 +1,41 @@
+''' Time the correlating stages (genuine_speak and real_speak) without a
+correlation cache, with an empty one and with a filled one, for several
+corr_thr values.
+
+Usage: python -m benchmarks.bench_corr_cache [log file] [cache directory]
+'''
+import sys
+import time
+import shutil
+import tempfile
+from badge_data_analysis import preprocessing, vad
+from badge_data_analysis.batch import correlation_table
+
+def correlating_stages(data, corr_thr, table):
+    data = data.copy(samples=False)
+    t0 = time.perf_counter()
+    vad.label_genuine(data, corr_thr=corr_thr, correlations=table)
+    t1 = time.perf_counter()
+    vad.calculate_thresholds(data)
+    vad.all_speak(data)
+    t2 = time.perf_counter()
+    vad.real_speak(data, corr_thr, correlations=table)
+    return t1 - t0 + time.perf_counter() - t2
+
+if __name__ == '__main__':
+    filename = sys.argv[1] if len(sys.argv) > 1 else 'data/audio_data_session_4.txt'
+    cache_dir = sys.argv[2] if len(sys.argv) > 2 else tempfile.mkdtemp()
+    data = preprocessing.read_file(filename)
+    preprocessing.fix_time_jumps(data)
+    preprocessing.truncate(data)
+    preprocessing.remove_offset(data)
+    vad.window_statistics(data)
+    print('corr_thr  no cache [s]  empty cache [s]  filled cache [s]')
+    for corr_thr in [0.75, 0.8, 0.85, 0.9]:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        times = [correlating_stages(data, corr_thr, None)]
+        for run in range(2):
+            table = correlation_table(filename, corr_cache=cache_dir)
+            times.append(correlating_stages(data, corr_thr, table))
+        print('%8.2f  %12.3f  %15.3f  %16.3f' % ((corr_thr,) + tuple(times)))
+    shutil.rmtree(cache_dir, ignore_errors=True)
@@ -0,0 +1,40 @@
+''' Replay logs to an in-process ingestion server from a growing number of
+concurrent hubs, as fast as the server takes them, and report the throughput
+and the latency of the acknowledgements. Checks that every session received
+the same data as read_file gives for its log.
+
+Usage: python -m benchmarks.bench_ingest [log file] [--unix]
+'''
+import os
+import sys
+import asyncio
+import tempfile
+import numpy as np
+from badge_data_analysis import ingest, preprocessing
+
+async def run(filename, hubs, path=None):
+    server = ingest.IngestServer()
+    port = await server.start(port=None if path else 0, path=path)
+    summary = await ingest.load_test([filename], hubs, port=port, path=path)
+    await server.close()
+    expected = preprocessing.read_file(filename)
+    same = True
+    for name in server.sessions:
+        data = server.meeting_data(name)
+        same = same and list(data.members) == list(expected.members) and all(
+            np.array_equal(data[m]['time'], expected[m]['time']) and
+            np.array_equal(data[m]['signal'], expected[m]['signal']) for m in expected.members)
+    return summary, same
+
+if __name__ == '__main__':
+    args = [a for a in sys.argv[1:] if a != '--unix']
+    filename = args[0] if args else 'data/audio_data_session_4.txt'
+    path = os.path.join(tempfile.mkdtemp(), 'ingest.sock') if '--unix' in sys.argv else None
+    print('hubs  packets/s  p50 [ms]  p99 [ms]  max [ms]  same')
+    for hubs in [1, 2, 4, 8, 16]:
+        summary, same = asyncio.run(run(filename, hubs, path))
+        if path != None and os.path.exists(path):
+            os.remove(path)
+        print('%4d  %9.0f  %8.1f  %8.1f  %8.1f  %s' % (
+            hubs, summary['lines_per_sec'], 1e3*summary['latency_p50'],
+            1e3*summary['latency_p99'], 1e3*summary['latency_p100'], same))
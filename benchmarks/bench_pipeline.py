@@ -0,0 +1,28 @@
+''' Time a sweep over corr_thr and window with batch.run_session against the
+memoized Pipeline.
+
+Usage: python -m benchmarks.bench_pipeline [log file]
+'''
+import sys
+import time
+import numpy as np
+from badge_data_analysis.batch import run_session
+from badge_data_analysis.pipeline import Pipeline
+
+SWEEP = [{'window': window, 'corr_thr': corr_thr} for window in [1.0, 2.0]
+         for corr_thr in [0.75, 0.8, 0.85, 0.9]]
+
+if __name__ == '__main__':
+    filename = sys.argv[1] if len(sys.argv) > 1 else 'data/audio_data_session_0.txt'
+    t0 = time.perf_counter()
+    reference = [run_session(filename, **params)[1] for params in SWEEP]
+    t1 = time.perf_counter()
+    pipe = Pipeline(filename)
+    results = [pipe.indicators(**params) for params in SWEEP]
+    t2 = time.perf_counter()
+    same = all(np.allclose(a[key], b[key], equal_nan=True) for a, b 
+               in zip(reference, results) for key in a)
+    print(len(SWEEP), 'parameter sets')
+    print('run_session [s]  pipeline [s]  speedup  same')
+    print('%15.2f  %12.2f  %6.1fx  %4s' % (t1-t0, t2-t1, (t1-t0)/(t2-t1), same))
+    print('Stage runs:', pipe.runs)
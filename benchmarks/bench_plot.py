@@ -0,0 +1,30 @@
+''' Time building and drawing the signal and VAD figures of a session, with
+and without the min/max decimation of the signals.
+
+Usage: python -m benchmarks.bench_plot [log file]
+'''
+import sys
+import time
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+from badge_data_analysis import batch, plot
+
+if __name__ == '__main__':
+    filename = sys.argv[1] if len(sys.argv) > 1 else 'data/audio_data_session_4.txt'
+    data, _ = batch.run_session(filename)
+    print('figure   decimate  build [s]  draw [s]  zoomed draw [s]')
+    for name, func in [('signals', plot.signals), ('vad', plot.vad)]:
+        for decimate in [False, True]:
+            t0 = time.perf_counter()
+            fig, axes = func(data, decimate=decimate)
+            t1 = time.perf_counter()
+            fig.canvas.draw()
+            t2 = time.perf_counter()
+            start = axes[0].get_xlim()[0]
+            axes[0].set_xlim(start, start + 60/86400)
+            fig.canvas.draw()
+            t3 = time.perf_counter()
+            plt.close(fig)
+            print('%-7s  %8s  %9.3f  %8.3f  %15.3f' % (name, decimate, t1 - t0,
+                                                    t2 - t1, t3 - t2))
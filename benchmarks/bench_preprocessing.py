@@ -0,0 +1,75 @@
+''' Peak memory and time of truncate and remove_offset, compared with the
+previous versions (boolean masks, copies and float padding).
+
+Usage: python -m benchmarks.bench_preprocessing [hours] [members]
+'''
+import sys
+import time
+import tracemalloc
+import numpy as np
+from badge_data_analysis import preprocessing
+from badge_data_analysis.meeting_data import MeetingData
+
+SAMPLE_PERIOD = 0.05
+
+def truncate_copy(data):
+    # Previous implementation
+    for member in data.members:
+        indices = np.logical_and(data[member]['time'] >= data.meeting_start,
+                                 data[member]['time'] <= data.meeting_end)
+        data[member]['signal'] = data[member]['signal'][indices]
+        data[member]['time'] = data[member]['time'][indices]
+        if data[member]['time'][0] - data.meeting_start > 1:
+            time_missing = np.arange(data.meeting_start, data[member]['time'][0], data.sample_period)
+            data[member]['time'] = np.hstack((time_missing, data[member]['time']))
+            signal_missing = np.zeros(time_missing.shape)
+            data[member]['signal'] = np.hstack((signal_missing, data[member]['signal']))
+            data[member]['valid'] = np.arange(len(data[member]['signal'])) >= len(time_missing)
+    return data
+
+def remove_offset_copy(data, percentile=1):
+    # Previous implementation
+    for member in data.members:
+        offset = int(np.percentile(data[member]['signal'], percentile))
+        data[member]['signal'] -= offset
+        data[member]['signal'] = np.clip(data[member]['signal'], 0, None)
+    return data
+
+def session(hours, num_members, dtype, rng):
+    # Members start a few seconds apart and the last one misses its first
+    # minute, so it has to be padded
+    data = MeetingData()
+    num_samples = int(hours*3600/SAMPLE_PERIOD)
+    for member in range(num_members):
+        time = 1.5e9 + rng.uniform(0, 5) + SAMPLE_PERIOD*np.arange(num_samples)
+        if member == num_members - 1:
+            time = np.hstack((time[:1] - 5, time[1200:]))
+        signal = rng.integers(0, 120, len(time)).astype(dtype)
+        data[member] = {'time': time, 'signal': signal}
+    return data
+
+def measure(func, data):
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    func(data)
+    elapsed = time.perf_counter() - t0
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak/2**20
+
+if __name__ == '__main__':
+    hours = float(sys.argv[1]) if len(sys.argv) > 1 else 2
+    num_members = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    rng = np.random.default_rng(0)
+    before = session(hours, num_members, np.int64, rng)
+    after = session(hours, num_members, np.uint8, np.random.default_rng(0))
+    print(hours, 'hours,', num_members, 'members')
+    print('stage           before [s]  after [s]  before [MiB]  after [MiB]')
+    for name, old, new in [('truncate', truncate_copy, preprocessing.truncate),
+                           ('remove_offset', remove_offset_copy, preprocessing.remove_offset)]:
+        t_old, m_old = measure(old, before)
+        t_new, m_new = measure(new, after)
+        print('%-14s  %10.3f  %9.3f  %12.1f  %11.1f' % (name, t_old, t_new, m_old, m_new))
+    same = all(np.array_equal(before[m]['signal'], after[m]['signal'])
+               for m in before.members)
+    print('Same signals:', same)
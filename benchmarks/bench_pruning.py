@@ -0,0 +1,41 @@
+''' Compare the exhaustive pair correlations of genuine_speak and real_speak
+with the scalable mode (prune_similarity) on synthetic meetings of growing
+size: time, correlated pairs and the fraction of labels that change.
+
+Usage: python -m benchmarks.bench_pruning [prune_similarity] [hours]
+'''
+import os
+import sys
+import time
+import tempfile
+import numpy as np
+from badge_data_analysis import synthetic, batch, profiling
+
+def run(filename, prune_similarity):
+    with profiling.profile() as profiler:
+        t0 = time.perf_counter()
+        data, indicators = batch.run_session(filename, kde_method='binned',
+                                             prune_similarity=prune_similarity)
+        elapsed = time.perf_counter() - t0
+    return data, elapsed, profiler.counters['correlated_pairs']
+
+if __name__ == '__main__':
+    prune_similarity = float(sys.argv[1]) if len(sys.argv) > 1 else 0.2
+    hours = float(sys.argv[2]) if len(sys.argv) > 2 else 1.0
+    print('members  exhaustive [s]  pairs  scalable [s]  pairs  gen_speak diff  '
+          'real_speak diff')
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for members in [4, 8, 16, 24, 32]:
+            filename = os.path.join(tmp_dir, 'meeting.txt')
+            synthetic.generate(filename, members, hours, seed=members)
+            try:
+                exhaustive, t_exh, pairs_exh = run(filename, None)
+                scalable, t_sc, pairs_sc = run(filename, prune_similarity)
+            except ValueError as e:
+                # Too few genuine windows to estimate the thresholds
+                print('%7d  failed: %s' % (members, e))
+                continue
+            diff = [np.mean(scalable.matrix(key) != exhaustive.matrix(key))
+                    for key in ('gen_speak', 'real_speak')]
+            print('%7d  %14.3f  %5d  %12.3f  %5d  %14.4f  %15.4f' % (
+                members, t_exh, pairs_exh, t_sc, pairs_sc, diff[0], diff[1]))
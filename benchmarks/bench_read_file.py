@@ -0,0 +1,57 @@
+''' Compare the streaming log parser against the original list-based one.
+
+Usage: python -m benchmarks.bench_read_file [log_file]
+'''
+import sys
+import json
+import time
+import numpy as np
+from badge_data_analysis import preprocessing
+from badge_data_analysis.meeting_data import MeetingData
+
+def read_file_lists(filename, excluded_members=[]):
+    # Original implementation: python lists and O(n) dedup per packet. The
+    # lists are kept in plain dicts, since the rows of a MeetingData are
+    # arrays, and converted at the end
+    lists = {}
+    with open(filename, 'r') as fid:
+        for line in fid.readlines():
+            packet = json.loads(line)
+            member = packet['data']['member_id']
+            if member in excluded_members:
+                continue
+            ts = packet['data']['timestamp']
+            sp = packet['data']['sample_period']/1000
+            ns = packet['data']['num_samples']
+            if not member in lists:
+                lists[member] = {'signal': list(packet['data']['samples']),
+                                 'time': list(np.linspace(ts,ts+(ns-1)*sp,ns))}
+            elif not ts in lists[member]['time']:
+                lists[member]['signal'].extend(packet['data']['samples'])
+                lists[member]['time'].extend(np.linspace(ts,ts+(ns-1)*sp,ns))
+    data = MeetingData()
+    for member in sorted(lists):
+        data[member] = {'time': np.array(lists[member]['time']),
+                        'signal': np.array(lists[member]['signal'], dtype=np.int64)}
+    return data
+
+def timeit(func, filename, repeat=3):
+    best = np.inf
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        data = func(filename)
+        best = min(best, time.perf_counter() - t0)
+    return best, data
+
+if __name__ == '__main__':
+    filename = sys.argv[1] if len(sys.argv) > 1 else 'data/audio_data_session_4.txt'
+    t_old, data_old = timeit(read_file_lists, filename, repeat=1)
+    t_new, data_new = timeit(preprocessing.read_file, filename)
+    assert data_old.members == data_new.members
+    for member in data_old.members:
+        assert np.array_equal(data_old[member]['time'], data_new[member]['time'])
+        assert np.array_equal(data_old[member]['signal'], data_new[member]['signal'])
+    print('File:           ', filename)
+    print('Lists (old):    ', np.round(t_old, 3), 'sec')
+    print('Streaming (new):', np.round(t_new, 3), 'sec')
+    print('Speedup:        ', np.round(t_old/t_new, 1), 'x')
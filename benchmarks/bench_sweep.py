@@ -0,0 +1,46 @@
+''' Time a parameter sweep against a single run of the analysis and against
+the same grid run through the memoized Pipeline, and check that all of them
+give the same indicators.
+
+Usage: python -m benchmarks.bench_sweep [log file] [kde method] [workers]
+'''
+import sys
+import time
+import numpy as np
+from badge_data_analysis.batch import run_session
+from badge_data_analysis.pipeline import Pipeline
+from badge_data_analysis.sweep import sweep, grid_points
+
+GRID = {'corr_thr': [0.7, 0.75, 0.8, 0.85, 0.9, 0.95],
+        'max_temp_shift': [0.1, 0.15, 0.3],
+        'silence_thr_mean': [0.6, 0.8, 1.0, 1.2, 1.5, 2.0]}
+
+if __name__ == '__main__':
+    filename = sys.argv[1] if len(sys.argv) > 1 else 'data/audio_data_session_4.txt'
+    method = sys.argv[2] if len(sys.argv) > 2 else 'binned'
+    workers = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+    points = grid_points(GRID)
+    t0 = time.perf_counter()
+    run_session(filename, kde_method=method)
+    t1 = time.perf_counter()
+    rows = sweep(filename, GRID, workers, kde_method=method)
+    t2 = time.perf_counter()
+    pipe = Pipeline(filename, kde_method=method)
+    same = True
+    for point in points:
+        try:
+            indicators = pipe.indicators(**point)
+        except Exception:
+            continue
+        members = pipe.run().members
+        for row in rows:
+            if all(row[key] == value for key, value in point.items()):
+                i = members.index(row['member'])
+                same &= bool(np.isclose(indicators['speaking_time'][i],
+                                        row['speaking_time']))
+    t3 = time.perf_counter()
+    print(len(points), 'grid points,', method, 'KDE,', workers, 'workers')
+    print('single run [s]  sweep [s]  pipeline [s]  same')
+    print('%14.2f  %9.2f  %12.2f  %4s' % (t1-t0, t2-t1, t3-t2, same))
+    print('Failed points:', len({tuple(row[key] for key in GRID) for row in rows
+                                 if row['error'] != None}))
@@ -0,0 +1,30 @@
+''' Compare the exact gaussian_kde thresholds against the binned estimation.
+
+Usage: python -m benchmarks.bench_thresholds [bandwidth]
+'''
+import sys
+import time
+import numpy as np
+from badge_data_analysis import vad
+
+def member_data(num_windows, rng):
+    # Window statistics of one member: silence around 5 and speech around 25
+    speak = rng.random(num_windows) < 0.3
+    gen_speak = np.where(speak, 1, -1).astype(np.int16)
+    win_mean = np.where(speak, rng.gamma(8, 3, num_windows), rng.gamma(4, 1.2, num_windows))
+    win_std = np.where(speak, rng.gamma(6, 2.5, num_windows), rng.gamma(3, 1, num_windows))
+    return {'gen_speak': gen_speak, 'win_mean': win_mean, 'win_std': win_std}
+
+if __name__ == '__main__':
+    bandwidth = float(sys.argv[1]) if len(sys.argv) > 1 else None
+    rng = np.random.default_rng(0)
+    print('windows   exact [s]  binned [s]  speedup  thr exact  thr binned')
+    for num_windows in [1000, 3600, 10000, 36000, 100000]:
+        data = member_data(num_windows, rng)
+        t0 = time.perf_counter()
+        exact = vad._detect_thr(data, 'win_mean', bandwidth, 'exact')
+        t1 = time.perf_counter()
+        binned = vad._detect_thr(data, 'win_mean', bandwidth, 'binned')
+        t2 = time.perf_counter()
+        print('%7d  %10.4f  %10.4f  %6.0fx  %9.2f  %10.3f' % (num_windows,
+              t1-t0, t2-t1, (t1-t0)/(t2-t1), exact, binned))
@@ -0,0 +1,98 @@
+''' Compare the iterative time jump correction against the single pass one on
+Unix timestamps, as in the hub logs: packets of 114 samples 50 ms apart whose
+start times have some jitter and are rounded to the millisecond. Reports the
+times of both on one long series per number of jumps, and then how many of a
+set of shorter random series give different corrected times and by how much:
+hub times, hub times not rounded, and times with a random period for every
+sample. The single pass keeps the periods it does not fix as they were read,
+while the iterative one computes them again from the shifted times, so with
+more than one jump they can differ in the last bits of the times.
+
+Usage: python -m benchmarks.bench_time_jumps [num_samples]
+'''
+import sys
+import time
+import numpy as np
+from badge_data_analysis import preprocessing
+from badge_data_analysis.meeting_data import MeetingData
+
+SAMPLES_PER_PACKET = 114
+SAMPLE_PERIOD = 0.05
+
+def fix_time_jumps_loop(data, max_jump_sec=1):
+    # Original implementation: one full pass over the times per jump
+    for member in data.members:
+        while True:
+            diff = np.diff(data[member]['time'])
+            diff_abs = np.abs(diff)
+            idx = np.argmax(diff_abs)
+            if diff_abs[idx] > max_jump_sec:
+                offset = diff[idx] - np.median(diff)
+                length, = data[member]['time'].shape
+                data[member]['time'] += np.pad(offset*np.ones((idx+1,)),
+                                               (0,length-idx-1))
+            else:
+                break
+    return data
+
+def add_jumps(rng, t, num_jumps, max_jump):
+    for idx in rng.integers(1, len(t), num_jumps):
+        t[idx:] += rng.choice([-1, 1])*rng.uniform(2, max_jump)
+    return t
+
+def hub_times(rng, num_samples, num_jumps, max_jump=5e4, rounded=True):
+    # Sample times of a badge whose clock jumps num_jumps times
+    num_packets = -(-num_samples // SAMPLES_PER_PACKET)
+    starts = 1.6e9 + np.cumsum(SAMPLES_PER_PACKET*SAMPLE_PERIOD
+                               + rng.normal(0, 0.005, num_packets))
+    starts = add_jumps(rng, starts, num_jumps, max_jump)
+    if rounded:
+        starts = np.round(starts, 3)
+    offsets = SAMPLE_PERIOD*np.arange(SAMPLES_PER_PACKET)
+    return (starts[:, None] + offsets).ravel()[:num_samples]
+
+def random_times(rng, num_samples, num_jumps, max_jump=5e4):
+    # Every period different, which is the worst case for the median
+    t = 1.6e9 + np.cumsum(rng.uniform(0.6, 1.4, num_samples)*SAMPLE_PERIOD)
+    return add_jumps(rng, t, num_jumps, max_jump)
+
+def meeting(t):
+    data = MeetingData()
+    data[1] = {'time': t.copy(), 'signal': np.zeros(t.shape, dtype=np.int64)}
+    return data
+
+def max_diff(t):
+    a, b = meeting(t), meeting(t)
+    fix_time_jumps_loop(a)
+    preprocessing.fix_time_jumps(b)
+    return np.max(np.abs(a[1]['time'] - b[1]['time']))
+
+if __name__ == '__main__':
+    num_samples = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    rng = np.random.default_rng(0)
+    print('jumps   loop [s]  single pass [s]  speedup  max diff [s]')
+    for num_jumps in [0, 1, 4, 16, 64]:
+        t = hub_times(rng, num_samples, num_jumps)
+        a, b = meeting(t), meeting(t)
+        t0 = time.perf_counter()
+        fix_time_jumps_loop(a)
+        t1 = time.perf_counter()
+        preprocessing.fix_time_jumps(b)
+        t2 = time.perf_counter()
+        print('%5d  %9.3f  %15.4f  %6.0fx  %12.3g' % (num_jumps, t1-t0, t2-t1,
+              (t1-t0)/(t2-t1), np.max(np.abs(a[1]['time'] - b[1]['time']))))
+    print()
+    print('times        jumps  series  different  max diff [s]  max diff per jump [ulp]')
+    ulp = np.spacing(1.6e9)
+    # Lengths of both parities: with an even number of periods the median
+    # is the mean of two of them, which is where the roundings part
+    series = [('hub', lambda k: hub_times(rng, rng.integers(10000, 20000), k, 1e6)),
+              ('hub, not ms', lambda k: hub_times(rng, rng.integers(10000, 20000),
+                                                  k, 1e6, False)),
+              ('random', lambda k: random_times(rng, rng.integers(1000, 2000), k, 1e6))]
+    for name, times in series:
+        for num_jumps in [1, 2, 4, 16, 64]:
+            diffs = np.array([max_diff(times(num_jumps)) for _ in range(300)])
+            print('%-11s  %5d  %6d  %9d  %12.3g  %23.2f' % (name, num_jumps,
+                  len(diffs), np.count_nonzero(diffs), np.max(diffs),
+                  np.max(diffs)/ulp/num_jumps))
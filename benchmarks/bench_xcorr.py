@@ -0,0 +1,52 @@
+''' Compare the per-lag loop cross-correlation against the batched one.
+
+Usage: python -m benchmarks.bench_xcorr [num_windows]
+'''
+import sys
+import time
+import numpy as np
+from badge_data_analysis import vad
+
+SAMPLE_PERIOD = 0.05
+
+def xcorr_loop(x, y, max_lag=None, normalize=True, eps=1e-10):
+    # Original implementation: one python iteration per lag
+    if len(x) > len(y):
+        s, l = y, x
+    else:
+        s, l = x, y
+    if max_lag == None:
+        init_pad = len(s) - 1
+        end_pad = len(s) - 1
+        out_len = len(s) + len(l) - 1
+    else:
+        init_pad = max_lag
+        end_pad = np.clip(max_lag - (len(l) - len(s)), 0, None)
+        out_len = 2*max_lag + 1
+    l = np.pad(l, (init_pad, end_pad))
+    corr = np.zeros((out_len,))
+    s_energy = np.sum(s**2)
+    for lag in range(out_len):
+        corr[lag] = np.sum(l[lag:lag+len(s)]*s)
+        if normalize:
+            corr[lag] /= np.sqrt(np.sum(l[lag:lag+len(s)]**2)*s_energy + eps)
+    return corr
+
+if __name__ == '__main__':
+    num_windows = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    rng = np.random.default_rng(0)
+    print('window  max_shift   loop [s]  batched [s]  speedup  max abs diff')
+    for window in [0.5, 1.0, 2.0, 5.0]:
+        n = int(round(window/SAMPLE_PERIOD))
+        x = list(rng.integers(0, 100, (num_windows, n)))
+        y = list(rng.integers(0, 100, (num_windows, n)))
+        for max_temp_shift in [0.05, 0.15, 0.5, 1.0]:
+            max_lag = int(np.round(max_temp_shift/SAMPLE_PERIOD))
+            t0 = time.perf_counter()
+            loop = np.array([np.max(xcorr_loop(a, b, max_lag)) for a, b in zip(x, y)])
+            t1 = time.perf_counter()
+            batched = vad.max_xcorr(x, y, max_lag)
+            t2 = time.perf_counter()
+            print('%6.2f  %9.2f  %9.3f  %11.4f  %6.0fx  %12.1e' % (window, 
+                  max_temp_shift, t1-t0, t2-t1, (t1-t0)/(t2-t1), 
+                  np.max(np.abs(loop - batched))))
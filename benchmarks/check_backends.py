@@ -0,0 +1,154 @@
+''' Check that the NumPy and the numba backends (see
+badge_data_analysis.kernels) give the same results: the kernels max_corr,
+turn_counts and overlapped_runs on random inputs against the NumPy code they
+replace, and the labels and indicators of whole sessions. A fresh process
+with numba hidden checks the fallback to NumPy. Exits with status 1 on any
+mismatch.
+
+Usage: python -m benchmarks.check_backends [log files or directories]
+'''
+import sys
+import json
+import hashlib
+import tempfile
+import subprocess
+import numpy as np
+if sys.argv[1:2] == ['--fallback']:
+    # Hide numba before kernels tries to import it
+    sys.modules['numba'] = None
+from badge_data_analysis import batch, kernels, metrics, synthetic, vad
+
+KEYS = ('gen_speak', 'all_speak', 'real_speak')
+# Float signals (linear alignment) add their products in another order
+FLOAT_RTOL = 1e-12
+
+def random_pairs(rng, num_pairs, dtype):
+    # Ragged pairs of segments as the windows of badges with lost samples
+    x_list, y_list = [], []
+    for _ in range(num_pairs):
+        len_x, len_y = rng.integers(1, 30, 2)
+        if dtype == int:
+            x_list.append(rng.integers(0, 200, len_x))
+            y_list.append(rng.integers(0, 200, len_y))
+        else:
+            x_list.append(rng.uniform(0, 200, len_x))
+            y_list.append(rng.uniform(0, 200, len_y))
+    return x_list, y_list
+
+def check_max_corr(rng):
+    failures = []
+    for dtype in (int, float):
+        x_list, y_list = random_pairs(rng, 500, dtype)
+        max_lags = [0, 1, 3, 8]
+        with kernels.using('numpy'):
+            expected = vad._lag_xcorr(x_list, y_list, max_lags)
+            expected_one = vad.max_xcorr(x_list, y_list, 3)
+        with kernels.using('numba'):
+            result = vad._lag_xcorr(x_list, y_list, max_lags)
+            result_one = vad.max_xcorr(x_list, y_list, 3)
+        for name, a, b in [('max_corr', expected, result),
+                           ('max_xcorr', expected_one, result_one)]:
+            same = np.array_equal(a, b) if dtype == int else \
+                   np.allclose(a, b, rtol=FLOAT_RTOL, atol=0)
+            if not same:
+                failures.append('%s (%s signals)' % (name, dtype.__name__))
+    return failures
+
+def random_labels(rng, num_members, num_windows):
+    # Speech runs of random lengths, overlapping now and then
+    labels = np.zeros((num_members, num_windows), dtype=bool)
+    for row in range(num_members):
+        lengths = rng.geometric(0.3, num_windows)
+        values = np.arange(len(lengths)) % 2 == rng.integers(2)
+        labels[row] = np.repeat(values, lengths)[:num_windows]
+    return labels
+
+def check_counters(rng):
+    failures = []
+    for trial in range(200):
+        labels = random_labels(rng, rng.integers(1, 7), rng.integers(0, 300))
+        num_members = labels.shape[0]
+        overlap = labels & (np.sum(labels, axis=0) >= 2)
+        rows, _ = metrics._overlap_events(labels, overlap)
+        if not np.array_equal(np.bincount(rows, minlength=num_members),
+                              kernels.overlapped_runs(labels, overlap)):
+            failures.append('overlapped_runs (trial %d)' % trial)
+        for required in (1, 2, 3):
+            rows, _ = metrics._turn_events(labels, required)
+            solo = np.where(np.sum(labels, axis=0) == 1)[0]
+            speakers = np.argmax(labels[:, solo], axis=0)
+            if not np.array_equal(np.bincount(rows, minlength=num_members),
+                                  kernels.turn_counts(speakers, num_members, required)):
+                failures.append('turn_counts (trial %d, required %d)' % (trial, required))
+    return failures
+
+def fingerprints(files, backend):
+    # Hash of the labels and indicators of every session and align mode, so
+    # the results of another process can be compared
+    result = {}
+    for filename in files:
+        for align in [None, 'nearest', 'linear']:
+            try:
+                data, indicators = batch.run_session(filename, align=align,
+                                                     backend=backend)
+            except ValueError as e:
+                result[filename + ' ' + str(align)] = 'failed: ' + str(e)
+                continue
+            sha = hashlib.sha1()
+            for key in KEYS:
+                sha.update(np.ascontiguousarray(data.matrix(key)).tobytes())
+            for key in batch.INDICATORS:
+                sha.update(np.asarray(indicators[key], dtype=float).tobytes())
+            result[filename + ' ' + str(align)] = sha.hexdigest()
+    return result
+
+def fallback(files):
+    # Run in a process where numba cannot be imported
+    failures = []
+    if kernels.backend != 'numpy':
+        failures.append('default backend without numba: ' + kernels.backend)
+    try:
+        kernels.set_backend('numba')
+        failures.append('set_backend(numba) without numba did not fail')
+    except ImportError:
+        pass
+    print(json.dumps({'failures': failures,
+                      'fingerprints': fingerprints(files, None)}))
+
+def compare(name, expected, result):
+    return ['%s: %s' % (name, key) for key in expected
+            if expected[key] != result.get(key)]
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--fallback']:
+        fallback(sys.argv[2:])
+        sys.exit(0)
+    rng = np.random.default_rng(0)
+    tmp_dir = tempfile.TemporaryDirectory()
+    # Logs with clock jumps, duplicates and lost packets
+    files = batch.find_logs(sys.argv[1:] or ['data'])
+    for seed in range(2):
+        filename = tmp_dir.name + '/synthetic_%d.txt' % seed
+        synthetic.generate(filename, num_members=4, hours=0.1, num_beacons=1,
+                           packet_loss=0.02, duplicates=0.02, clock_jumps=1,
+                           seed=seed)
+        files.append(filename)
+    failures = []
+    numpy_results = fingerprints(files, 'numpy')
+    if kernels.numba == None:
+        print('numba is not installed: only the fallback is checked')
+    else:
+        failures += check_max_corr(rng)
+        failures += check_counters(rng)
+        failures += compare('numba labels', numpy_results, fingerprints(files, 'numba'))
+    output = subprocess.run([sys.executable, '-m', 'benchmarks.check_backends',
+                             '--fallback'] + files, capture_output=True, text=True,
+                            check=True).stdout
+    child = json.loads(output.splitlines()[-1])
+    failures += child['failures']
+    failures += compare('fallback labels', numpy_results, child['fingerprints'])
+    tmp_dir.cleanup()
+    for failure in failures:
+        print('Mismatch:', failure)
+    print('%d sessions, %d mismatches' % (len(numpy_results), len(failures)))
+    sys.exit(1 if failures else 0)
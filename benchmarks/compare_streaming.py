@@ -0,0 +1,54 @@
+''' Compare the labels of the streaming VAD with those of the offline flow on
+the logs in data/ (or the given ones). The streaming processor gets the
+members and the thresholds of the offline run, and its windows are matched
+to the offline ones by their start time. Reports the share of windows with
+the same gen_speak labels, the share of equal real_speak labels and the
+speaking time of every member over the offline windows.
+
+Usage: python -m benchmarks.compare_streaming [log files or directories]
+'''
+import sys
+import numpy as np
+from badge_data_analysis import batch, streaming
+
+def compare(filename):
+    data, _ = batch.run_session(filename)
+    members = data.members
+    processor, windows = streaming.replay(filename, members=members,
+                                          thresholds=streaming.thresholds_from(data))
+    # The streaming clock is the one before the long jumps (see
+    # StreamingVAD._clock_offset), the offline one that after them
+    offset = np.median([processor._offsets[m] for m in members])
+    lag = int(np.round((processor.start_time + offset - data.meeting_start)
+                       /data.window_length))
+    # The last offline window is left unlabelled
+    first = max(lag, 0)
+    last = min(data.number_of_windows - 1, len(windows) + lag)
+    windows = windows[first-lag:last-lag]
+    result = {'offline windows': data.number_of_windows - 1,
+              'streaming windows': len(windows), 'lag': lag}
+    for key in ('gen_speak', 'real_speak'):
+        offline = data.matrix(key)[:, first:last]
+        online = np.array([[w[key][m] for w in windows] for m in members])
+        result[key] = offline == online
+    result['speaking_time'] = [(m, np.mean(data.matrix('real_speak')[i, first:last]),
+                                np.mean([w['real_speak'][m] for w in windows]))
+                               for i, m in enumerate(members)]
+    return result
+
+if __name__ == '__main__':
+    for filename in batch.find_logs(sys.argv[1:] or ['data']):
+        try:
+            result = compare(filename)
+        except ValueError as e:
+            print('%s: failed: %s' % (filename, e))
+            continue
+        print('%s: %d offline windows, %d matched, streaming starts %d windows '
+              'before' % (filename, result['offline windows'],
+                          result['streaming windows'], -result['lag']))
+        print('  same gen_speak in %.1f%% of the windows, same real_speak in '
+              '%.1f%% of the labels' % (100*np.mean(np.all(result['gen_speak'], axis=0)),
+                                       100*np.mean(result['real_speak'])))
+        for member, offline, online in result['speaking_time']:
+            print('  member %d speaking time: offline %.3f, streaming %.3f'
+                  % (member, offline, online))
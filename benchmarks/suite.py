@@ -0,0 +1,205 @@
+''' Time every public function of preprocessing, vad and metrics on the logs
+in data/ and on synthetic logs of growing size (see
+badge_data_analysis.synthetic), and report how each one scales with the
+number of members and the duration. Each function runs on a copy of the
+result of the pipeline stage that precedes it, best of --repeat runs.
+
+Results can be saved as JSON and compared against a previous run, to catch
+regressions (the exit code is 1 when some function got slower).
+
+Usage: python -m benchmarks.suite [--members 4 8 16 24] [--hours 0.5 1 2 4]
+                                  [--save results.json] [--compare base.json]
+'''
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+import tempfile
+import numpy as np
+from badge_data_analysis import preprocessing, vad, metrics, synthetic
+from badge_data_analysis.pipeline import Pipeline
+
+def _iter_packets(data, filename):
+    with open(filename, 'r') as fid:
+        for packet in preprocessing.iter_packets(fid):
+            pass
+
+def _window_pairs(data):
+    # Samples of the first two members in every window
+    a, b = data.members[:2]
+    signal_a, bounds_a = vad._windowed_signal(data[a]), data[a]['win_idx']
+    signal_b, bounds_b = vad._windowed_signal(data[b]), data[b]['win_idx']
+    x = [signal_a[bounds_a[i]:bounds_a[i+1]] for i in range(len(bounds_a) - 2)]
+    y = [signal_b[bounds_b[i]:bounds_b[i+1]] for i in range(len(bounds_b) - 2)]
+    pairs = [(p, q) for p, q in zip(x, y) if len(p) > 0 and len(q) > 0]
+    return [p for p, q in pairs], [q for p, q in pairs]
+
+def _max_xcorr(data, filename):
+    x, y = _window_pairs(data)
+    vad.max_xcorr(x, y, 3)
+
+def _batch_xcorr(data, filename):
+    x, y = _window_pairs(data)
+    length = min(min(len(p) for p in x), min(len(q) for q in y))
+    vad.batch_xcorr(np.array([p[:length] for p in x]),
+                    np.array([q[:length] for q in y]), 3)
+
+def _xcorr(data, filename):
+    a, b = data.members[:2]
+    length = min(len(data[a]['signal']), len(data[b]['signal']), 20*600)
+    vad.xcorr(data[a]['signal'][:length], data[b]['signal'][:length], 3)
+
+def _densities(data, filename):
+    # Only members with speech and silence, as calculate_thresholds
+    for member in data.members:
+        gen_speak = data[member]['gen_speak']
+        if np.sum(gen_speak > 0) > 1 and np.sum(gen_speak < 0) > 1:
+            vad.densities(data[member], 'win_mean')
+
+# Name, pipeline stage whose result is the input (None for the log alone)
+# and function of the data and the log file name
+CASES = [
+    ('preprocessing.iter_packets', None, _iter_packets),
+    ('preprocessing.read_file', None, lambda data, f: preprocessing.read_file(f)),
+    ('preprocessing.fix_time_jumps', 'read', lambda data, f: preprocessing.fix_time_jumps(data)),
+    ('preprocessing.truncate', 'fix_time_jumps', lambda data, f: preprocessing.truncate(data)),
+    ('preprocessing.remove_offset', 'truncate', lambda data, f: preprocessing.remove_offset(data)),
+    ('preprocessing.align', 'remove_offset', lambda data, f: preprocessing.align(data)),
+    ('vad.xcorr', 'remove_offset', _xcorr),
+    ('vad.window_index', 'align', lambda data, f: vad.window_index(data)),
+    ('vad.window_stats', 'align', lambda data, f: vad.window_stats(data)),
+    ('vad.window_statistics', 'align', lambda data, f: vad.window_statistics(data)),
+    ('vad.batch_xcorr', 'window_statistics', _batch_xcorr),
+    ('vad.max_xcorr', 'window_statistics', _max_xcorr),
+    ('vad.label_genuine', 'window_statistics', lambda data, f: vad.label_genuine(data)),
+    ('vad.pair_similarity', 'window_statistics', lambda data, f: vad.pair_similarity(data)),
+    ('vad.genuine_speak', 'align', lambda data, f: vad.genuine_speak(data)),
+    ('vad.densities', 'genuine_speak', _densities),
+    ('vad.calculate_thresholds', 'genuine_speak', lambda data, f: vad.calculate_thresholds(data)),
+    ('vad.calculate_thresholds binned', 'genuine_speak',
+     lambda data, f: vad.calculate_thresholds(data, method='binned')),
+    ('vad.all_speak', 'thresholds', lambda data, f: vad.all_speak(data)),
+    ('vad.real_speak', 'all_speak', lambda data, f: vad.real_speak(data)),
+    ('metrics.speaking_time', 'real_speak', lambda data, f: metrics.speaking_time(data)),
+    ('metrics.overlap_time', 'real_speak', lambda data, f: metrics.overlap_time(data)),
+    ('metrics.overlap_count', 'real_speak', lambda data, f: metrics.overlap_count(data)),
+    ('metrics.overlap_count fill_gaps', 'real_speak',
+     lambda data, f: metrics.overlap_count(data, fill_gaps=True)),
+    ('metrics.turn_taking', 'real_speak', lambda data, f: metrics.turn_taking(data)),
+    ('metrics.rolling_indicators', 'real_speak',
+     lambda data, f: metrics.rolling_indicators(data, horizons=(60, 300, 600), stride=10)),
+    ('metrics.calculate_indicators', 'metrics',
+     lambda data, f: metrics.calculate_indicators(data, print_results=False)),
+]
+
+def time_log(filename, cases, repeat=3):
+    # Best time of every case on one log, None when its input can not be
+    # computed (e.g. the thresholds of a log without speech)
+    pipe = Pipeline(filename)
+    times = {}
+    for name, stage, func in cases:
+        try:
+            state = pipe.run(stage) if stage != None else None
+            best = np.inf
+            for _ in range(repeat):
+                data = state.copy() if state != None else None
+                t0 = time.perf_counter()
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    func(data, filename)
+                best = min(best, time.perf_counter() - t0)
+            times[name] = best
+        except Exception:
+            times[name] = None
+    return times
+
+def _exponent(sizes, times):
+    # Slope of log(time) against log(size): ~1 linear, ~2 quadratic
+    valid = [(s, t) for s, t in zip(sizes, times) if t != None and t > 0]
+    if len(valid) < 2:
+        return np.nan
+    s, t = np.log(np.array(valid)).T
+    return np.polyfit(s, t, 1)[0]
+
+def _print_table(title, labels, results, cases, sizes=None):
+    print('\n' + title)
+    header = '%-34s' % 'function' + ''.join('%11s' % label for label in labels)
+    print(header + ('   exponent' if sizes != None else ''))
+    for name, _, _ in cases:
+        times = [result[name] for result in results]
+        line = '%-34s' % name + ''.join('%11s' % ('failed' if t == None else
+                                         '%.4f' % t) for t in times)
+        if sizes != None:
+            exponent = _exponent(sizes, times)
+            line += '%11.2f' % exponent + (' <-' if exponent > 1.5 else '')
+        print(line)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--data', default='data', help='directory of real logs')
+    parser.add_argument('--members', type=int, nargs='*', default=[4, 8, 16, 24],
+                        help='members of the synthetic logs (at --base-hours)')
+    parser.add_argument('--hours', type=float, nargs='*', default=[0.5, 1, 2, 4],
+                        help='durations of the synthetic logs (with --base-members)')
+    parser.add_argument('--base-members', type=int, default=6)
+    parser.add_argument('--base-hours', type=float, default=1)
+    parser.add_argument('--beacons', type=int, default=1)
+    parser.add_argument('--duplicates', type=float, default=0.05)
+    parser.add_argument('--jumps', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('-k', '--cases', default='', help='only the functions '
+                        'whose name contains this text')
+    parser.add_argument('--save', default=None, help='save the times as JSON')
+    parser.add_argument('--compare', default=None, help='JSON of a previous run')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='relative slowdown reported as a regression')
+    args = parser.parse_args(argv)
+    cases = [case for case in CASES if args.cases in case[0]]
+    results = {}
+
+    files = sorted(glob.glob(os.path.join(args.data, '*.txt')))
+    for filename in files:
+        results[os.path.basename(filename)] = time_log(filename, cases, args.repeat)
+    if files:
+        labels = [os.path.splitext(os.path.basename(f))[0][-10:] for f in files]
+        _print_table('Sample logs [s]', labels,
+                     [results[os.path.basename(f)] for f in files], cases)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for axis, sizes in (('members', args.members), ('hours', args.hours)):
+            if len(sizes) == 0:
+                continue
+            names = []
+            for size in sizes:
+                members = size if axis == 'members' else args.base_members
+                hours = size if axis == 'hours' else args.base_hours
+                name = 'synthetic_%dm_%gh' % (members, hours)
+                filename = os.path.join(tmp_dir, name + '.txt')
+                synthetic.generate(filename, members, hours, args.beacons,
+                                   duplicates=args.duplicates, clock_jumps=args.jumps)
+                results[name] = time_log(filename, cases, args.repeat)
+                names.append(name)
+            _print_table('Synthetic logs, by ' + axis + ' [s]', [str(s) for s in sizes],
+                         [results[name] for name in names], cases, sizes)
+
+    if args.save != None:
+        with open(args.save, 'w') as fid:
+            json.dump(results, fid, indent=1)
+    if args.compare != None:
+        with open(args.compare, 'r') as fid:
+            baseline = json.load(fid)
+        slower = []
+        for log, times in results.items():
+            for name, t in times.items():
+                t_base = baseline.get(log, {}).get(name)
+                if t != None and t_base != None and t > (1 + args.tolerance)*t_base:
+                    slower.append((log, name, t_base, t))
+        print('\nRegressions against', args.compare + ':', len(slower))
+        for log, name, t_base, t in slower:
+            print('  %-28s %-34s %.4f -> %.4f s' % (log, name, t_base, t))
+        return 1 if slower else 0
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())